@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Append-only archive of every chat message, for auditing who painted what
+and for rebuilding canvases.
+
+A ChatArchive takes batches of ChatMessages from the receive path (one
+deque append per batch) and a background thread does the rest: it
+formats them as lines
+
+    time<TAB>channel<TAB>username<TAB>tags<TAB>message
+
+and writes them in blocks, each block a gzip member of its own, to
+rotating segment files chat-YYYYmmdd-HHMMSS.gz (so `zcat` reads them;
+several processes can share a directory with different prefixes).
+Next to every segment a .idx file gets one JSON line per block: its
+offset and length in the segment, the time range, the number of lines
+and a Bloom filter of the usernames in it. A query reads the indexes
+and only decompresses the blocks that can match:
+
+    python archive.py chat_archive --user someone --since 3600
+"""
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import zlib
+from collections import deque, namedtuple
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+ARCHIVED = REGISTRY.counter('archive_lines_total', 'Chat messages written to the archive')
+ARCHIVE_BYTES = REGISTRY.counter('archive_bytes_total', 'Compressed bytes written to the archive')
+
+ArchivedMessage = namedtuple('ArchivedMessage', 'time channel username tags message')
+
+
+def _bloom_positions(username, bits):
+    digest = hashlib.blake2b(username.encode('utf-8'), digest_size=8).digest()
+    a = int.from_bytes(digest[:4], 'little')
+    b = int.from_bytes(digest[4:], 'little') | 1
+    # double hashing, three probes
+    return [(a + i * b) % bits for i in range(3)]
+
+
+def bloom_filter(usernames):
+    """
+    :return: Bloom filter of a set of usernames as bytes, 16 bits per
+        name (under 1% false positives)
+    """
+    bits = max(64, 16 * len(usernames))
+    bits += -bits % 8
+    bloom = bytearray(bits // 8)
+    for username in usernames:
+        for p in _bloom_positions(username, bits):
+            bloom[p >> 3] |= 1 << (p & 7)
+    return bytes(bloom)
+
+
+def bloom_contains(bloom, username):
+    bits = len(bloom) * 8
+    return all(bloom[p >> 3] & (1 << (p & 7))
+               for p in _bloom_positions(username, bits))
+
+
+def _sent_time(raw_tags):
+    """
+    tmi-sent-ts of a message in seconds, read from the raw tags rather
+    than through ChatMessage.timestamp, which parses all of them
+    """
+    start = raw_tags.find('tmi-sent-ts=') if raw_tags else -1
+    if start < 0:
+        return None
+    start += 12
+    end = raw_tags.find(';', start)
+    try:
+        return int(raw_tags[start:end if end >= 0 else None]) / 1000.0
+    except ValueError:
+        return None
+
+
+class ChatArchive(object):
+    """
+    Archives chat messages from a background thread, see the module
+    docstring.
+    :param path: directory of the segments, created when missing
+    :param block_lines: lines per compressed block at most
+    :param block_seconds: a block is written at least this often while
+        there is chat, so at most this much is lost in a crash
+    :param segment_seconds: start a new segment file this often
+    :param segment_bytes: or when the current one gets this large
+    :param prefix: start of the segment names, differs per process when
+        several write to one directory
+    """
+
+    def __init__(self, path, block_lines=2000, block_seconds=5.,
+                 segment_seconds=3600, segment_bytes=64 << 20, prefix='chat'):
+        self.path = path
+        self.prefix = prefix
+        self.block_lines = block_lines
+        self.block_seconds = block_seconds
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        os.makedirs(path, exist_ok=True)
+        self.pending = deque()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.segment = None
+        self.index = None
+        self.segment_started = 0.
+        self.thread = threading.Thread(target=self._run, name='chat-archive',
+                                       daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def add_many(self, messages):
+        """
+        Queue a batch of ChatMessages, stamped with the current time for
+        messages without a tmi-sent-ts tag. Cheap enough for the receive
+        thread: the writer thread is not woken, it picks the batches up
+        every block_seconds.
+        """
+        if messages:
+            self.pending.append((time.time(), messages))
+
+    def add(self, message):
+        self.add_many([message])
+
+    def close(self):
+        """
+        Write everything queued so far and stop the thread.
+        """
+        self.stopping = True
+        self.wakeup.set()
+        self.thread.join()
+
+    def _run(self):
+        lines = []
+        users = set()
+        first = last = None
+        block_started = time.monotonic()
+        while True:
+            self.wakeup.wait(self.block_seconds)
+            self.wakeup.clear()
+            stopping = self.stopping
+            pending = self.pending
+            while pending:
+                received, messages = pending.popleft()
+                for msg in messages:
+                    ts = _sent_time(msg.raw_tags) or received
+                    if first is None or ts < first:
+                        first = ts
+                    if last is None or ts > last:
+                        last = ts
+                    users.add(msg.username)
+                    lines.append('%.3f\t%s\t%s\t%s\t%s\n' % (
+                        ts, msg.channel, msg.username, msg.raw_tags or '',
+                        msg.message))
+                if len(lines) >= self.block_lines:
+                    self._write_block(lines, users, first, last)
+                    lines, users, first, last = [], set(), None, None
+                    block_started = time.monotonic()
+            if lines and (stopping or time.monotonic() - block_started >= self.block_seconds):
+                self._write_block(lines, users, first, last)
+                lines, users, first, last = [], set(), None, None
+            if not lines:
+                block_started = time.monotonic()
+            if stopping:
+                break
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+
+    def _open_segment(self, now):
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+        name = self.prefix + time.strftime('-%Y%m%d-%H%M%S', time.gmtime(now))
+        self.segment = open(os.path.join(self.path, name + '.gz'), 'ab')
+        self.index = open(os.path.join(self.path, name + '.idx'), 'a')
+        self.segment_started = now
+        log.info("Archiving to %s.gz", name)
+
+    def _write_block(self, lines, users, first, last):
+        now = time.time()
+        if (self.segment is None
+                or now - self.segment_started >= self.segment_seconds
+                or self.segment.tell() >= self.segment_bytes):
+            self._open_segment(now)
+        compressor = zlib.compressobj(wbits=31)  # a complete gzip member
+        data = compressor.compress(''.join(lines).encode('utf-8')) + compressor.flush()
+        offset = self.segment.tell()
+        self.segment.write(data)
+        self.segment.flush()
+        # the index only ever points at blocks that are completely written
+        self.index.write(json.dumps({
+            'offset': offset, 'length': len(data), 'first': first,
+            'last': last, 'count': len(lines),
+            'users': base64.b64encode(bloom_filter(users)).decode('ascii'),
+        }) + '\n')
+        self.index.flush()
+        ARCHIVED.inc(len(lines))
+        ARCHIVE_BYTES.inc(len(data))
+
+
+def query(path, username=None, since=None, until=None, channel=None):
+    """
+    Read messages back from an archive, decompressing only the blocks
+    whose time range and username filter can match.
+    :param path: the archive directory
+    :param username: only messages by this user
+    :param since: only messages at or after this time (seconds since the
+        epoch)
+    :param until: only messages before this time
+    :param channel: only messages in this channel ('#name')
+    :return: iterator over ArchivedMessages, segment by segment in
+        name order (oldest first for each prefix)
+    """
+    if username is not None:
+        username = username.lower()
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.idx'):
+            continue
+        segment = os.path.join(path, name[:-4] + '.gz')
+        with open(os.path.join(path, name)) as f:
+            blocks = [json.loads(line) for line in f if line.endswith('\n')]
+        blocks = [b for b in blocks
+                  if (since is None or b['last'] >= since)
+                  and (until is None or b['first'] < until)
+                  and (username is None or bloom_contains(
+                      base64.b64decode(b['users']), username))]
+        if not blocks:
+            continue
+        with open(segment, 'rb') as f:
+            for block in blocks:
+                f.seek(block['offset'])
+                text = zlib.decompress(f.read(block['length']), wbits=31).decode('utf-8')
+                # not splitlines(), chat may contain other line breaks
+                for line in text.split('\n')[:-1]:
+                    ts, chan, user, tags, message = line.split('\t', 4)
+                    ts = float(ts)
+                    if ((username is None or user == username)
+                            and (since is None or ts >= since)
+                            and (until is None or ts < until)
+                            and (channel is None or chan == channel)):
+                        yield ArchivedMessage(ts, chan, user, tags, message)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Search a chat archive')
+    parser.add_argument('path', help='the archive directory')
+    parser.add_argument('--user', help='only messages by this user')
+    parser.add_argument('--channel', help='only messages in this channel (without #)')
+    parser.add_argument('--since', type=float,
+                        help='only the last this many seconds')
+    args = parser.parse_args(argv)
+    since = time.time() - args.since if args.since else None
+    channel = '#' + args.channel.lower() if args.channel else None
+    try:
+        for msg in query(args.path, args.user, since, channel=channel):
+            print('%s %s %s: %s' % (
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(msg.time)),
+                msg.channel, msg.username, msg.message))
+    except BrokenPipeError:  # piped into head
+        sys.stderr.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load benchmark: replays chat from fakeserver.FakeTwitchServer into the
+chat client and the pixel pipeline, and reports the sustained message
+rate, end-to-end latency (from the server writing a line to the canvas
+holding its pixels) and lost or garbled messages.
+
+    python bench_load.py --rate 5000 --duration 10 --shape burst
+    python bench_load.py --client sync --log recorded_chat.log
+    python bench_load.py --rate 20000 --bus drop-oldest --chunk-cost 5
+
+The server runs in a thread of its own, the client in the main thread:
+'async' reads with AsyncTwitchChatStream.receive_messages, 'sync' polls
+TwitchChatStream.twitch_receive_messages on a socket made readable by
+select. Every batch that is received is applied to the canvas at once.
+With --bus the client only queues the batches on an EventBus and a
+second thread paints them, 256 messages at a time, like the Tk loop does;
+--chunk-cost adds a sleep per chunk to stand in for a slow consumer, so
+the drop policies can be compared under overload.
+"""
+import argparse
+import asyncio
+import select
+import sys
+import threading
+import time
+
+import numpy as np
+
+from canvas import PixelBatch
+from chat import AsyncTwitchChatStream, TwitchChatStream
+from eventbus import POLICIES, EventBus
+from fakeserver import (FakeTwitchServer, recorded_chat, schedule,
+                        synthetic_chat)
+
+
+class ServerThread(threading.Thread):
+    """
+    Runs a FakeTwitchServer and one replay in a background event loop.
+    """
+
+    def __init__(self, args):
+        threading.Thread.__init__(self, daemon=True)
+        self.args = args
+        self.ready = threading.Event()
+        self.done = threading.Event()
+        self.server = None
+        self.sent_count = 0
+        self.chat = recorded_chat(args.log) if args.log else synthetic_chat()
+
+    def run(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        args = self.args
+        self.server = await FakeTwitchServer().start()
+        self.ready.set()
+        await self.server.wait_for_members(args.channel)
+        self.sent_count = await self.server.replay(
+            args.channel, self.chat, schedule(args.shape, args.rate, args.duration))
+        self.done.set()
+        # let the client drain what is still in flight
+        await asyncio.sleep(args.grace)
+        await self.server.close()
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.latencies = []
+        self.seen = set()
+        self.garbled = 0
+        self.duplicates = 0
+        self.first = None
+        self.last = None
+
+    def record(self, rec, sent_texts):
+        """
+        Check a batch against what the server sent and time it, right
+        after its pixels are on the canvas.
+        """
+        now = time.time_ns()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        for msg in rec:
+            try:
+                seq = int(msg.tags['id'])
+                sent_ns = int(msg.tags['x-sent-ns'])
+                ok = sent_texts[seq] == msg.message
+            except (KeyError, ValueError, IndexError):
+                ok = False
+            if not ok:
+                self.garbled += 1
+                continue
+            if seq in self.seen:
+                self.duplicates += 1
+            self.seen.add(seq)
+            self.latencies.append(now - sent_ns)
+
+    def report(self, sent, shed=0):
+        received = len(self.seen)
+        print('sent           %8d' % sent)
+        print('received       %8d' % received)
+        print('shed           %8d' % shed)
+        print('dropped        %8d' % (sent - received - shed))
+        print('garbled        %8d' % self.garbled)
+        print('duplicates     %8d' % self.duplicates)
+        if received > 1 and self.last > self.first:
+            print('sustained      %8.0f msg/s' % (received / ((self.last - self.first) / 1e9)))
+        if self.latencies:
+            lat = np.array(self.latencies) / 1e6
+            print('latency p50    %8.2f ms' % np.percentile(lat, 50))
+            print('latency p99    %8.2f ms' % np.percentile(lat, 99))
+            print('latency max    %8.2f ms' % lat.max())
+
+
+def paint(rec, batch, array):
+    for msg in rec:
+        batch.add_message(msg.message)
+    batch.apply(array)
+
+
+class Painter(object):
+    """
+    Paints received batches right away.
+    """
+
+    def __init__(self, thread, stats, array):
+        self.thread = thread
+        self.stats = stats
+        self.array = array
+        self.batch = PixelBatch()
+
+    def __call__(self, rec):
+        paint(rec, self.batch, self.array)
+        self.stats.record(rec, self.thread.server.sent)
+
+
+class BusPainter(Painter, threading.Thread):
+    """
+    Queues received batches on an EventBus and paints them from a thread
+    of its own.
+    """
+
+    def __init__(self, thread, stats, array, policy, chunk_cost):
+        Painter.__init__(self, thread, stats, array)
+        threading.Thread.__init__(self, daemon=True)
+        self.bus = EventBus(policy=policy)
+        self.chunk_cost = chunk_cost
+        self.stop = threading.Event()
+
+    def __call__(self, rec):
+        self.bus.put_many(rec)
+
+    def run(self):
+        while not (self.stop.is_set() and not self.bus):
+            rec = self.bus.get_many(256)
+            if not rec:
+                time.sleep(.001)
+                continue
+            Painter.__call__(self, rec)
+            if self.chunk_cost:
+                time.sleep(self.chunk_cost)
+
+
+async def run_async(args, handle):
+    chat = AsyncTwitchChatStream('benchbot', 'oauth:bench', reconnect=False)
+    await chat.connect()
+    await chat.join_channel(args.channel)
+    try:
+        while True:
+            rec = await chat.receive_messages()
+            if rec is None:
+                break
+            if rec:
+                handle(rec)
+    finally:
+        await chat.close()
+
+
+def run_sync(args, thread, handle):
+    chat = TwitchChatStream('benchbot', 'oauth:bench', reconnect=False)
+    chat.connect()
+    chat.join_channel(args.channel)
+    while chat.connected:
+        readable, _, _ = select.select([chat.s], [], [], .5)
+        if not readable:
+            if not thread.is_alive():
+                break
+            continue
+        rec = chat.twitch_receive_messages()
+        if rec:
+            handle(rec)
+    chat.s.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Chat load benchmark')
+    parser.add_argument('--client', default='async', choices=['async', 'sync'])
+    parser.add_argument('--log', help='recorded chat to replay, synthetic when omitted')
+    parser.add_argument('--rate', type=float, default=2000, help='messages per second')
+    parser.add_argument('--shape', default='constant', choices=['constant', 'burst', 'ramp'])
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--grace', type=float, default=1,
+                        help='seconds to wait for stragglers after the replay')
+    parser.add_argument('--channel', default='bench')
+    parser.add_argument('--size', type=int, default=500, help='canvas width and height')
+    parser.add_argument('--bus', choices=POLICIES,
+                        help='paint from a second thread fed by an EventBus with this policy')
+    parser.add_argument('--chunk-cost', type=float, default=0,
+                        help='milliseconds the painting thread sleeps per chunk')
+    args = parser.parse_args(argv)
+
+    thread = ServerThread(args)
+    thread.start()
+    thread.ready.wait()
+    AsyncTwitchChatStream.connect_host = TwitchChatStream.connect_host = '127.0.0.1'
+    AsyncTwitchChatStream.connect_port = TwitchChatStream.connect_port = thread.server.port
+
+    stats = Stats()
+    array = np.zeros((args.size, args.size, 3), np.uint8)
+    print('%s client, %s shape, %g msg/s for %gs'
+          % (args.client, args.shape, args.rate, args.duration))
+    if args.bus:
+        handle = BusPainter(thread, stats, array, args.bus, args.chunk_cost / 1000.)
+        handle.start()
+    else:
+        handle = Painter(thread, stats, array)
+    if args.client == 'async':
+        asyncio.run(run_async(args, handle))
+    else:
+        run_sync(args, thread, handle)
+    thread.join()
+    shed = 0
+    if args.bus:
+        handle.stop.set()
+        handle.join()
+        shed = handle.bus.dropped
+    stats.report(thread.sent_count, shed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmark of the chat line parser.
+Compares ircv3.parse_line with the regex based parsing twitch.py used
+before, over a recorded corpus (one raw IRC line per line of the file)
+or, without arguments, over a synthetic corpus of Twitch chat.
+
+    python bench_parse.py [recorded_chat.log]
+"""
+import random
+import re
+import sys
+import time
+
+from ircv3 import parse_line
+
+
+class _LegacyStream(object):
+    """
+    The regex based parsing of TwitchChatStream this replaced, copied
+    as it was, with the stream state it touched.
+    """
+
+    def __init__(self):
+        self.buffer = []
+        self.current_channel = None
+
+    @staticmethod
+    def _check_has_ping(data):
+        return re.match(
+            r'^PING :tmi\.twitch\.tv$', data)
+
+    @staticmethod
+    def _check_has_channel(data):
+        return re.findall(
+            r'^:[a-zA-Z0-9_]+\![a-zA-Z0-9_]+@[a-zA-Z0-9_]+'
+            r'\.tmi\.twitch\.tv '
+            r'JOIN #([a-zA-Z0-9_]+)$', data)
+
+    @staticmethod
+    def _check_has_message(data):
+        return re.match(r'^:[a-zA-Z0-9_]+\![a-zA-Z0-9_]+@[a-zA-Z0-9_]+'
+                        r'\.tmi\.twitch\.tv '
+                        r'PRIVMSG #[a-zA-Z0-9_]+ :.+$', data)
+
+    def _send_pong(self):
+        self.buffer.append("PONG\n")
+
+    def _parse_message(self, data):
+        if _LegacyStream._check_has_ping(data):
+            self._send_pong()
+        if _LegacyStream._check_has_channel(data):
+            self.current_channel = \
+                _LegacyStream._check_has_channel(data)[0]
+
+        if _LegacyStream._check_has_message(data):
+            return {
+                'channel': re.findall(r'^:.+![a-zA-Z0-9_]+'
+                                      r'@[a-zA-Z0-9_]+'
+                                      r'.+ '
+                                      r'PRIVMSG (.*?) :',
+                                      data)[0],
+                'username': re.findall(r'^:([a-zA-Z0-9_]+)!', data)[0],
+                'message': re.findall(r'PRIVMSG #[a-zA-Z0-9_]+ :(.+)',
+                                      data)[0]
+            }
+        else:
+            return None
+
+
+_legacy_stream = _LegacyStream()
+
+
+def legacy_parse(data):
+    """
+    The old TwitchChatStream._parse_message plus the field access the
+    bot does on every message.
+    """
+    msg = _legacy_stream._parse_message(data)
+    if msg is not None:
+        return msg['channel'], msg['username'], msg['message']
+    return None
+
+
+def new_parse(data):
+    """parse_line plus the field access the bot does on every message."""
+    msg = parse_line(data)
+    if msg is not None and msg.command == 'PRIVMSG':
+        return msg.channel, msg.username, msg.message
+    return None
+
+
+def synthetic_corpus(n, tagged, seed=0):
+    rnd = random.Random(seed)
+    words = ['Kappa', 'PogChamp', 'LUL', 'hello', 'gg', 'wow', 'nice',
+             'draw', 'here', 'please']
+    lines = []
+    for i in range(n):
+        user = 'user%d' % rnd.randrange(5000)
+        r = rnd.random()
+        if r < 0.01:
+            lines.append('PING :tmi.twitch.tv')
+            continue
+        if r < 0.02:
+            lines.append(':%s!%s@%s.tmi.twitch.tv JOIN #channel'
+                         % (user, user, user))
+            continue
+        text = ' '.join(rnd.choice(words) for _ in range(rnd.randrange(1, 8)))
+        if rnd.random() < 0.5:
+            text += ' (%d,%d)' % (rnd.randrange(500), rnd.randrange(500))
+        line = ':%s!%s@%s.tmi.twitch.tv PRIVMSG #channel :%s' % (
+            user, user, user, text)
+        if tagged:
+            line = ('@badge-info=;badges=subscriber/12,premium/1;'
+                    'color=#%06X;display-name=%s;emotes=25:0-4;'
+                    'first-msg=0;flags=;id=%08x-0000-4000-8000-%012x;mod=0;'
+                    'room-id=1234567;subscriber=1;tmi-sent-ts=%d;turbo=0;'
+                    'user-id=%d;user-type= %s' % (
+                        rnd.randrange(1 << 24), user, i, i,
+                        1507246572675 + i, rnd.randrange(1 << 30), line))
+        lines.append(line)
+    return lines
+
+
+def bench(parsers, lines, repeat=7):
+    """
+    :return: lines per second of each parser, from its best of repeat
+        rounds; the parsers take turns within a round, so a busy machine
+        slows them alike instead of skewing their ratio
+    """
+    best = [float('inf')] * len(parsers)
+    for _ in range(repeat):
+        for i, parse in enumerate(parsers):
+            t0 = time.perf_counter()
+            for line in lines:
+                parse(line)
+            best[i] = min(best[i], time.perf_counter() - t0)
+    return [len(lines) / t for t in best]
+
+
+def main(argv):
+    if len(argv) > 1:
+        with open(argv[1], encoding='utf-8', errors='replace') as f:
+            recorded = [line.rstrip('\r\n') for line in f if line.strip()]
+        corpora = [('recorded', recorded)]
+    else:
+        corpora = [('untagged', synthetic_corpus(50000, False)),
+                   ('tagged', synthetic_corpus(50000, True))]
+    for name, lines in corpora:
+        if any(line.startswith('@') for line in lines):
+            # the regex parser does not understand tagged lines at all
+            new, = bench([new_parse], lines)
+            print('%-9s parse_line  %10.0f lines/s' % (name, new))
+            continue
+        new, old = bench([new_parse, legacy_parse], lines)
+        print('%-9s parse_line  %10.0f lines/s' % (name, new))
+        print('%-9s regex       %10.0f lines/s  (%.1fx)'
+              % (name, old, new / old))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Canvas operations shared by the GUI and the headless bot. The canvas is
+a NumPy uint8 array indexed [x][y][rgb], or a tiles.TiledCanvas.
+"""
+import re
+import functools
+import numpy as np
+from metrics import REGISTRY
+
+PIXELS_APPLIED = REGISTRY.counter('canvas_pixels_applied_total', 'Pixel commands written to a canvas')
+PIXELS_REJECTED = REGISTRY.counter('canvas_pixels_rejected_total', 'Pixel commands outside the canvas')
+PIXELS_COALESCED = REGISTRY.counter('canvas_pixels_coalesced_total', 'Pixel commands overwritten within the same batch')
+PIXELS_SHED = REGISTRY.counter('canvas_pixels_shed_total', 'Pixel commands dropped because a batch was full')
+EMOTES_STAMPED = REGISTRY.counter('canvas_emotes_stamped_total', 'Emote sprites stamped onto a canvas')
+SHAPES_DRAWN = REGISTRY.counter('canvas_shapes_drawn_total', 'Rectangles, lines and fills drawn onto a canvas')
+
+
+# at most six digits, larger numbers are no coordinates and would not
+# fit the int64 arrays
+PIXEL_COMMAND = re.compile(
+    r'[(\[{](-?\d{1,6}),\s*(-?\d{1,6})(?:,\s*(#[0-9a-fA-F]{6}|[a-zA-Z]+))?[)\]}]')
+# rect(x0,y0,x1,y1[,color]), box(...) (outline), line(...) and fill(x,y[,color])
+SHAPE_COMMAND = re.compile(
+    r'\b(rect|box|line|fill)\s*[(\[{](-?\d{1,6}),\s*(-?\d{1,6})'
+    r'(?:,\s*(-?\d{1,6}),\s*(-?\d{1,6}))?'
+    r'(?:,\s*(#[0-9a-fA-F]{6}|[a-zA-Z]+))?[)\]}]')
+# anything that may hold a pixel or shape command, for cheap prefiltering
+COMMAND = re.compile(r'[(\[{]-?\d+,\s*-?\d+[,)\]}]')
+
+COLORS = {
+    'white': (255, 255, 255), 'black': (0, 0, 0), 'grey': (128, 128, 128),
+    'gray': (128, 128, 128), 'red': (255, 0, 0), 'green': (0, 255, 0),
+    'blue': (0, 0, 255), 'yellow': (255, 255, 0), 'orange': (255, 165, 0),
+    'purple': (128, 0, 128), 'pink': (255, 192, 203), 'cyan': (0, 255, 255),
+    'magenta': (255, 0, 255), 'brown': (139, 69, 19),
+}
+
+
+def colors_command(command):
+    """
+    Handler of the !colors chat command, see commands.py.
+    :return: the colors pixel commands take
+    """
+    return 'Colors: %s or #rrggbb' % ', '.join(COLORS)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_color(color, default=(255, 255, 255)):
+    """
+    :param color: '#rrggbb', a name from COLORS or None
+    :return: (r, g, b) tuple, default for None or unknown names
+    """
+    if not color:
+        return default
+    if color[0] == '#':
+        return (int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16))
+    return COLORS.get(color.lower(), default)
+
+
+def stamp(canvas, sprite, x, y):
+    """
+    Copy a sprite into the canvas with its top left corner at (x, y),
+    clipped to the canvas. Transparent pixels are left alone.
+    :param sprite: (rgb, mask) arrays indexed [x][y], see EmotePack
+    :return: (xs, ys) of the pixels written, relative to (x0, y0), and
+        the (x0, y0, x1, y1) box covered; None when nothing is inside
+    """
+    rgb, mask = sprite
+    width, height = canvas.shape[:2]
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + mask.shape[0], width), min(y + mask.shape[1], height)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    region = (slice(x0 - x, x1 - x), slice(y0 - y, y1 - y))
+    mask = mask[region]
+    block = canvas[x0:x1, y0:y1]
+    np.copyto(block, rgb[region], where=mask[..., None])
+    if not isinstance(canvas, np.ndarray):
+        # a TiledCanvas hands out copies
+        canvas[x0:x1, y0:y1] = block
+    return np.nonzero(mask), (x0, y0, x1, y1)
+
+
+def rectangle(canvas, x0, y0, x1, y1, color, outline=False):
+    """
+    Fill the rectangle between two corners (both inclusive, in any
+    order), or draw only its outline, clipped to the canvas.
+    :return: (xs, ys) of the pixels written and the (x0, y0, x1, y1)
+        box covered; None when nothing is inside
+    """
+    x0, x1 = sorted((x0, x1))
+    y0, y1 = sorted((y0, y1))
+    width, height = canvas.shape[:2]
+    cx0, cy0 = max(x0, 0), max(y0, 0)
+    cx1, cy1 = min(x1 + 1, width), min(y1 + 1, height)
+    if cx0 >= cx1 or cy0 >= cy1:
+        return None
+    if outline:
+        mask = np.zeros((cx1 - cx0, cy1 - cy0), bool)
+        # only the sides that are inside the canvas
+        mask[0] |= x0 == cx0
+        mask[-1] |= x1 == cx1 - 1
+        mask[:, 0] |= y0 == cy0
+        mask[:, -1] |= y1 == cy1 - 1
+        xs, ys = np.nonzero(mask)
+        if not len(xs):
+            return None
+        xs += cx0
+        ys += cy0
+        canvas[xs, ys] = color
+    else:
+        canvas[cx0:cx1, cy0:cy1] = color
+        xs, ys = np.indices((cx1 - cx0, cy1 - cy0)).reshape(2, -1)
+        xs += cx0
+        ys += cy0
+    return (xs, ys), (cx0, cy0, cx1, cy1)
+
+
+def line(canvas, x0, y0, x1, y1, color):
+    """
+    Draw a Bresenham line from (x0, y0) to (x1, y1), both inclusive,
+    clipped to the canvas: one pixel per step along the longer axis,
+    the other coordinate rounded.
+    :return: (xs, ys) of the pixels written and the (x0, y0, x1, y1)
+        box covered; None when nothing is inside, or when an endpoint is
+        further from the canvas than its size (which keeps the arrays
+        small and within int64)
+    """
+    width, height = canvas.shape[:2]
+    if not (-width <= min(x0, x1) and max(x0, x1) < 2 * width
+            and -height <= min(y0, y1) and max(y0, y1) < 2 * height):
+        return None
+    dx, dy = x1 - x0, y1 - y0
+    n = max(abs(dx), abs(dy))
+    steps = np.arange(n + 1)
+    # (2 t |d| + n) // 2n is t |d| / n rounded half up, exactly
+    n = max(n, 1)
+    xs = x0 + np.sign(dx) * ((2 * steps * abs(dx) + n) // (2 * n))
+    ys = y0 + np.sign(dy) * ((2 * steps * abs(dy) + n) // (2 * n))
+    ok = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    if not ok.all():
+        xs, ys = xs[ok], ys[ok]
+        if not len(xs):
+            return None
+    canvas[xs, ys] = color
+    return (xs, ys), (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+
+
+def _connected(mask, x, y):
+    """
+    The part of a boolean [x][y] mask that is connected to (x, y) by
+    4-neighbours, found a run along y (contiguous in memory) at a time:
+    each run is filled with one slice, and seeds the runs next to it in
+    the neighbouring columns.
+    """
+    free = mask.copy()
+    seeds = [(x, y)]
+    while seeds:
+        x, y = seeds.pop()
+        column = free[x]
+        if not column[y]:
+            continue
+        # extend the run through y in both directions
+        up = column[y::-1]
+        k = int(up.argmin())
+        start = y + 1 - (k if not up[k] else len(up))
+        down = column[y:]
+        k = int(down.argmin())
+        end = y + (k if not down[k] else len(down))
+        column[start:end] = False
+        for nx in (x - 1, x + 1):
+            if 0 <= nx < len(free):
+                run = free[nx, start:end]
+                starts = run.copy()
+                starts[1:] &= ~run[:-1]
+                seeds.extend((nx, start + int(s)) for s in np.flatnonzero(starts))
+    return mask & ~free
+
+
+def flood_fill(canvas, x, y, color, radius):
+    """
+    Paint the area of the color at (x, y) that is connected to it, as
+    far as it lies within radius pixels (a square) of (x, y).
+    :return: (xs, ys) of the pixels written and the (x0, y0, x1, y1)
+        box covered; None when (x, y) is outside the canvas
+    """
+    width, height = canvas.shape[:2]
+    if not (0 <= x < width and 0 <= y < height):
+        return None
+    x0, y0 = max(x - radius, 0), max(y - radius, 0)
+    x1, y1 = min(x + radius + 1, width), min(y + radius + 1, height)
+    block = canvas[x0:x1, y0:y1]
+    target = block[x - x0, y - y0]
+    if (target == color).all():
+        return (np.empty(0, np.int64), np.empty(0, np.int64)), (x, y, x + 1, y + 1)
+    region = _connected((block == target).all(axis=2), x - x0, y - y0)
+    xs, ys = np.nonzero(region)
+    xs += x0
+    ys += y0
+    canvas[xs, ys] = color
+    return (xs, ys), (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+
+
+class PixelBatch(object):
+    """
+    Collects the pixel commands of one receive cycle, e.g. "(x,y)" or
+    "(x,y,#ff0000)" / "[x,y,red]" anywhere in a chat message, and applies
+    them to an RGB uint8 canvas with a single fancy-indexed assignment.
+    Commands outside the canvas are rejected, and when a batch sets the
+    same pixel more than once the last command wins.
+    With an emote pack, a message that contains an emote stamps the
+    emote's sprite at each of its coordinates instead; paint=False
+    leaves out messages without an emote.
+    Shape commands draw many pixels at once: "rect(x0,y0,x1,y1,color)"
+    fills a rectangle, "box(...)" draws its outline, "line(...)" a line
+    and "fill(x,y,color)" flood fills the area around a pixel. Each is
+    one slice or mask operation on the canvas, and they are bounded by
+    MAX_SHAPE so that one message cannot repaint the whole board.
+    :param max_commands: bound on the queued commands. Past it, writes
+        to the same pixel are coalesced (only the last one matters) and,
+        when that is not enough, the oldest commands are dropped, so a
+        flood cannot make one frame arbitrarily slow. None for no bound.
+        Stamps and shapes are bounded to max_commands / STAMP_COST the
+        same way.
+    :param limiter: a ratelimit.UserRateLimiter that has to allow a
+        message before its commands are queued, None to accept all
+    :param emotes: an emotes.EmotePack, None to only paint pixels
+    """
+
+    # roughly what a 28x28 stamp costs compared to a pixel command
+    STAMP_COST = 64
+    # longest side of a rectangle or line; fills reach half of it
+    # around their pixel
+    MAX_SHAPE = 128
+
+    def __init__(self, max_commands=None, limiter=None, emotes=None):
+        self.max_commands = max_commands
+        self.limiter = limiter
+        self.emotes = emotes
+        self.paint = True
+        self.xs = []
+        self.ys = []
+        self.colors = []
+        self.stamps = []  # (x, y, sprite)
+        self.shapes = []  # (kind, x0, y0, x1, y1, color)
+
+    def __len__(self):
+        return len(self.xs) + len(self.stamps) + len(self.shapes)
+
+    def add(self, x, y, color=(255, 255, 255)):
+        self.xs.append(x)
+        self.ys.append(y)
+        self.colors.append(color)
+
+    def add_message(self, message, username=None, emotes=None):
+        """
+        Queue every pixel command (or emote stamp) and shape command
+        found in a chat message.
+        :param username: who sent it, for the limiter
+        :param emotes: ChatMessage.emotes of the message, if known
+        :return: number of commands queued
+        """
+        commands = PIXEL_COMMAND.findall(message)
+        shapes = ()
+        # the keywords are cheaper to look for than the regex
+        if self.paint and ('rect' in message or 'box' in message
+                           or 'line' in message or 'fill' in message):
+            shapes = self._shapes(message)
+            if shapes:
+                # fill(x,y,color) also reads as a pixel command
+                commands = PIXEL_COMMAND.findall(SHAPE_COMMAND.sub(' ', message))
+        if not commands and not shapes:
+            return 0
+        sprite = None
+        if commands and self.emotes is not None:
+            sprite = self.emotes.find(message, emotes)
+        if sprite is None and not self.paint:
+            return 0
+        count = len(commands) + len(shapes)
+        if self.limiter is not None and not self.limiter.allow(username, message, count):
+            return 0
+        for kind, x0, y0, x1, y1, color in shapes:
+            self.shapes.append((kind, x0, y0, x1, y1, parse_color(color)))
+        if sprite is not None:
+            for x, y, _ in commands:
+                self.stamps.append((int(x), int(y), sprite))
+        else:
+            for x, y, color in commands:
+                self.xs.append(x)
+                self.ys.append(y)
+                self.colors.append(parse_color(color))
+        if self.max_commands is not None and (
+                len(self.xs) > self.max_commands
+                or (len(self.stamps) + len(self.shapes)) * self.STAMP_COST
+                > self.max_commands):
+            self.shed()
+        return count
+
+    def _shapes(self, message):
+        """
+        :return: the valid shape commands of a message as (kind, x0, y0,
+            x1, y1, color) with int coordinates; rectangles and lines
+            longer than MAX_SHAPE are left out
+        """
+        shapes = []
+        for kind, x0, y0, x1, y1, color in SHAPE_COMMAND.findall(message):
+            if (kind == 'fill') != (not x1):
+                continue
+            x0, y0, x1, y1 = int(x0), int(y0), int(x1 or 0), int(y1 or 0)
+            if kind != 'fill' and (abs(x1 - x0) >= self.MAX_SHAPE
+                                   or abs(y1 - y0) >= self.MAX_SHAPE):
+                continue
+            shapes.append((kind, x0, y0, x1, y1, color))
+        return shapes
+
+    def shed(self):
+        """
+        Coalesce writes to the same pixel, then drop the oldest commands
+        until a quarter of max_commands is free again (so this runs once
+        per max_commands / 4 new commands, not for each of them).
+        """
+        n = len(self.xs)
+        # ordered by the last write to each pixel, oldest first
+        latest = {}
+        for key, color in zip(zip(self.xs, self.ys), self.colors):
+            latest.pop(key, None)
+            latest[key] = color
+        PIXELS_COALESCED.inc(n - len(latest))
+        keys = list(latest)
+        target = self.max_commands * 3 // 4
+        if len(keys) > target:
+            PIXELS_SHED.inc(len(keys) - target)
+            keys = keys[len(keys) - target:]
+        self.xs = [x for x, _ in keys]
+        self.ys = [y for _, y in keys]
+        self.colors = [latest[key] for key in keys]
+        # the same for stamps: only the last one at a position matters
+        latest = {}
+        for x, y, sprite in self.stamps:
+            latest.pop((x, y), None)
+            latest[x, y] = sprite
+        PIXELS_COALESCED.inc(len(self.stamps) - len(latest))
+        stamps = [(x, y, sprite) for (x, y), sprite in latest.items()]
+        target = target // self.STAMP_COST
+        if len(stamps) > target:
+            PIXELS_SHED.inc(len(stamps) - target)
+            stamps = stamps[len(stamps) - target:]
+        self.stamps = stamps
+        # shapes build on each other (a fill depends on what is below
+        # it), so they are only ever dropped, the oldest first
+        if len(self.shapes) > target:
+            PIXELS_SHED.inc(len(self.shapes) - target)
+            self.shapes = self.shapes[len(self.shapes) - target:]
+
+    def clear(self):
+        self.xs = []
+        self.ys = []
+        self.colors = []
+        self.stamps = []
+        self.shapes = []
+
+    def apply(self, canvas, journal=None):
+        """
+        Write all queued commands into the canvas and empty the batch.
+        Shapes go on top of the pixels of the same batch, in the order
+        they came in, and stamps on top of both.
+        :param canvas: uint8 array indexed [x][y][rgb]
+        :param journal: optional object whose append(xs, ys, colors) is
+            called with the pixels written, e.g. a CanvasStore
+        :return: (applied, rejected, box) where box is the (x0, y0, x1, y1)
+            bounding box of the changed pixels, or None
+        """
+        stamps = self.stamps
+        shapes = self.shapes
+        try:
+            applied, rejected, box = self._apply_pixels(canvas, journal)
+        finally:
+            # a batch that fails is dropped rather than failing every frame
+            self.clear()
+        boxes = [box] if box is not None else []
+        for shape in shapes:
+            written = self._draw(canvas, *shape)
+            if written is None:
+                PIXELS_REJECTED.inc()
+                rejected += 1
+                continue
+            (xs, ys), area = written
+            SHAPES_DRAWN.inc()
+            applied += len(xs)
+            if journal is not None and len(xs):
+                journal.append(xs, ys, np.broadcast_to(
+                    np.array(shape[-1], np.uint8), (len(xs), 3)))
+            boxes.append(area)
+        for x, y, sprite in stamps:
+            written = stamp(canvas, sprite, x, y)
+            if written is None:
+                PIXELS_REJECTED.inc()
+                rejected += 1
+                continue
+            (xs, ys), area = written
+            EMOTES_STAMPED.inc()
+            applied += len(xs)
+            if journal is not None and len(xs):
+                xs += area[0]
+                ys += area[1]
+                journal.append(xs, ys, canvas[xs, ys])
+            boxes.append(area)
+        if len(boxes) > 1:
+            x0s, y0s, x1s, y1s = zip(*boxes)
+            box = (min(x0s), min(y0s), max(x1s), max(y1s))
+        elif boxes:
+            box = boxes[0]
+        return applied, rejected, box
+
+    def _draw(self, canvas, kind, x0, y0, x1, y1, color):
+        """
+        Draw one queued shape.
+        :return: see rectangle; None when it is rejected
+        """
+        if kind == 'fill':
+            return flood_fill(canvas, x0, y0, color, self.MAX_SHAPE // 2)
+        if kind == 'line':
+            return line(canvas, x0, y0, x1, y1, color)
+        return rectangle(canvas, x0, y0, x1, y1, color, outline=kind == 'box')
+
+    def _apply_pixels(self, canvas, journal):
+        if not self.xs:
+            return 0, 0, None
+        # the numbers are still strings from the regex, convert them in C
+        xs = np.array(self.xs).astype(np.int64)
+        ys = np.array(self.ys).astype(np.int64)
+        colors = np.array(self.colors, np.uint8)
+        width, height = canvas.shape[:2]
+        ok = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        rejected = len(ok) - int(np.count_nonzero(ok))
+        PIXELS_REJECTED.inc(rejected)
+        if rejected:
+            xs, ys, colors = xs[ok], ys[ok], colors[ok]
+        if len(xs) == 0:
+            return 0, rejected, None
+        # numpy does not define which duplicate wins, keep the last one
+        flat = xs * height + ys
+        _, last = np.unique(flat[::-1], return_index=True)
+        if len(last) < len(flat):
+            keep = len(flat) - 1 - last
+            xs, ys, colors = xs[keep], ys[keep], colors[keep]
+        canvas[xs, ys] = colors
+        PIXELS_APPLIED.inc(len(xs))
+        if journal is not None:
+            journal.append(xs, ys, colors)
+        box = (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+        return len(xs), rejected, box
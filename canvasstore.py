@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Crash-safe canvas persistence. A store is a directory holding
+
+    canvas.bin   the canvas itself, memory-mapped, uint8 [x][y][rgb]
+                 (tiles.bin for a tiled store, the tiles of a
+                 tiles.TiledCanvas one after the other; the file is
+                 sparse, so tiles that were never painted take no space,
+                 and tiles.alloc marks the tiles that were, one byte per
+                 tile [tx][ty], so reads skip the others)
+    meta.json    size of the canvas and the name of the current log
+    pixels.N.log append-only log of every pixel applied since the last
+                 snapshot, fixed size binary records
+
+The live canvas is the memory map, so painting writes straight into the
+page cache and a crashed process loses nothing. The log covers a crashed
+machine: each batch of applied pixels is appended to it with one
+sequential write. A snapshot flushes the memory map to disk and starts
+a new, empty log (compaction), so the log never grows beyond what was
+painted since the last snapshot. Opening a store maps canvas.bin and
+replays the current log over it; replaying is idempotent, so a map that
+is already newer than the log is harmless. tiles.alloc is flushed with
+the map, and the replay marks again any tile painted since.
+"""
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from tiles import TiledCanvas
+
+log = logging.getLogger(__name__)
+
+RECORD = np.dtype([('x', '<u4'), ('y', '<u4'), ('rgb', 'u1', 3)])
+
+
+class CanvasStore(object):
+    """
+    A canvas backed by a directory, see the module docstring.
+    :param path: the directory, created when missing
+    :param width: canvas width, must match an existing store
+    :param height: canvas height, must match an existing store
+    :param snapshot_interval: seconds between snapshots
+    :param max_log_bytes: take a snapshot early when the log gets larger
+    :param fsync_interval: seconds between fsyncs of the log, 0 to fsync
+        every append, None to leave it to the OS
+    :param tile: keep the canvas as a TiledCanvas with tiles of this
+        size, for boards too large to hold as one array. Only used when
+        the store is created, an existing store keeps its layout
+    """
+
+    def __init__(self, path, width, height, snapshot_interval=60,
+                 max_log_bytes=64 << 20, fsync_interval=1., tile=None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.snapshot_interval = snapshot_interval
+        self.max_log_bytes = max_log_bytes
+        self.fsync_interval = fsync_interval
+        os.makedirs(path, exist_ok=True)
+        meta = self._read_meta()
+        if meta is None:
+            self.tile = tile
+            meta = self._meta(0)
+            self.array = self._map('w+')
+            self.array.flush()
+            self._write_meta(meta)
+        else:
+            if (meta['width'], meta['height']) != (width, height):
+                raise ValueError('%s holds a %dx%d canvas, not %dx%d' % (
+                    path, meta['width'], meta['height'], width, height))
+            self.tile = meta.get('tile')
+            self.array = self._map('r+')
+        self.generation = meta['log']
+        replayed = self._replay(self._log_name(self.generation))
+        if replayed:
+            log.info('%s: replayed %d pixels', path, replayed)
+        self.log = open(self._file(self._log_name(self.generation)), 'ab')
+        self.log_bytes = self.log.tell()
+        self.last_snapshot = self.last_fsync = time.monotonic()
+
+    def _map(self, mode):
+        if self.tile is None:
+            return np.memmap(self._file('canvas.bin'), np.uint8, mode,
+                             shape=(self.width, self.height, 3))
+        tiles_x = -(-self.width // self.tile)
+        tiles_y = -(-self.height // self.tile)
+        pool = np.memmap(self._file('tiles.bin'), np.uint8, mode,
+                         shape=(tiles_x * tiles_y, self.tile, self.tile, 3))
+        if mode == 'r+' and not os.path.exists(self._file('tiles.alloc')):
+            # a store from before tiles.alloc: a tile that is all black
+            # reads the same whether it is marked or not
+            written = pool.reshape(tiles_x, tiles_y, -1).any(axis=2)
+            mode = 'w+'
+        else:
+            written = None
+        alloc = np.memmap(self._file('tiles.alloc'), np.uint8, mode,
+                          shape=(tiles_x, tiles_y))
+        if written is not None:
+            alloc[:] = written
+        return TiledCanvas(self.width, self.height, self.tile, pool, alloc)
+
+    def _meta(self, generation):
+        meta = {'width': self.width, 'height': self.height, 'log': generation}
+        if self.tile is not None:
+            meta['tile'] = self.tile
+        return meta
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    @staticmethod
+    def _log_name(generation):
+        return 'pixels.%d.log' % generation
+
+    def _read_meta(self):
+        try:
+            with open(self._file('meta.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _write_meta(self, meta):
+        tmp = self._file('meta.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._file('meta.json'))
+
+    def _replay(self, name):
+        try:
+            records = np.fromfile(self._file(name), RECORD)
+        except FileNotFoundError:
+            return 0
+        # a torn record at the end of a log is simply not read
+        if len(records):
+            self.array[records['x'], records['y']] = records['rgb']
+        return len(records)
+
+    def append(self, xs, ys, colors):
+        """
+        Log pixels that were just written to the canvas, in order.
+        Called by PixelBatch.apply when the store is passed as journal.
+        """
+        records = np.empty(len(xs), RECORD)
+        records['x'] = xs
+        records['y'] = ys
+        records['rgb'] = colors
+        data = records.tobytes()
+        self.log.write(data)
+        self.log.flush()
+        self.log_bytes += len(data)
+        now = time.monotonic()
+        if self.fsync_interval is not None and now - self.last_fsync >= self.fsync_interval:
+            os.fsync(self.log.fileno())
+            self.last_fsync = now
+        if (self.log_bytes >= self.max_log_bytes
+                or now - self.last_snapshot >= self.snapshot_interval):
+            self.snapshot()
+
+    def snapshot(self):
+        """
+        Flush the canvas to disk and continue with an empty log.
+        """
+        self.array.flush()
+        old = self._log_name(self.generation)
+        self.generation += 1
+        new_log = open(self._file(self._log_name(self.generation)), 'wb')
+        # from here on a restart replays the new (empty) log only
+        self._write_meta(self._meta(self.generation))
+        self.log.close()
+        self.log = new_log
+        self.log_bytes = 0
+        os.remove(self._file(old))
+        self.last_snapshot = time.monotonic()
+
+    def close(self):
+        self.snapshot()
+        self.log.close()
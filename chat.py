@@ -0,0 +1,1106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Twitch chat client: line framing, IRC message handling, the outbound
+rate limiting and the (blocking and asyncio) chat streams.
+This module does not import any GUI or imaging packages, so scripts and
+the headless bot can use it on their own.
+Adapted from code with the following license:
+    
+Copyright (c) 2015 Jonas Degrave
+Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the "Software"), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions:
+The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import time
+import logging
+import socket
+try: # Mac user
+    import fcntl
+except: # Windows user, they'll use socket instead
+    pass
+import os
+import errno
+import random
+import threading
+from collections import deque
+import asyncio
+from ircv3 import parse_line
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+RECV_BYTES = REGISTRY.counter('twitch_recv_bytes_total', 'Bytes received from the chat servers')
+RECV_LINES = REGISTRY.counter('twitch_recv_lines_total', 'IRC lines received')
+PARSE_SECONDS = REGISTRY.histogram('twitch_parse_seconds', 'Time to parse the lines of one read')
+OUTBOUND_DEPTH = REGISTRY.gauge('twitch_outbound_queue_depth', 'Lines waiting for the rate limits')
+RECONNECTS = REGISTRY.counter('twitch_reconnects_total', 'Connections re-established after being lost')
+OUTBOUND_WAIT = REGISTRY.histogram('twitch_outbound_wait_seconds', 'Time lines spent in the outbound queue', buckets=(.001, .01, .1, .5, 1, 2.5, 5, 10, 30, 60))
+
+
+class LineFramer(object):
+    """
+    Reassembles CRLF terminated IRC lines from a byte stream.
+    Bytes are received straight into a preallocated bytearray with
+    recv_into, and only complete lines are decoded, so a line (or a
+    multi-byte UTF-8 character) cut between two reads is kept until the
+    rest of it arrives.
+    :param size: initial size of the receive buffer in bytes, it grows
+        only when a single line does not fit
+    :type size: int
+    """
+
+    def __init__(self, size=65536):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.end = 0
+
+    def clear(self):
+        """
+        Forget any partial line, e.g. after reconnecting.
+        """
+        self.end = 0
+
+    def _resize(self, size):
+        buf = bytearray(size)
+        buf[:self.end] = self.view[:self.end]
+        self.view.release()
+        self.buf = buf
+        self.view = memoryview(buf)
+
+    def recv_from(self, s):
+        """
+        Receive whatever is available on the socket into the buffer.
+        :param s: the socket to read from
+        :return: number of bytes received, 0 when the peer closed
+        """
+        if self.end == len(self.buf):
+            # a single line longer than the buffer
+            self._resize(2 * len(self.buf))
+        n = s.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def feed(self, data):
+        """
+        Append bytes that were read elsewhere.
+        :param data: bytes to add to the buffer
+        """
+        end = self.end + len(data)
+        if end > len(self.buf):
+            size = len(self.buf)
+            while size < end:
+                size *= 2
+            self._resize(size)
+        self.view[self.end:end] = data
+        self.end = end
+
+    def take(self):
+        """
+        Take everything left in the buffer, e.g. to hand the connection
+        over to another reader that feeds it to its own framer.
+        :return: the buffered bytes, usually a partial line
+        """
+        data = bytes(self.view[:self.end])
+        self.end = 0
+        return data
+
+    def pop_lines(self):
+        """
+        Take all complete lines out of the buffer.
+        :return: list of decoded lines, without the line terminator and
+            skipping empty lines
+        """
+        lines = []
+        buf, view, end = self.buf, self.view, self.end
+        start = 0
+        while True:
+            i = buf.find(b'\r\n', start, end)
+            if i < 0:
+                break
+            if i > start:
+                lines.append(str(view[start:i], 'utf-8', 'replace'))
+            start = i + 2
+        if start:
+            # move the partial line to the front of the buffer
+            view[:end - start] = view[start:end]
+            self.end = end - start
+        return lines
+
+
+class TokenBucket(object):
+    """
+    Rate limiter that allows short bursts. Tokens refill continuously,
+    every sent line takes one.
+    To stay within a Twitch limit of `limit` lines per `per` seconds in
+    *any* window of that length, capacity + rate * per must not exceed
+    the limit; TokenBucket.for_limit picks such a pair.
+    :param capacity: maximum number of tokens (the burst size)
+    :param rate: tokens added per second
+    """
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    @classmethod
+    def for_limit(cls, limit, per):
+        """
+        Bucket for a server limit of `limit` lines per `per` seconds:
+        half of it can be sent as a burst, the other half is refilled
+        evenly over the window.
+        """
+        burst = max(1, limit // 2)
+        return cls(burst, (limit - burst) / float(per))
+
+    def _refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def take(self, now):
+        """
+        :return: True and use up a token when one is available
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def wait_time(self, now):
+        """
+        :return: seconds until the next token is available
+        """
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.
+        return (1 - self.tokens) / self.rate
+
+
+class Backoff(object):
+    """
+    Jittered exponential backoff between reconnect attempts: attempt n
+    waits a random time between d/2 and d, d = min(cap, base * 2**n).
+    A short blip costs about a second, a long outage does not hammer the
+    server, and connections that dropped together do not retry in step.
+    :param base: upper bound of the first delay in seconds
+    :param cap: upper bound of any delay in seconds
+    """
+
+    def __init__(self, base=1., cap=60.):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def reset(self):
+        self.attempt = 0
+
+    def delay(self):
+        """
+        :return: seconds to wait before the next attempt
+        """
+        d = min(self.cap, self.base * 2 ** self.attempt)
+        self.attempt = min(self.attempt + 1, 32)
+        return random.uniform(d / 2, d)
+
+
+class OutboundScheduler(object):
+    """
+    Queue of lines for the IRC stream, released according to Twitch's
+    rate limits instead of one line every few seconds.
+    There are two lanes: PING, PONG, JOIN and PART go into the high
+    priority lane and are always released before chat. PING/PONG are
+    never limited,
+    JOIN/PART share the join bucket and PRIVMSG draws from the user
+    bucket, or from the moderator bucket for channels listed in
+    moderator_channels (names without #). Everything that is ready is
+    returned at once so the caller can send it with a single sendall.
+    :param user_limit: (lines, seconds) for chat messages
+    :param moderator_limit: (lines, seconds) for chat messages in
+        channels where the bot is a moderator or the broadcaster
+    :param join_limit: (JOINs, seconds) for JOIN and PART
+    """
+
+    def __init__(self, user_limit=(20, 30), moderator_limit=(100, 30),
+                 join_limit=(20, 10)):
+        self.user_bucket = TokenBucket.for_limit(*user_limit)
+        self.moderator_bucket = TokenBucket.for_limit(*moderator_limit)
+        self.join_bucket = TokenBucket.for_limit(*join_limit)
+        self.moderator_channels = set()
+        self.high = deque()
+        self.chat = deque()
+
+    def __len__(self):
+        return len(self.high) + len(self.chat)
+
+    def put(self, line):
+        """
+        Queue one line (without line terminator).
+        """
+        entry = (time.monotonic(), line)
+        if line.startswith(('PONG', 'PING', 'JOIN', 'PART', 'CAP')):
+            self.high.append(entry)
+        else:
+            self.chat.append(entry)
+        OUTBOUND_DEPTH.inc()
+
+    def _bucket_for(self, line):
+        if line.startswith('PRIVMSG'):
+            channel = line[9:line.find(' ', 9)]
+            if channel in self.moderator_channels:
+                return self.moderator_bucket
+            return self.user_bucket
+        if line.startswith(('JOIN', 'PART')):
+            return self.join_bucket
+        return None
+
+    def pop_ready(self, now=None):
+        """
+        Take every line that may be sent right now out of the queue.
+        :return: the lines joined and CRLF terminated as bytes, b'' when
+            nothing is ready
+        """
+        if now is None:
+            now = time.monotonic()
+        ready = []
+        if self.high:
+            waiting = deque()
+            for entry in self.high:
+                bucket = self._bucket_for(entry[1])
+                if bucket is None or bucket.take(now):
+                    ready.append(entry)
+                else:
+                    waiting.append(entry)
+            self.high = waiting
+        chat = self.chat
+        while chat:
+            bucket = self._bucket_for(chat[0][1])
+            if bucket is not None and not bucket.take(now):
+                break
+            ready.append(chat.popleft())
+        if not ready:
+            return b''
+        OUTBOUND_DEPTH.dec(len(ready))
+        for queued, line in ready:
+            OUTBOUND_WAIT.observe(now - queued)
+        return ('\r\n'.join(line for _, line in ready) + '\r\n').encode('utf-8')
+
+    def next_due(self, now=None):
+        """
+        :return: seconds until the next queued line can be sent (0 when
+            one is ready now), None when the queue is empty
+        """
+        if now is None:
+            now = time.monotonic()
+        lines = list(self.high)
+        if self.chat:
+            lines.append(self.chat[0])
+        if not lines:
+            return None
+        due = None
+        for _, line in lines:
+            bucket = self._bucket_for(line)
+            wait = 0. if bucket is None else bucket.wait_time(now)
+            if due is None or wait < due:
+                due = wait
+        return due
+
+
+class TwitchChatStream(object):
+    """
+    The TwitchChatStream is used for interfacing with the Twitch chat of
+    a channel. To use this, an oauth-account (of the user chatting)
+    should be created. At the moment of writing, this can be done here:
+    https://twitchapps.com/tmi/
+    :param username: Twitch username
+    :type username: string
+    :param oauth: oauth for logging in (see https://twitchapps.com/tmi/)
+    :type oauth: string
+    :param verbose: log all stream messages at DEBUG level
+    :type verbose: boolean
+    :param reconnect: reconnect (on a background thread) when the
+        connection is lost, joining every channel again
+    :type reconnect: boolean
+    """
+
+    # class attributes, so tests can point every stream at a local server
+    connect_host = "irc.twitch.tv"
+    connect_port = 6667
+    # seconds; Twitch sends a PING about every five minutes, a link that
+    # is silent for longer gets a PING of ours and is dropped when that
+    # goes unanswered
+    connect_timeout = 10
+    idle_timeout = 360
+    pong_timeout = 15
+    # connections that lived this long start over with short backoffs
+    stable_after = 60
+    # failed reconnects are warnings, every this many in a row an error
+    reconnect_error_after = 5
+
+    def __init__(self, username, oauth, verbose=False, reconnect=True):
+        """Create a new stream object, and try to connect."""
+        self.username = username
+        self.oauth = oauth
+        self.verbose = verbose
+        self.reconnect = reconnect
+        self.current_channel = ""
+        self.channels = set()
+        self.outbound = OutboundScheduler()
+        self.connected = False
+        self.s = None
+        self.framer = LineFramer()
+        self.backoff = Backoff()
+        self.connected_since = 0.
+        self.last_received = 0.
+        self._ping_sent_at = None
+        self._reconnecting = False
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.reconnect = False
+        if self.s is not None:
+            self.s.close()
+
+    @staticmethod
+    def _logged_in_successful(data):
+        """
+        Test the login status from the returned communication of the
+        server.
+        :param data: bytes received from server during login
+        :type data: list of bytes
+        :return boolean, True when you are logged in.
+        """
+        '''
+        if re.match(r'^:(testserver\.local|tmi\.twitch\.tv)'join(self
+                    r' NOTICE \* :'
+                    r'(Login unsuccessful|Error logging in)*$',
+                    data.strip()):
+            return False'''
+        if "Login authentication failed" in data or "Improperly formatted auth" in data:
+            return False
+        else:
+            return True
+
+    def connect(self):
+        """
+        Connect to Twitch and join every channel joined before, if any.
+        Blocks for up to connect_timeout seconds per step; after a lost
+        connection the stream reconnects by itself on a background
+        thread, see _connection_lost.
+        """
+
+        # Blocking (with a timeout) during the login only, the socket is
+        # made non-blocking once we are in
+
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(self.connect_timeout)
+        connect_host = self.connect_host
+        connect_port = self.connect_port
+        try:
+            s.connect((connect_host, connect_port))
+        except (Exception, IOError):
+            s.close()
+            log.warning("Unable to create a socket to %s:%s", connect_host, connect_port)
+            raise
+
+        try:
+            # Connected to twitch
+            # Sending our details to twitch...
+            s.sendall(('PASS %s\r\n' % self.oauth).encode('utf-8'))
+            s.sendall(('NICK %s\r\n' % self.username).encode('utf-8'))
+            s.sendall(b'CAP REQ :twitch.tv/tags\r\n')
+            if self.verbose:
+                log.debug('PASS %s', self.oauth)
+                log.debug('NICK %s', self.username)
+
+            data = s.recv(1024)
+        except (Exception, IOError):
+            s.close()
+            raise
+        received = data.decode('utf-8', 'replace')
+        if self.verbose:
+            log.debug(received)
+        if not TwitchChatStream._logged_in_successful(received):
+            # ... and they didn't accept our details
+            s.close()
+            self.connected=False
+            return #raise IOError("Twitch did not accept the username-oauth combination")
+        
+        else:
+            # ... and they accepted our details
+            # Connected to twitch.tv!
+            # now make this socket non-blocking on the OS-level (and drop
+            # the login timeout, which would make recv wait for data)
+            s.settimeout(None)
+            try: # Mac user
+                fcntl.fcntl(s,fcntl.F_SETFL,os.O_NONBLOCK)
+            except: # Windows user
+                s.setblocking(0)
+            # keep whatever followed the login reply for the next read
+            self.framer.clear()
+            self.framer.feed(data)
+            # JOINs go out ahead of any chat that is still queued
+            for channel in sorted(self.channels):
+                self.outbound.put('JOIN #%s' % channel)
+            old, self.s = self.s, s
+            if old is not None:
+                old.close()
+            self.connected_since = self.last_received = time.monotonic()
+            self._ping_sent_at = None
+            self.connected=True
+
+    def _connection_lost(self, reason):
+        """
+        Drop a dead connection and, unless reconnect is off, reconnect
+        on a background thread so the receiving thread never blocks on
+        DNS, connect or login. Queued lines are kept.
+        """
+        if not self.connected:
+            return
+        self.connected = False
+        log.warning("Connection lost (%s)", reason)
+        try:
+            self.s.close()
+        except OSError:
+            pass
+        if self.reconnect and not self._reconnecting:
+            self._reconnecting = True
+            threading.Thread(target=self._reconnect, name='twitch-reconnect',
+                             daemon=True).start()
+
+    def _reconnect(self):
+        if time.monotonic() - self.connected_since > self.stable_after:
+            self.backoff.reset()
+        failures = 0
+        try:
+            while self.reconnect:
+                delay = self.backoff.delay()
+                log.info("Reconnecting in %.1fs", delay)
+                time.sleep(delay)
+                try:
+                    self.connect()
+                except (Exception, IOError) as e:
+                    failures += 1
+                    self._log_reconnect_failure(failures, e)
+                    continue
+                if not self.connected:
+                    log.error("Twitch refused the login, not reconnecting")
+                    return
+                RECONNECTS.inc()
+                log.info("Reconnected, joining %d channels again", len(self.channels))
+                return
+        finally:
+            self._reconnecting = False
+
+    def _log_reconnect_failure(self, failures, error):
+        if failures % self.reconnect_error_after:
+            log.info("Reconnect failed: %s", error)
+        else:
+            log.error("Still not reconnected after %d attempts: %s", failures, error)
+
+    def _check_alive(self):
+        """
+        PING a connection that has been silent for idle_timeout seconds,
+        drop it when the PING is not answered within pong_timeout.
+        """
+        now = time.monotonic()
+        if self._ping_sent_at is not None:
+            if now - self._ping_sent_at > self.pong_timeout:
+                self._connection_lost("no reply to PING")
+        elif now - self.last_received > self.idle_timeout:
+            self._ping_sent_at = now
+            self._send("PING :tmi.twitch.tv")
+            self._push_from_buffer()
+
+
+    def _push_from_buffer(self):
+        """
+        Send every queued message the rate limits allow right now, in a
+        single write.
+        This is necessary to avoid Twitch overflow control.
+        """
+        if self.outbound and self.connected:
+            data = self.outbound.pop_ready()
+            if data:
+                try:
+                    self.s.sendall(data)
+                except OSError as e:
+                    # whatever was in this write may or may not have made it
+                    self._connection_lost(e)
+                    return
+                if self.verbose:
+                    log.debug(data.decode('utf-8'))
+
+    def _send(self, message):
+        """
+        Send a message to the IRC stream
+        :param message: the message to be sent.
+        :type message: string
+        """
+        if len(message) > 0:
+            self.outbound.put(message)
+
+    def _send_pong(self):
+        """
+        Send a pong message, usually in reply to a received ping message
+        """
+        self._send("PONG :tmi.twitch.tv")
+
+    def join_channel(self, channel):
+        """
+        Join a different chat channel on Twitch.
+        Note, this function returns immediately, but the switch might
+        take a moment
+        :param channel: name of the channel (without #)
+        """
+        self.channels.add(channel)
+        self._send('JOIN #%s' % channel)
+        self._push_from_buffer()
+
+    def send_chat_message(self, toChannel, message):
+        """
+        Send a chat message to the server.
+        :param message: String to send (don't use \\n)
+        :param toChannel: lowercase string of channel name to send message to
+        """
+        self._send("PRIVMSG #{0} :{1}".format(toChannel, message))
+
+    def _parse_message(self, data):
+        """
+        Parse one line received from the socket, answering pings and
+        keeping track of the joined channel on the way.
+        :param data: a decoded line received from the socket
+        :return: the ChatMessage when it is a chat message, None otherwise
+        """
+        msg = parse_line(data)
+        if msg is None:
+            return None
+        if msg.command == 'PRIVMSG':
+            if msg.channel and msg.message:
+                return msg
+        elif msg.command == 'PING':
+            self._send_pong()
+        elif msg.command == 'JOIN' and msg.channel:
+            self.current_channel = msg.channel[1:]
+        return None
+
+    def _parse_lines(self):
+        """
+        Parse all complete lines in the framer.
+        :return: list of the chat messages among them
+        """
+        start = time.perf_counter()
+        lines = self.framer.pop_lines()
+        result = []
+        for line in lines:
+            if self.verbose:
+                log.debug(line)
+            rec = self._parse_message(line)
+            if rec:
+                result.append(rec)
+        RECV_LINES.inc(len(lines))
+        PARSE_SECONDS.observe(time.perf_counter() - start)
+        return result
+
+    def twitch_receive_messages(self, max_messages=2000):
+        """
+        Call this function to process everything received by the socket
+        This needs to be called frequently enough (~10s) Twitch logs off
+        users not replying to ping commands.
+        :param max_messages: stop reading once this many chat messages
+            were received (reads are not split, so a few more may come);
+            the rest waits in the socket for the next call, which keeps
+            a flood from piling up unbounded work in one call
+        :return: list of chat messages received. Each message is a
+            ChatMessage, which also still supports message['channel'],
+            message['username'] and message['message']. Empty while
+            (re)connecting.
+        """
+        if not self.connected:
+            return []
+        self._push_from_buffer()
+        result = []
+        while self.connected and len(result) < max_messages:
+            # process the complete buffer, until no data is left no more
+            try:
+                n = self.framer.recv_from(self.s)     # NON-BLOCKING RECEIVE!
+            except socket.error as e:
+                err = e.args[0]
+                if err == errno.EAGAIN or err == errno.EWOULDBLOCK:
+                    # There is no more data available to read
+                    self._check_alive()
+                    return result
+                else:
+                    # a "real" error occurred, reconnect in the background
+                    self._connection_lost(e)
+                    return result
+            if n == 0:
+                self._connection_lost("closed by the server")
+                return result
+            self.last_received = time.monotonic()
+            self._ping_sent_at = None
+            RECV_BYTES.inc(n)
+            result.extend(self._parse_lines())
+            # answer pings right away instead of on the next call
+            self._push_from_buffer()
+        return result
+
+
+class AsyncTwitchChatStream(object):
+    """
+    asyncio counterpart of TwitchChatStream. Instead of polling a
+    non-blocking socket, lines are read from an asyncio StreamReader and
+    every chat message is yielded the moment its line arrives:
+
+        async with AsyncTwitchChatStream(NICK, PASS) as chat:
+            await chat.join_channel("somechannel")
+            async for message_info in chat:
+                ...
+
+    Outgoing lines go through an OutboundScheduler and are written by a
+    background task as soon as the rate limits allow, so they no longer
+    wait for the next receive call. One event loop can drive any number
+    of these streams.
+    A lost connection is reconnected inside receive_messages, with
+    backoff, and every joined channel is joined again; a connection
+    that stays silent is found by a watchdog task that PINGs it.
+    :param username: Twitch username
+    :type username: string
+    :param oauth: oauth for logging in (see https://twitchapps.com/tmi/)
+    :type oauth: string
+    :param verbose: log all stream messages at DEBUG level
+    :type verbose: boolean
+    :param reconnect: reconnect when the connection is lost instead of
+        ending the stream
+    :type reconnect: boolean
+    """
+
+    connect_host = "irc.twitch.tv"
+    connect_port = 6667
+    # see TwitchChatStream
+    connect_timeout = TwitchChatStream.connect_timeout
+    idle_timeout = TwitchChatStream.idle_timeout
+    pong_timeout = TwitchChatStream.pong_timeout
+    stable_after = TwitchChatStream.stable_after
+    reconnect_error_after = TwitchChatStream.reconnect_error_after
+
+    def __init__(self, username, oauth, verbose=False, reconnect=True):
+        self.username = username
+        self.oauth = oauth
+        self.verbose = verbose
+        self.reconnect = reconnect
+        self.current_channel = ""
+        self.channels = set()
+        self.outbound = OutboundScheduler()
+        self.connected = False
+        self.reader = None
+        self.writer = None
+        self.framer = LineFramer()
+        self.backoff = Backoff()
+        self.connected_since = 0.
+        self.last_received = 0.
+        self._closed = False
+        self._pending = deque()
+        self._wakeup = None
+        self._writer_task = None
+        self._watchdog_task = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self._pending:
+            rec = await self.receive_messages()
+            if rec is None:
+                raise StopAsyncIteration
+            self._pending.extend(rec)
+        return self._pending.popleft()
+
+    async def receive_messages(self):
+        """
+        Wait for data from the server and process all of it, so callers
+        can handle everything that arrived together as one batch.
+        :return: list of chat messages received (possibly empty), None
+            once the stream is closed, or the connection is lost and
+            reconnect is off or the login is refused
+        """
+        while True:
+            if self.reader is None:
+                return None
+            try:
+                data = await self.reader.read(65536)
+            except (ConnectionError, OSError) as e:
+                data = b''
+                reason = e
+            else:
+                reason = "closed by the server"
+            if data:
+                break
+            if (self._closed or not self.reconnect
+                    or not await self._reconnect(reason)):
+                return None
+        self.last_received = time.monotonic()
+        RECV_BYTES.inc(len(data))
+        self.framer.feed(data)
+        return self._parse_lines()
+
+    # PING/JOIN/PRIVMSG handling is identical for both streams
+    _parse_message = TwitchChatStream._parse_message
+    _parse_lines = TwitchChatStream._parse_lines
+
+    async def connect(self, sock=None):
+        """
+        Connect and log in to Twitch.
+        :param sock: an already logged in socket (e.g. TwitchChatStream.s)
+            to take over instead of opening a new connection; otherwise
+            every channel joined before is joined again
+        """
+        self._closed = False
+        if sock is not None:
+            sock.setblocking(False)
+            self.reader, self.writer = await asyncio.open_connection(sock=sock)
+            self.connected = True
+        else:
+            try:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(self.connect_host, self.connect_port),
+                    self.connect_timeout)
+            except (Exception, IOError):
+                log.warning("Unable to create a socket to %s:%s", self.connect_host, self.connect_port)
+                raise
+            try:
+                self.writer.write(('PASS %s\r\n' % self.oauth).encode('utf-8'))
+                self.writer.write(('NICK %s\r\n' % self.username).encode('utf-8'))
+                self.writer.write(b'CAP REQ :twitch.tv/tags\r\n')
+                await self.writer.drain()
+                received = (await asyncio.wait_for(
+                    self.reader.readline(), self.connect_timeout)).decode('utf-8', 'replace')
+            except (Exception, IOError):
+                self._disconnect()
+                raise
+            if self.verbose:
+                log.debug(received)
+            self.connected = TwitchChatStream._logged_in_successful(received)
+            if not self.connected:
+                self._disconnect()
+                return
+            self.framer.clear()
+            # JOINs go out ahead of any chat that is still queued
+            for channel in sorted(self.channels):
+                self.outbound.put('JOIN #%s' % channel)
+        self.connected_since = self.last_received = time.monotonic()
+        self._wakeup = asyncio.Event()
+        self._writer_task = asyncio.ensure_future(self._write_outbound())
+        self._watchdog_task = asyncio.ensure_future(self._watchdog())
+
+    def _disconnect(self):
+        """
+        Stop the background tasks and start closing the connection.
+        :return: the StreamWriter being closed, or None
+        """
+        for task in (self._writer_task, self._watchdog_task):
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        self._writer_task = self._watchdog_task = None
+        writer = self.writer
+        self.reader = self.writer = None
+        self.connected = False
+        if writer is not None:
+            writer.close()
+        return writer
+
+    async def close(self):
+        """
+        Stop the outbound writer and close the connection.
+        """
+        self._closed = True
+        writer = self._disconnect()
+        if writer is not None:
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def _reconnect(self, reason):
+        """
+        Reconnect after the connection was lost, waiting according to
+        self.backoff before every attempt. Queued lines are kept.
+        :return: True once logged in again, False when the login was
+            refused or the stream got closed in the meantime
+        """
+        log.warning("Connection lost (%s)", reason)
+        self._disconnect()
+        if time.monotonic() - self.connected_since > self.stable_after:
+            self.backoff.reset()
+        failures = 0
+        while not self._closed:
+            delay = self.backoff.delay()
+            log.info("Reconnecting in %.1fs", delay)
+            await asyncio.sleep(delay)
+            if self._closed:
+                break
+            try:
+                await self.connect()
+            except (Exception, IOError) as e:
+                failures += 1
+                self._log_reconnect_failure(failures, e)
+                continue
+            if not self.connected:
+                log.error("Twitch refused the login, not reconnecting")
+                return False
+            RECONNECTS.inc()
+            log.info("Reconnected, joining %d channels again", len(self.channels))
+            return True
+        return False
+
+    _log_reconnect_failure = TwitchChatStream._log_reconnect_failure
+
+    async def _watchdog(self):
+        """
+        PING the server after idle_timeout seconds without data and drop
+        the connection when nothing arrives within pong_timeout, which
+        makes receive_messages reconnect.
+        """
+        while True:
+            idle = time.monotonic() - self.last_received
+            if idle < self.idle_timeout:
+                await asyncio.sleep(self.idle_timeout - idle)
+                continue
+            sent = time.monotonic()
+            self._send("PING :tmi.twitch.tv")
+            await asyncio.sleep(self.pong_timeout)
+            if self.last_received < sent:
+                log.warning("No reply to PING in %gs", self.pong_timeout)
+                self.writer.transport.abort()
+                return
+
+    async def _write_outbound(self):
+        """
+        Write queued lines as soon as the rate limits allow, sleeping
+        until either the next one is due or a new one is queued.
+        """
+        while True:
+            self._wakeup.clear()
+            data = self.outbound.pop_ready()
+            if data:
+                self.writer.write(data)
+                if self.verbose:
+                    log.debug(data.decode('utf-8'))
+                try:
+                    await self.writer.drain()
+                except (ConnectionError, OSError):
+                    # the reader sees the connection go and reconnects
+                    return
+            due = self.outbound.next_due()
+            if due is None:
+                await self._wakeup.wait()
+            elif due > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), due)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _send(self, message):
+        """
+        Queue a message for the IRC stream
+        :param message: the message to be sent.
+        :type message: string
+        """
+        if len(message) > 0:
+            self.outbound.put(message)
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    def _send_pong(self):
+        """
+        Send a pong message, it goes out ahead of any queued chat
+        """
+        self._send("PONG :tmi.twitch.tv")
+
+    async def join_channel(self, channel):
+        """
+        Join a different chat channel on Twitch.
+        Note, the switch is only visible in current_channel once the
+        server echoes the JOIN back.
+        :param channel: name of the channel (without #)
+        """
+        self.channels.add(channel)
+        self._send('JOIN #%s' % channel)
+
+    async def part_channel(self, channel):
+        """
+        Leave a chat channel.
+        :param channel: name of the channel (without #)
+        """
+        self.channels.discard(channel)
+        self._send('PART #%s' % channel)
+
+    def send_chat_message(self, toChannel, message):
+        """
+        Send a chat message to the server.
+        :param message: String to send (don't use \\n)
+        :param toChannel: lowercase string of channel name to send message to
+        """
+        self._send("PRIVMSG #{0} :{1}".format(toChannel, message))
+
+
+class ChatConnectionPool(object):
+    """
+    Reads the chat of many channels at once by spreading them over
+    several connections, at most channels_per_connection each, all
+    driven by one asyncio event loop. Every chat message is routed to the
+    handler registered for its channel:
+
+        pool = ChatConnectionPool(NICK, PASS)
+        for channel in channels:
+            await pool.join(channel, handler)
+        await pool.run()
+
+    The rate limits Twitch applies per account (chat and JOINs) are
+    shared by all connections of the pool.
+    :param username: Twitch username
+    :type username: string
+    :param oauth: oauth for logging in (see https://twitchapps.com/tmi/)
+    :type oauth: string
+    :param channels_per_connection: channels joined on one connection
+        before another one is opened
+    :type channels_per_connection: int
+    :param verbose: log all stream messages at DEBUG level
+    :type verbose: boolean
+    """
+
+    stream_class = AsyncTwitchChatStream
+
+    def __init__(self, username, oauth, channels_per_connection=50,
+                 verbose=False):
+        self.username = username
+        self.oauth = oauth
+        self.channels_per_connection = channels_per_connection
+        self.verbose = verbose
+        self.limits = OutboundScheduler()
+        self.connections = []
+        self.channels = {}      # stream -> set of channel names
+        self._handlers = {}     # '#channel' -> handler
+        self._owner = {}        # channel -> stream
+        self._readers = {}      # stream -> reader task
+
+    def __len__(self):
+        return len(self._owner)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    async def _open_connection(self):
+        stream = self.stream_class(self.username, self.oauth,
+                                   verbose=self.verbose)
+        # one account, one set of limits
+        stream.outbound.user_bucket = self.limits.user_bucket
+        stream.outbound.moderator_bucket = self.limits.moderator_bucket
+        stream.outbound.join_bucket = self.limits.join_bucket
+        stream.outbound.moderator_channels = self.limits.moderator_channels
+        await stream.connect()
+        if not stream.connected:
+            raise IOError("Twitch did not accept the username-oauth combination")
+        self.connections.append(stream)
+        self.channels[stream] = set()
+        self._readers[stream] = asyncio.ensure_future(self._read(stream))
+        return stream
+
+    async def join(self, channel, handler):
+        """
+        Join a channel on the first connection with room left, opening a
+        new connection when all are full. Joining a channel again only
+        replaces its handler.
+        :param channel: name of the channel (without #)
+        :param handler: called with every ChatMessage of the channel, may
+            be a coroutine function
+        """
+        channel = channel.lower()
+        self._handlers['#' + channel] = handler
+        if channel in self._owner:
+            return
+        for stream in self.connections:
+            if len(self.channels[stream]) < self.channels_per_connection:
+                break
+        else:
+            stream = await self._open_connection()
+        self.channels[stream].add(channel)
+        self._owner[channel] = stream
+        await stream.join_channel(channel)
+
+    async def part(self, channel):
+        """
+        Leave a channel and forget its handler.
+        :param channel: name of the channel (without #)
+        """
+        channel = channel.lower()
+        stream = self._owner.pop(channel, None)
+        self._handlers.pop('#' + channel, None)
+        if stream is not None:
+            self.channels[stream].discard(channel)
+            await stream.part_channel(channel)
+
+    def send_chat_message(self, toChannel, message):
+        """
+        Send a chat message on the connection that joined the channel.
+        :param message: String to send (don't use \\n)
+        :param toChannel: lowercase string of channel name to send message to
+        """
+        self._owner[toChannel].send_chat_message(toChannel, message)
+
+    async def _read(self, stream):
+        handlers = self._handlers
+        async for message_info in stream:
+            handler = handlers.get(message_info.channel)
+            if handler is not None:
+                # one failing message must not end the reader for every
+                # channel on this connection
+                try:
+                    result = handler(message_info)
+                    if asyncio.iscoroutine(result):
+                        await result
+                except Exception:
+                    log.exception("Handler for %s failed", message_info.channel)
+
+    async def run(self):
+        """
+        Dispatch messages until every connection is closed.
+        """
+        while self._readers:
+            done, _ = await asyncio.wait(
+                list(self._readers.values()),
+                return_when=asyncio.FIRST_COMPLETED)
+            for stream, task in list(self._readers.items()):
+                if task in done:
+                    del self._readers[stream]
+                    task.result()
+
+    async def close(self):
+        """
+        Close all connections.
+        """
+        for task in self._readers.values():
+            task.cancel()
+        self._readers.clear()
+        for stream in self.connections:
+            await stream.close()
+        self.connections = []
+        self.channels.clear()
+        self._owner.clear()
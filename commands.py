@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Chat commands ("!stats", "!canvas top", ...) registered by name and
+found for a message by walking a prefix trie over its first characters,
+so looking one up costs the length of the command, however many there
+are. Messages that start with no command go to the default handler (the
+painting). Every handler says where it runs:
+
+    inline   right away on the thread handling chat, for cheap ones
+    thread   in a thread pool, for handlers that wait (files, network)
+    process  in a process pool, for CPU-heavy ones; the handler must be
+             a module-level function and its result picklable
+
+A pooled handler has a bound on the calls running or waiting at once,
+past which new calls are dropped, and a timeout after which a call that
+has not started is skipped and the result of one that has is dropped,
+so a slow handler never holds up reading chat.
+
+    commands = CommandDispatcher(reply=pool.send_chat_message,
+                                 deliver=loop.call_soon_threadsafe)
+    commands.register('!stats', stats, mode='process', timeout=5)
+    commands.dispatch(message)
+
+A handler is called with a Command and returns None or text to reply
+with in the channel of the message. Every command starts with PREFIX,
+so chat can be filtered for commands before it reaches a dispatcher.
+"""
+import functools
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+COMMANDS_DISPATCHED = REGISTRY.counter('commands_dispatched_total', 'Chat commands handed to their handler')
+COMMANDS_DROPPED = REGISTRY.counter('commands_dropped_total', 'Chat commands dropped because their handler was busy')
+COMMANDS_TIMED_OUT = REGISTRY.counter('commands_timed_out_total', 'Chat commands whose handler did not finish in time')
+COMMANDS_FAILED = REGISTRY.counter('commands_failed_total', 'Chat commands whose handler raised')
+
+MODES = ('inline', 'thread', 'process')
+
+# what every command name starts with
+PREFIX = '!'
+
+# name: the registered command, args: the rest of the message after it
+Command = namedtuple('Command', 'name args channel username message')
+
+
+class _Route(object):
+    __slots__ = ('name', 'handler', 'mode', 'timeout', 'max_concurrent', 'pending')
+
+    def __init__(self, name, handler, mode, timeout, max_concurrent):
+        self.name = name
+        self.handler = handler
+        self.mode = mode
+        self.timeout = timeout
+        self.max_concurrent = max_concurrent
+        self.pending = 0
+
+
+def _call(handler, command, deadline):
+    # runs in the pool; a call that waited past its deadline is skipped
+    if deadline is not None and time.monotonic() > deadline:
+        raise TimeoutError('%s waited too long' % command.name)
+    return handler(command)
+
+
+class CommandDispatcher(object):
+    """
+    Routes chat messages to the command handlers registered for them,
+    see the module docstring.
+    :param default: called with every ChatMessage that starts with no
+        command, inline
+    :param reply: called as reply(channel, text) (channel without #)
+        with the text a handler returned
+    :param deliver: called as deliver(function, *args) to run reply for
+        pooled handlers, e.g. loop.call_soon_threadsafe to do so on the
+        event loop; by default reply runs on the pool's thread
+    :param threads: threads of the thread pool
+    :param processes: processes of the process pool, default one per
+        core
+    """
+
+    def __init__(self, default=None, reply=None, deliver=None, threads=4,
+                 processes=None):
+        self.default = default
+        self.reply = reply
+        self.deliver = deliver
+        self.threads = threads
+        self.processes = processes or os.cpu_count() or 1
+        # char -> node, a node's route under None
+        self.trie = {}
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, handler, mode='inline', timeout=None,
+                 max_concurrent=8):
+        """
+        Route messages starting with name (followed by a space, the end
+        of the message or punctuation) to handler. Registering a name
+        again replaces its handler.
+        :param mode: 'inline', 'thread' or 'process', see the module
+            docstring
+        :param timeout: seconds a pooled call may take from dispatch to
+            result, None for no limit
+        :param max_concurrent: pooled calls running or waiting at once
+        """
+        if mode not in MODES:
+            raise ValueError('mode %r is not one of %s' % (mode, ', '.join(MODES)))
+        if not name.startswith(PREFIX) or name == PREFIX:
+            raise ValueError('command %r does not start with %s' % (name, PREFIX))
+        node = self.trie
+        for char in name:
+            node = node.setdefault(char, {})
+        node[None] = _Route(name, handler, mode, timeout, max_concurrent)
+
+    def match(self, text):
+        """
+        :return: the name of the longest command text starts with, None
+            when it starts with none
+        """
+        route = self._match(text)
+        return route.name if route is not None else None
+
+    def _match(self, text):
+        node = self.trie
+        found = None
+        for char in text:
+            if None in node and not char.isalnum():
+                found = node[None]
+            node = node.get(char)
+            if node is None:
+                return found
+        return node.get(None, found)
+
+    def dispatch(self, message):
+        """
+        Hand a ChatMessage to the handler of its command, or to default.
+        Never waits for a pooled handler.
+        :return: the name of the command, None for default
+        """
+        text = message.message
+        route = self._match(text) if text[:1] in self.trie else None
+        if route is None:
+            if self.default is not None:
+                self.default(message)
+            return None
+        command = Command(route.name, text[len(route.name):].strip(),
+                          message.channel, message.username, text)
+        COMMANDS_DISPATCHED.inc()
+        if route.mode == 'inline':
+            try:
+                self._reply(command, route.handler(command))
+            except Exception:
+                COMMANDS_FAILED.inc()
+                log.exception("%s failed", route.name)
+            return route.name
+        with self.lock:
+            if route.pending >= route.max_concurrent:
+                COMMANDS_DROPPED.inc()
+                return route.name
+            route.pending += 1
+        deadline = None
+        if route.timeout is not None:
+            deadline = time.monotonic() + route.timeout
+        future = self._pool(route.mode).submit(_call, route.handler, command, deadline)
+        future.add_done_callback(functools.partial(self._done, route, command, deadline))
+        return route.name
+
+    def _pool(self, mode):
+        pool = self.pools.get(mode)
+        if pool is None:
+            if mode == 'thread':
+                pool = ThreadPoolExecutor(self.threads, thread_name_prefix='command')
+            else:
+                pool = ProcessPoolExecutor(self.processes)
+            self.pools[mode] = pool
+        return pool
+
+    def _done(self, route, command, deadline, future):
+        with self.lock:
+            route.pending -= 1
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except TimeoutError:
+            COMMANDS_TIMED_OUT.inc()
+            return
+        except Exception:
+            COMMANDS_FAILED.inc()
+            log.exception("%s failed", route.name)
+            return
+        if deadline is not None and time.monotonic() > deadline:
+            COMMANDS_TIMED_OUT.inc()
+            return
+        if self.deliver is not None and result is not None:
+            self.deliver(self._reply, command, result)
+        else:
+            self._reply(command, result)
+
+    def _reply(self, command, text):
+        if text is not None and self.reply is not None:
+            try:
+                self.reply(command.channel.lstrip('#'), text)
+            except Exception:
+                log.exception("could not reply to %s", command.name)
+
+    def close(self):
+        """
+        Stop the pools, dropping the calls that have not started.
+        """
+        for pool in self.pools.values():
+            pool.shutdown(wait=True, cancel_futures=True)
+        self.pools = {}
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Emote sprites for stamping onto the canvas. An emote pack is a directory
+of images named after the emote id (as in the IRCv3 emotes tag, e.g.
+25.png) or the emote text (Kappa.png), in any format PIL reads.
+
+Decoding and scaling an image is far slower than copying it, so each
+sprite is decoded once, scaled to the stamp size and kept as NumPy
+arrays in an LRU cache bounded in bytes; stamping a cached emote is one
+masked array copy (canvas.stamp).
+"""
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+SPRITE_HITS = REGISTRY.counter('emote_cache_hits_total', 'Sprites found in the emote cache')
+SPRITE_DECODES = REGISTRY.counter('emote_decodes_total', 'Emote images decoded')
+SPRITE_BYTES = REGISTRY.gauge('emote_cache_bytes', 'Bytes held by decoded sprites')
+
+
+class EmotePack(object):
+    """
+    The emotes in a directory, decoded on first use.
+    :param path: the directory; a missing directory is an empty pack
+    :param size: sprites are scaled to fit size x size pixels
+    :param max_bytes: bound on the decoded sprites kept in memory
+    """
+
+    def __init__(self, path, size=28, max_bytes=16 << 20):
+        self.path = path
+        self.size = size
+        self.max_bytes = max_bytes
+        self.files = {}
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                key, ext = os.path.splitext(name)
+                if ext:
+                    self.files[key] = os.path.join(path, name)
+        self.cache = OrderedDict()  # key -> (rgb, mask)
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, key):
+        return key in self.files
+
+    def _decode(self, key):
+        from PIL import Image # only needed when there are emotes to draw
+        with Image.open(self.files[key]) as image:
+            image = image.convert('RGBA')
+        image.thumbnail((self.size, self.size), Image.LANCZOS)
+        # [x][y] like the canvas, contiguous so stamps copy fast
+        rgba = np.ascontiguousarray(np.asarray(image).swapaxes(0, 1))
+        SPRITE_DECODES.inc()
+        return rgba[..., :3].copy(), rgba[..., 3] >= 128
+
+    def sprite(self, key):
+        """
+        :return: (rgb, mask) arrays indexed [x][y] for an emote id or
+            name, mask is True where the sprite is opaque; None when the
+            pack does not have it or it cannot be decoded
+        """
+        sprite = self.cache.get(key)
+        if sprite is not None:
+            self.cache.move_to_end(key)
+            SPRITE_HITS.inc()
+            return sprite
+        if key not in self.files:
+            return None
+        try:
+            sprite = self._decode(key)
+        except (OSError, ValueError) as e:
+            log.warning("Cannot decode emote %s: %s", self.files[key], e)
+            del self.files[key]
+            return None
+        self.cache[key] = sprite
+        self.bytes += sprite[0].nbytes + sprite[1].nbytes
+        while self.bytes > self.max_bytes and len(self.cache) > 1:
+            _, (rgb, mask) = self.cache.popitem(last=False)
+            self.bytes -= rgb.nbytes + mask.nbytes
+        SPRITE_BYTES.set(self.bytes)
+        return sprite
+
+    def find(self, message, emotes=None):
+        """
+        The first emote of a chat message that the pack has.
+        :param message: the text
+        :param emotes: ChatMessage.emotes of the message, emote ids and
+            their positions in the text
+        :return: (rgb, mask) as from sprite(), or None
+        """
+        if emotes:
+            first = sorted((positions[0], emote_id)
+                           for emote_id, positions in emotes.items() if positions)
+            for (start, end), emote_id in first:
+                for key in (emote_id, message[start:end + 1]):
+                    sprite = self.sprite(key)
+                    if sprite is not None:
+                        return sprite
+        for word in message.split():
+            if word in self.files:
+                sprite = self.sprite(word)
+                if sprite is not None:
+                    return sprite
+        return None
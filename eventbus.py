@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Hand-off of parsed chat messages from the network thread to the thread
+that renders them (the Tk main loop), so neither waits for the other.
+
+    bus = EventBus()
+    # network thread, once per receive cycle
+    bus.put_many(rec)
+    # Tk thread, from an after() callback
+    rec = bus.get_many(256)
+
+Only deque.extend and deque.popleft touch the shared state, both atomic
+in CPython, so there is no lock for a chat flood to contend on. The
+queue is bounded, so the time an event can spend in it is bounded too.
+Under load it degrades in steps: above high_water the bus reports itself
+overloaded (the GUI then skips redraws to drain faster), and only when
+that is not enough are events shed according to the policy:
+
+    drop-oldest  the oldest queued events make room for new ones
+    drop-newest  new events that do not fit are dropped
+    sample       half way between high_water and maxsize a shrinking
+                 share of new events is kept, none at maxsize
+
+The bus stays overloaded until it has drained to low_water.
+"""
+import logging
+import math
+from collections import deque
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+EVENTS_DEPTH = REGISTRY.gauge('eventbus_depth', 'Events waiting for the consumer thread')
+EVENTS_DROPPED = REGISTRY.counter('eventbus_dropped_total', 'Events shed because the bus was full')
+EVENTS_OVERLOADED = REGISTRY.gauge('eventbus_overloaded', '1 while the bus is above its high-water mark')
+
+POLICIES = ('drop-oldest', 'drop-newest', 'sample')
+
+
+class EventBus(object):
+    """
+    Bounded queue for one producer thread and one consumer thread.
+    :param maxsize: events held at most
+    :param policy: what to shed when full, see the module docstring
+    :param high_water: depth at which the bus becomes overloaded,
+        default maxsize / 4
+    :param low_water: depth at which it stops being overloaded, default
+        high_water / 4
+    """
+
+    def __init__(self, maxsize=20000, policy='drop-oldest', high_water=None,
+                 low_water=None):
+        if policy not in POLICIES:
+            raise ValueError('unknown policy %r, use one of %s' % (policy, ', '.join(POLICIES)))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.high_water = maxsize // 4 if high_water is None else high_water
+        self.low_water = self.high_water // 4 if low_water is None else low_water
+        self.overloaded = False
+        self.dropped = 0
+        # with maxlen the deque itself evicts the oldest, atomically
+        self.events = deque(maxlen=maxsize if policy == 'drop-oldest' else None)
+
+    def __len__(self):
+        return len(self.events)
+
+    def _shed(self, events, depth):
+        """
+        :return: the part of events to queue on top of depth events
+        """
+        if self.policy == 'drop-oldest':
+            return events
+        if self.policy == 'sample':
+            start = (self.high_water + self.maxsize) // 2
+            if depth > start:
+                keep = (self.maxsize - depth) / float(self.maxsize - start)
+                events = events[::int(math.ceil(1 / keep))] if keep > 0 else []
+        # the consumer only ever makes room, so checking first is safe
+        # with a single producer
+        return events[:max(self.maxsize - depth, 0)]
+
+    def put_many(self, events):
+        """
+        Queue a list of events, in order.
+        :return: number of events queued
+        """
+        depth = len(self.events)
+        queued = self._shed(events, depth)
+        self.events.extend(queued)
+        # drop-oldest queues everything and loses the overflow at the front
+        dropped = len(events) - len(queued) + max(depth + len(queued) - self.maxsize, 0)
+        if dropped:
+            self.dropped += dropped
+            EVENTS_DROPPED.inc(dropped)
+        depth = len(self.events)
+        EVENTS_DEPTH.set(depth)
+        if depth >= self.high_water and not self.overloaded:
+            self.overloaded = True
+            EVENTS_OVERLOADED.set(1)
+            log.warning("Event bus overloaded: %d events queued", depth)
+        return len(queued)
+
+    def put(self, event):
+        return self.put_many([event])
+
+    def get_many(self, n):
+        """
+        :return: list of up to n of the oldest events, empty when there
+            are none
+        """
+        popleft = self.events.popleft
+        result = []
+        try:
+            for _ in range(n):
+                result.append(popleft())
+        except IndexError:
+            pass
+        depth = len(self.events)
+        EVENTS_DEPTH.set(depth)
+        if self.overloaded and depth <= self.low_water:
+            self.overloaded = False
+            EVENTS_OVERLOADED.set(0)
+            log.info("Event bus recovered, %d events shed so far", self.dropped)
+        return result
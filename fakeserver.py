@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for irc.twitch.tv, speaking the subset of IRC the bot
+uses: PASS/NICK login (accepted or refused), CAP REQ, JOIN/PART echoes,
+PING/PONG and tagged PRIVMSGs. Chat is replayed from a recorded log (one
+raw IRC line per line) or generated, at a configurable rate and burst
+shape, to every client that joined the channel.
+
+    python fakeserver.py --port 6667 --rate 2000 --shape burst
+    python -m twitch --server 127.0.0.1:6667 --nick bot --oauth test --channel test
+
+Every PRIVMSG gets an 'id' tag with its sequence number and an
+'x-sent-ns' tag with time.time_ns() at the moment it is written, which
+bench_load.py uses to measure loss and end-to-end latency.
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import sys
+import time
+
+from ircv3 import parse_line
+
+HOST = 'tmi.twitch.tv'
+
+
+def schedule(shape, rate, duration, burst_factor=10., period=1.):
+    """
+    Send times (seconds from the start) for a traffic shape.
+    :param shape: 'constant' - evenly spaced at rate;
+        'burst' - rate on average, but all of it sent at burst_factor
+        times the rate at the start of every period;
+        'ramp' - rate growing linearly from 0 to 2 * rate
+    :param rate: average messages per second
+    :param duration: seconds of traffic
+    :return: iterator over send times
+    """
+    if shape == 'constant':
+        n = int(rate * duration)
+        return (i / float(rate) for i in range(n))
+    if shape == 'burst':
+        per_period = int(rate * period)
+        fast = rate * burst_factor
+        return (p * period + i / fast
+                for p in range(int(duration / period))
+                for i in range(per_period))
+    if shape == 'ramp':
+        # n(t) = rate * t^2 / duration, so t(n) = sqrt(n * duration / rate)
+        n = int(rate * duration)
+        return ((i * duration / float(rate)) ** .5 for i in range(n))
+    raise ValueError('unknown shape %r' % shape)
+
+
+def synthetic_chat(seed=0, width=500, height=500):
+    """
+    Endless (username, text) pairs of chat with pixel commands.
+    """
+    rnd = random.Random(seed)
+    words = ['Kappa', 'PogChamp', 'LUL', 'hello', 'gg', 'draw', 'here']
+    while True:
+        text = ' '.join(rnd.choice(words) for _ in range(rnd.randrange(1, 5)))
+        text += ' (%d,%d,#%06x)' % (rnd.randrange(width),
+                                    rnd.randrange(height),
+                                    rnd.randrange(1 << 24))
+        yield 'user%d' % rnd.randrange(10000), text
+
+
+def recorded_chat(path):
+    """
+    (username, text) pairs of the PRIVMSGs in a recorded log, repeated
+    forever.
+    """
+    chat = []
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            msg = parse_line(line.rstrip('\r\n'))
+            if msg is not None and msg.command == 'PRIVMSG' and msg.message:
+                chat.append((msg.username, msg.message))
+    if not chat:
+        raise ValueError('no PRIVMSG lines in %s' % path)
+    return itertools.cycle(chat)
+
+
+class FakeTwitchServer(object):
+    """
+    The fake server. Clients are served by start(); replay() then sends
+    chat to a channel.
+    :param oauth: the only oauth accepted, None to accept any
+    :param ping_interval: seconds between PINGs to each client, None for
+        no PINGs
+    """
+
+    def __init__(self, oauth=None, ping_interval=None):
+        self.oauth = oauth
+        self.ping_interval = ping_interval
+        self.server = None
+        self.port = None
+        self.clients = {}        # writer -> nick
+        self.members = {}        # '#channel' -> set of writers
+        self.sent = []           # text of every replayed message, by id
+        self.received = []       # raw lines received from clients
+        self.pongs = 0
+        self._handlers = set()
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self._serve, host, port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        self.server.close()
+        for writer in list(self.clients):
+            writer.close()
+        # let the handlers see EOF and finish on their own
+        await asyncio.gather(*self._handlers, return_exceptions=True)
+        await self.server.wait_closed()
+
+    def _write(self, writer, line):
+        writer.write((line + '\r\n').encode('utf-8'))
+
+    async def _ping(self, writer):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            self._write(writer, 'PING :%s' % HOST)
+
+    async def _serve(self, reader, writer):
+        nick = oauth = None
+        pinger = None
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8', 'replace').rstrip('\r\n')
+                self.received.append(line)
+                msg = parse_line(line)
+                if msg is None:
+                    continue
+                command = msg.command
+                if command == 'PASS':
+                    oauth = msg.params[0] if msg.params else ''
+                elif command == 'NICK':
+                    nick = msg.params[0].lower() if msg.params else ''
+                    if self.oauth is not None and oauth != self.oauth:
+                        self._write(writer, ':%s NOTICE * :Login authentication failed' % HOST)
+                        await writer.drain()
+                        break
+                    for n, text in (('001', 'Welcome, GLHF!'),
+                                    ('002', 'Your host is %s' % HOST),
+                                    ('003', 'This server is rather new'),
+                                    ('004', '-'), ('375', '-'),
+                                    ('372', 'You are in a maze of twisty passages.'),
+                                    ('376', '>')):
+                        self._write(writer, ':%s %s %s :%s' % (HOST, n, nick, text))
+                    self.clients[writer] = nick
+                    if self.ping_interval:
+                        pinger = asyncio.ensure_future(self._ping(writer))
+                elif nick not in self.clients.values():
+                    continue
+                elif command == 'CAP':
+                    self._write(writer, ':%s CAP * ACK :%s' % (HOST, msg.message))
+                elif command == 'JOIN':
+                    for channel in msg.params[0].lower().split(','):
+                        self.members.setdefault(channel, set()).add(writer)
+                        self._write(writer, ':%s!%s@%s.%s JOIN %s' % (nick, nick, nick, HOST, channel))
+                        self._write(writer, ':%s.%s 353 %s = %s :%s' % (nick, HOST, nick, channel, nick))
+                        self._write(writer, ':%s.%s 366 %s %s :End of /NAMES list' % (nick, HOST, nick, channel))
+                elif command == 'PART':
+                    channel = msg.params[0].lower()
+                    self.members.get(channel, set()).discard(writer)
+                    self._write(writer, ':%s!%s@%s.%s PART %s' % (nick, nick, nick, HOST, channel))
+                elif command == 'PING':
+                    self._write(writer, ':%s PONG %s :%s' % (HOST, HOST, msg.message or HOST))
+                elif command == 'PONG':
+                    self.pongs += 1
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            if pinger is not None:
+                pinger.cancel()
+            self._handlers.discard(asyncio.current_task())
+            self.clients.pop(writer, None)
+            for members in self.members.values():
+                members.discard(writer)
+            writer.close()
+
+    def privmsg_line(self, channel, username, text, seq):
+        now = time.time_ns()
+        return ('@badge-info=;badges=;color=#1E90FF;display-name=%s;emotes=;'
+                'id=%d;mod=0;room-id=1;subscriber=0;tmi-sent-ts=%d;turbo=0;'
+                'user-id=1;user-type=;x-sent-ns=%d :%s!%s@%s.%s PRIVMSG %s :%s'
+                % (username, seq, now // 1000000, now, username, username,
+                   username, HOST, channel, text))
+
+    async def wait_for_members(self, channel, count=1, timeout=10):
+        channel = '#' + channel.lower()
+        deadline = time.monotonic() + timeout
+        while len(self.members.get(channel, ())) < count:
+            if time.monotonic() > deadline:
+                raise TimeoutError('nobody joined %s' % channel)
+            await asyncio.sleep(.01)
+
+    async def replay(self, channel, chat, times):
+        """
+        Send chat to everyone in a channel.
+        :param channel: name of the channel (without #)
+        :param chat: iterator over (username, text) pairs
+        :param times: iterator over send times in seconds from now, see
+            schedule()
+        :return: number of messages sent
+        """
+        channel = '#' + channel.lower()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        times = iter(times)
+        pending = next(times, None)
+        count = 0
+        while pending is not None:
+            delay = start + pending - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # everything that is due goes out in one write per client
+            now = loop.time() - start
+            lines = []
+            while pending is not None and pending <= now:
+                username, text = next(chat)
+                lines.append(self.privmsg_line(channel, username, text, len(self.sent)))
+                self.sent.append(text)
+                pending = next(times, None)
+            data = ('\r\n'.join(lines) + '\r\n').encode('utf-8')
+            members = list(self.members.get(channel, ()))
+            for writer in members:
+                writer.write(data)
+            for writer in members:
+                try:
+                    await writer.drain()
+                except ConnectionError:
+                    pass
+            count += len(lines)
+        return count
+
+
+async def serve(args):
+    server = await FakeTwitchServer(args.oauth, args.ping_interval).start(args.host, args.port)
+    print('fake Twitch IRC server on %s:%d' % (args.host, server.port))
+    chat = recorded_chat(args.log) if args.log else synthetic_chat()
+    await server.wait_for_members(args.channel, timeout=float('inf'))
+    sent = await server.replay(args.channel, chat,
+                               schedule(args.shape, args.rate, args.duration))
+    print('sent %d messages' % sent)
+    await server.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fake Twitch IRC server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6667)
+    parser.add_argument('--oauth', help='only accept this oauth')
+    parser.add_argument('--channel', default='test')
+    parser.add_argument('--log', help='recorded chat to replay')
+    parser.add_argument('--rate', type=float, default=100, help='messages per second')
+    parser.add_argument('--shape', default='constant', choices=['constant', 'burst', 'ramp'])
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--ping-interval', type=float, default=None)
+    args = parser.parse_args(argv)
+    asyncio.run(serve(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,648 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tk interface of the bot. Only imported when running with a GUI
+(python -m twitch --gui), so the chat client and the headless bot do
+not need tkinter.
+"""
+import tkinter as tk
+import time
+import sys
+import os
+import threading
+import asyncio
+import logging
+import numpy as np
+from chat import TwitchChatStream, AsyncTwitchChatStream
+from canvas import PixelBatch, colors_command
+from canvasstore import CanvasStore
+from eventbus import EventBus
+from ratelimit import UserRateLimiter
+from emotes import EmotePack
+from archive import ChatArchive
+from timelapse import TimelapseRecorder
+from viewer import CanvasViewer
+from commands import CommandDispatcher
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+FRAME_SECONDS = REGISTRY.histogram('render_frame_seconds', 'Time to blit one frame into the PhotoImage')
+FRAMES_SKIPPED = REGISTRY.counter('render_frames_skipped_total', 'Redraws left out to catch up with chat')
+
+
+class CanvasRenderer(object):
+    """
+    Shows a viewport of a canvas in a Tk canvas through one persistent
+    PhotoImage the size of the widget, so drawing costs depend on the
+    window, not on the board. Drag to pan, use the mouse wheel to zoom
+    (by powers of two, from ZOOMS) and the arrow keys to move.
+    Changes are only marked with mark_dirty (which is safe from any
+    thread); at most fps times per second the part of everything marked
+    since the last frame that is in view is written into the PhotoImage
+    as a single PPM block, without touching the filesystem. Setting skip
+    to n > 0 redraws only every (n+1)th frame, which frees the Tk thread
+    for handling chat while it is behind.
+    :param canvas: the tk.Canvas to draw on
+    :param array: the canvas data, indexed [x][y], either grey values or
+        [x][y][rgb]; a NumPy array or a tiles.TiledCanvas
+    :param fps: maximum number of redraws per second
+    """
+
+    ZOOMS = (1/16., 1/8., 1/4., 1/2., 1, 2, 4, 8, 16)
+
+    def __init__(self, canvas, array, fps=30):
+        self.canvas = canvas
+        self.array = array
+        self.width, self.height = array.shape[:2]
+        self.interval = max(1, int(1000 / fps))
+        self.viewWidth = int(canvas['width'])
+        self.viewHeight = int(canvas['height'])
+        self.photo = tk.PhotoImage(master=canvas, width=self.viewWidth,
+                                   height=self.viewHeight)
+        self.item = canvas.create_image(0, 0, image=self.photo, anchor='nw')
+        # board pixel in the top left corner, and the zoom
+        self.x = self.y = 0
+        self.zoom = 1
+        self.lock = threading.Lock()
+        self.dirty = None
+        self.full = True
+        self.skip = 0
+        self._skipped = 0
+        self._after = None
+        self._drag = None
+        canvas.bind('<Configure>', self._resized)
+        canvas.bind('<ButtonPress-1>', self._startDrag)
+        canvas.bind('<B1-Motion>', self._dragged)
+        canvas.bind('<MouseWheel>', lambda e: self.zoomAt(e.x, e.y, 1 if e.delta > 0 else -1))
+        canvas.bind('<Button-4>', lambda e: self.zoomAt(e.x, e.y, 1))
+        canvas.bind('<Button-5>', lambda e: self.zoomAt(e.x, e.y, -1))
+        step = 50
+        for key, dx, dy in (('Left', -step, 0), ('Right', step, 0),
+                            ('Up', 0, -step), ('Down', 0, step)):
+            canvas.bind('<%s>' % key, lambda e, dx=dx, dy=dy: self.pan(dx, dy))
+        canvas.focus_set()
+        self._tick()
+
+    def _scale(self):
+        """
+        :return: (up, down), screen pixels per board pixel and board
+            pixels per screen pixel, one of them 1
+        """
+        if self.zoom >= 1:
+            return int(self.zoom), 1
+        return 1, int(round(1 / self.zoom))
+
+    def visible(self):
+        """
+        :return: (x0, y0, x1, y1) box of the board in view
+        """
+        up, down = self._scale()
+        return (self.x, self.y,
+                min(self.x + -(-self.viewWidth * down // up), self.width),
+                min(self.y + -(-self.viewHeight * down // up), self.height))
+
+    def _moveTo(self, x, y):
+        up, down = self._scale()
+        # keep the board in view, and at the top left when it is smaller
+        self.x = int(max(0, min(x, self.width - self.viewWidth * down // up)))
+        self.y = int(max(0, min(y, self.height - self.viewHeight * down // up)))
+        self.full = True
+        self.canvas.winfo_toplevel().title('%d,%d  %g%%' % (self.x, self.y, self.zoom * 100))
+
+    def pan(self, dx, dy):
+        """
+        Move the view by dx, dy screen pixels.
+        """
+        up, down = self._scale()
+        self._moveTo(self.x + dx * down // up, self.y + dy * down // up)
+
+    def zoomAt(self, sx, sy, steps):
+        """
+        Zoom in (steps > 0) or out by powers of two, keeping the board
+        pixel under the screen position sx, sy where it is.
+        """
+        i = min(max(self.ZOOMS.index(self.zoom) + steps, 0), len(self.ZOOMS) - 1)
+        up, down = self._scale()
+        bx, by = self.x + sx * down // up, self.y + sy * down // up
+        self.zoom = self.ZOOMS[i]
+        up, down = self._scale()
+        self._moveTo(bx - sx * down // up, by - sy * down // up)
+
+    def _startDrag(self, event):
+        self.canvas.focus_set()
+        self._drag = (event.x, event.y)
+
+    def _dragged(self, event):
+        if self._drag is not None:
+            self.pan(self._drag[0] - event.x, self._drag[1] - event.y)
+            self._drag = (event.x, event.y)
+
+    def _resized(self, event):
+        if (event.width, event.height) != (self.viewWidth, self.viewHeight):
+            self.viewWidth, self.viewHeight = event.width, event.height
+            self.photo.configure(width=event.width, height=event.height)
+            self._moveTo(self.x, self.y)
+
+    def mark_dirty(self, x0=0, y0=0, x1=None, y1=None):
+        """
+        Schedule the box x0 <= x < x1, y0 <= y < y1 (in board pixels)
+        for the next frame. Without x1/y1 a single pixel is marked,
+        without arguments the whole canvas.
+        """
+        if x1 is None:
+            if x0 == 0 and y0 == 0:
+                x1, y1 = self.width, self.height
+            else:
+                x1, y1 = x0 + 1, y0 + 1
+        with self.lock:
+            if self.dirty is None:
+                self.dirty = [x0, y0, x1, y1]
+            else:
+                d = self.dirty
+                d[0] = min(d[0], x0)
+                d[1] = min(d[1], y0)
+                d[2] = max(d[2], x1)
+                d[3] = max(d[3], y1)
+
+    def _tick(self):
+        if self._skipped < self.skip and self.dirty is not None and not self.full:
+            # keep the box, it is drawn with a later frame
+            self._skipped += 1
+            FRAMES_SKIPPED.inc()
+            self._after = self.canvas.after(self.interval, self._tick)
+            return
+        self._skipped = 0
+        with self.lock:
+            dirty, self.dirty = self.dirty, None
+        if self.full:
+            # after panning, zooming or resizing everything in view
+            self.full = False
+            dirty = self.visible()
+            self.photo.blank()
+        if dirty is not None:
+            with FRAME_SECONDS.time():
+                self._blit(*dirty)
+        self._after = self.canvas.after(self.interval, self._tick)
+
+    def _blit(self, x0, y0, x1, y1):
+        vx0, vy0, vx1, vy1 = self.visible()
+        x0, y0 = max(x0, vx0), max(y0, vy0)
+        x1, y1 = min(x1, vx1), min(y1, vy1)
+        up, down = self._scale()
+        if down > 1:
+            # the board pixels shown are every down-th from the corner
+            x0 += -(x0 - self.x) % down
+            y0 += -(y0 - self.y) % down
+        if x0 >= x1 or y0 >= y1:
+            return
+        block = self.array[x0:x1:down, y0:y1:down]
+        if block.dtype != np.uint8:
+            block = block.astype(np.uint8)
+        sx, sy = (x0 - self.x) * up // down, (y0 - self.y) * up // down
+        if up > 1:
+            block = block.repeat(up, 0).repeat(up, 1)[:self.viewWidth - sx, :self.viewHeight - sy]
+        # PPM wants rows of pixels, the canvas is indexed [x][y]
+        magic = 'P5' if block.ndim == 2 else 'P6'
+        header = ('%s %d %d 255\n' % (magic, block.shape[0], block.shape[1])).encode()
+        self.photo.put(header + block.swapaxes(0, 1).tobytes(), to=(sx, sy))
+
+    def stop(self):
+        """
+        Stop redrawing.
+        """
+        if self._after is not None:
+            self.canvas.after_cancel(self._after)
+            self._after = None
+
+
+class Interface(tk.Tk):
+    """
+    The Tk window.
+    :param archive: directory to archive all chat messages in (see
+        archive.ChatArchive), None for no archive
+    :param viewerPort: also show the board in a browser on this port
+        once launched (see viewer.CanvasViewer), 0 for any free one,
+        None for no viewer
+    :param viewerHost: address the viewer listens on
+    """
+    def __init__(self,archive=None,viewerPort=None,viewerHost='127.0.0.1'):
+        tk.Tk.__init__(self)
+        self.credentialsFrame = tk.LabelFrame(self,text="Login Credentials",padx=3)
+        self.channelFrame = tk.LabelFrame(self,text="Channel")
+        self.imageFrame = tk.LabelFrame(self,text="Image Options")
+        self.menubar = tk.Menu(self,tearoff=0)
+        self.menubar.add_command(label="Help",command = self.showHelp)
+        self.config(menu=self.menubar)
+        
+        self.isInChannel = False
+        self.wantsToReceive = False
+        self.receiving = False
+        self.STOP = False
+        self.lastMessageTime = time.time()
+        self.title("Twitch Colors")
+        self.attributes('-topmost',1)
+        self.lift()
+        self.focus_force()
+        self.width=0
+        self.height=0
+        self.array=np.zeros((0,0))
+        self.imTop=0
+        self.renderer=None
+        self.store=None
+        self.timelapse=None
+        self.tileSize=128
+        self.timelapseMaxPixels=4096*4096
+        # port to show the board in a browser on as well, see viewer.py
+        self.viewerPort=viewerPort
+        self.viewerHost=viewerHost
+        self.viewer=None
+        self.journal=None
+        # nobody paints much faster than everybody else
+        self.pixels=PixelBatch(limiter=UserRateLimiter())
+        # sprites for the 'emotes' option, named <emote id>.png or <emote name>.png
+        self.emotePack=EmotePack(self.resourcePath('emotes'))
+        # chat commands go to their handlers (register them here), the
+        # rest is painted
+        self.commands=CommandDispatcher(self.paintMessage,reply=self.sendReply)
+        self.commands.register('!colors',colors_command)
+        # every chat message when archiving, searchable with python archive.py DIR
+        self.archive=ChatArchive(archive) if archive else None
+        self.recLoop=None
+        self.recThread=None
+        # the AsyncTwitchChatStream while receiving, for replies
+        self.chat=None
+        # chat messages from the receive thread, handled on the Tk thread
+        self.events=EventBus()
+        self.drainInterval=15 # ms between drains
+        self.drainBudget=.008 # seconds of handling per drain
+        # while the bus is overloaded: longer drains, fewer redraws
+        self.overloadBudget=.012
+        self.overloadSkip=3
+        OS = os.name
+        if OS == 'nt': # Windows
+            self.isWindows = True
+        else:
+            self.isWindows = False
+            
+        self.PASS = ""
+        self.NICK = ""
+        
+        # Credentials Frame
+        self.NICKLabel = tk.Label(self.credentialsFrame,text="Username")
+        self.NICKLabel.grid(row=0,column=0,columnspan=2)
+        self.NICKEntry = tk.Entry(self.credentialsFrame,width=30)
+        self.NICKEntry.grid(row=1,column=0,columnspan=2,padx=10,pady=5)
+
+        self.PASSLabel = tk.Label(self.credentialsFrame,text="OAuth Code")
+        self.PASSLabel.grid(row=0,column=2)
+        self.PASSEntry = tk.Entry(self.credentialsFrame,width=30, show="*")
+        self.PASSEntry.grid(row=1,column=2,padx=5,pady=5)
+                
+        self.NICKEntry.insert(0,"UserNameHere")
+        self.PASSEntry.insert(0,"oauth:exampleabcdefg12345677")
+        #self.NICKEntry.insert(0,"ImABotBoy")
+        #self.PASSEntry.insert(0,"oauth:1ruvijtcfg81i6d0b44j5ct76mrhyo")
+        
+        self.connectButton = tk.Button(self.credentialsFrame,text="Connect to Twitch", command=self.connect,padx=38)
+        self.connectButton.grid(row=2,column=2,padx=7,pady=5)
+
+        # Channel Frame        
+        self.JOINLabel = tk.Label(self.channelFrame,text="Channel Name")
+        self.JOINLabel.grid(row=0,column=0,columnspan=2,padx=5,pady=5)
+        self.JOINEntry = tk.Entry(self.channelFrame,width=30)
+        self.JOINEntry.grid(row=1,column=0,columnspan=2,padx=5,pady=5)
+        self.JOINEntry.insert(0,"djskiskyskoski")
+        
+        self.joinButton = tk.Button(self.channelFrame,text="Join Channel",command = self.join,padx=55)
+        self.joinButton.grid(row=1,column=2,pady=5,padx=5)
+        self.joinButton.config(state='disabled')
+
+        
+        self.receiveMessagesButton = tk.Button(self.channelFrame,text="Read Chat!",command=self.receiveMessages,padx=60)
+        self.receiveMessagesButton.grid(row=2,column=0,columnspan=2,pady=5,padx=5)
+        self.attributes('-topmost',0)
+        
+        self.stopButton = tk.Button(self.channelFrame,text="Stop Reading", command = self.stop,padx=54)
+        self.stopButton.grid(row=2,column=2,columnspan=2,padx=5,pady=5)
+        
+        #Image Frame
+        self.wLabel = tk.Label(self.imageFrame,text="width")
+        self.wLabel.grid(row=0,column=0,columnspan=2,padx=5,pady=5)
+        self.hLabel = tk.Label(self.imageFrame,text="height")
+        self.hLabel.grid(row=0,column=2,columnspan=2,padx=5,pady=5)
+
+        self.wEntry = tk.Entry(self.imageFrame,width = 30)
+        self.wEntry.grid(row=1,column=0,columnspan=2,padx=5,pady=5)
+        self.hEntry = tk.Entry(self.imageFrame, width = 30)
+        self.hEntry.grid(row=1,column=2,columnspan=2,padx=5,pady=5)
+
+        self.colBool=tk.IntVar()
+        self.emoBool=tk.IntVar()
+        self.checkColor = tk.Checkbutton(self.imageFrame, text='pixels',variable=self.colBool)
+        self.checkEmote = tk.Checkbutton(self.imageFrame, text='emotes',variable=self.emoBool)
+        self.checkColor.grid(row=0,column=4,padx=5,pady=5)
+        self.checkEmote.grid(row=1,column=4,padx=5,pady=5)
+
+        self.imageButton = tk.Button(self.imageFrame,text='launch image',command=self.launchImage,padx=5)
+        self.imageButton.grid(row=1,column=5,padx=5,pady=5)
+        # Grid Frames        
+        self.credentialsFrame.grid(row=1,column=0,columnspan=2,padx=5,pady=5)
+        self.channelFrame.grid(row=3,column=0,padx=5,pady=5,rowspan=2)
+        self.imageFrame.grid(row=5,column=0,padx=5,pady=5,columnspan=2)
+        self.closeButton = tk.Button(self,text="Close Program",command = self.totalDestroy)
+        self.closeButton.grid(row=6,column=3,sticky='e',pady=5,padx=5)
+        self.addButtons()
+        self.disableButtons()
+        self.drainEvents()
+
+    def addButtons(self):
+        self.allButtons = []
+        self.allButtons.append(self.receiveMessagesButton)   
+        self.allButtons.append(self.stopButton)
+        
+        
+    def showHelp(self):
+        top = tk.Toplevel(self)
+        helpMessage  = "1. Obtain an 'OAuth' code from https://twitchapps.com/tmi/ to use along with your Twitch username.\n\n"
+        helpMessage += "2. Connect to a channel once logged into Twitch and interact with messages via the buttons in the 'Channel' section.\n\n"
+        topLabel = tk.Label(top,text=helpMessage)
+        topLabel.pack()
+        
+    def launchImage(self):
+        self.width=int(self.wEntry.get())
+        self.height=int(self.hEntry.get())
+        if self.renderer is not None:
+            self.renderer.stop()
+        if self.timelapse is not None:
+            self.timelapse.close()
+        if self.store is not None:
+            self.store.close()
+        # the canvas survives restarts and crashes, one store per size;
+        # tiled, so only the parts of a huge board that get painted cost
+        # memory
+        self.store=CanvasStore('canvas_%dx%d' % (self.width,self.height),self.width,self.height,tile=self.tileSize)
+        self.array=self.store.array
+        self.timelapse=None
+        if self.width*self.height <= self.timelapseMaxPixels:
+            # history for python timelapse.py, also written to the store;
+            # its keyframes copy the whole board, so not for huge ones
+            self.timelapse=TimelapseRecorder('timelapse_%dx%d.tlp' % (self.width,self.height),self.array,self.store)
+        self.journal=self.timelapse or self.store
+        if self.viewerPort is not None:
+            if self.viewer is None:
+                self.viewer=CanvasViewer(self.viewerPort,self.viewerHost)
+            self.journal=self.viewer.add('canvas',self.array,journal=self.journal)
+        self.imTop=tk.Toplevel(self)
+        # the view shows a part of larger boards, see CanvasRenderer
+        self.topCanvas = tk.Canvas(self.imTop,width=min(self.width,self.winfo_screenwidth()*3//4),
+                                   height=min(self.height,self.winfo_screenheight()*3//4),highlightthickness=0)
+        self.topCanvas.pack(expand=tk.YES, fill=tk.BOTH)
+        self.renderer = CanvasRenderer(self.topCanvas,self.array)
+        log.info("canvas %dx%d", self.width, self.height)
+         
+
+    def updateIm(self,x0=0,y0=0,x1=None,y1=None):
+        # drawn with the next frame of the renderer
+        self.renderer.mark_dirty(x0,y0,x1,y1)
+    
+    def connect(self):
+        self.NICK = self.NICKEntry.get()
+        self.PASS = self.PASSEntry.get()
+        if not self.PASS.startswith('oauth:'):
+            self.PASS = 'oauth:'+self.PASS
+        self.main = TwitchChatStream(self.NICK,self.PASS,verbose=False)
+        #self.main = TwitchChatStream(self.NICK,self.PASS,verbose=True)
+        self.main.connect()
+        if self.main.connected:
+            self.connectButton.config(bg="green")
+            self.joinButton.config(state='normal')
+            self.checkIfWantsToReceive()
+            log.info("Connected")
+        else:
+            self.connectButton.config(bg="red")
+            log.warning("Connection failed")
+            
+    def join(self):
+        self.joinButton.configure(bg="red")
+        channel = self.JOINEntry.get().lower()
+        self.main.join_channel(channel)
+        #self.main.twitch_receive_messages()
+        self.old_channel = self.main.current_channel
+        time.sleep(1)
+        self.main.twitch_receive_messages()
+        log.debug("I was in: %s", self.old_channel)
+        if self.old_channel == self.main.current_channel:
+            # Didn't actually join channel
+            self.joinButton.configure(bg="red")
+            self.disableButtons()
+            
+        else:
+            # Successfully joined channel
+            self.joinButton.configure(bg="green")
+            self.enableButtons()
+            self.isInChannel = True
+        log.info("I'm in channel: %s", self.main.current_channel)
+
+                
+    def resourcePath(self,filename):
+        try:
+            # PyInstaller creates a temp folder and stores path in _MEIPASS
+            base_path = sys._MEIPASS
+        except Exception:
+            base_path = os.path.abspath(".")
+        return os.path.join(base_path, filename)
+
+
+            
+    def receiveMessages(self):
+        log.debug("Receiving: %s", self.receiving)
+        self.STOP = False
+        if not self.receiving and self.isInChannel:
+            self.recThread = threading.Thread(target=self.receive,daemon=True)
+            self.recThread.start()
+            self.receiveMessagesButton.config(bg="green")
+            log.debug("After started thread and color changed to green")
+        
+    def stop(self):
+        if self.isInChannel:
+            try:            
+                log.debug("Wanted to receive before stopping? --> %s", self.wantsToReceive)
+                self.STOP = True    
+                if self.recLoop is not None and self.recLoop.is_running():
+                    # wake the receive thread even if chat is idle
+                    self.recLoop.call_soon_threadsafe(self.recTask.cancel)
+                self.receiving = False
+                self.wantsToReceive = False
+                if self.recThread is not None:
+                    self.recThread.join(2)
+                    self.recThread = None
+                self.receiveMessagesButton.config(bg="red")
+            except Exception as e:
+                log.exception("GOT AN ERROR IN STOP: %s", e)
+                pass
+        
+    def totalDestroy(self):
+        self.stop()
+        self.destroy()        
+        if self.timelapse is not None:
+            self.timelapse.close()
+        if self.store is not None:
+            self.store.close()
+        if self.viewer is not None:
+            self.viewer.close()
+        self.commands.close()
+        if self.archive is not None:
+            self.archive.close()
+        try:
+            self.main.s.close()
+        except:
+            pass
+        
+
+            
+    def checkIfWantsToReceive(self):
+        if self.wantsToReceive and not self.receiving:
+            log.debug("USER HOTKEYED RECEIVED")
+            self.receiveMessages()
+        self.after(1000,self.checkIfWantsToReceive) # Call this function repeatedly every 1000 milliseconds
+            
+
+
+
+    def receive(self):
+        log.debug("IN RECEIVE FUNC")
+        self.receiving = True
+        
+        if self.STOP:
+            log.debug("self.stop is True")
+            return
+        
+        self.recLoop = asyncio.new_event_loop()
+        self.recTask = self.recLoop.create_task(self.receiveAsync())
+        try:
+            self.recLoop.run_until_complete(self.recTask)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.recLoop.close()
+
+        self.STOP = False
+
+    async def receiveAsync(self):
+        # Read from a duplicate of the logged in socket, so closing the
+        # asyncio side on stop() leaves self.main connected
+        chat = AsyncTwitchChatStream(self.NICK,self.PASS)
+        chat.current_channel = self.main.current_channel
+        chat.channels = set(self.main.channels)
+        shared = self.main.connected
+        if shared:
+            # a line self.main only got part of goes on in the socket,
+            # so hand its start over with it
+            chat.framer.feed(self.main.framer.take())
+            await chat.connect(sock=self.main.s.dup())
+        else:
+            # self.main lost its connection, log in again and rejoin
+            await chat.connect()
+        since = chat.connected_since
+        self.chat = chat
+        try:
+            while not self.STOP:
+                rec = await chat.receive_messages()
+                if rec is None or self.STOP:
+                    return
+                if rec:
+                    # handled by drainEvents on the Tk thread
+                    self.events.put_many(rec)
+                    if self.archive is not None:
+                        self.archive.add_many(rec)
+        finally:
+            self.chat = None
+            if shared and chat.connected_since == since:
+                # still the socket of self.main, give back the partial line
+                self.main.framer.feed(chat.framer.take())
+            await chat.close()
+
+    def drainEvents(self):
+        # handle queued chat in chunks until the queue is empty or this
+        # frame's time is used up, the rest waits for the next call
+        overloaded = self.events.overloaded
+        if self.renderer is not None:
+            self.renderer.skip = self.overloadSkip if overloaded else 0
+        budget = self.overloadBudget if overloaded else self.drainBudget
+        start = time.perf_counter()
+        try:
+            while time.perf_counter() - start < budget:
+                rec = self.events.get_many(256)
+                if not rec:
+                    break
+                try:
+                    self.handleMessages(rec)
+                except Exception:
+                    # drop this chunk, keep drawing the next ones
+                    log.exception("Dropped %d messages", len(rec))
+        finally:
+            self.after(self.drainInterval,self.drainEvents)
+
+    def handleMessages(self,rec):
+        for message_info in rec:
+            self.handleMessage(message_info)
+        # all pixels of this batch in one go
+        applied,rejected,box = self.pixels.apply(self.array,self.journal)
+        if box is not None:
+            self.updateIm(*box)
+
+    def handleMessage(self,message_info):
+        if message_info['channel'] == "#"+self.main.current_channel:
+            self.commands.dispatch(message_info)
+
+    def sendReply(self,channel,text):
+        # on the receiving connection, whose event loop does the writing
+        chat = self.chat
+        if chat is not None:
+            self.recLoop.call_soon_threadsafe(chat.send_chat_message,channel,text)
+
+    def paintMessage(self,message_info):
+        user = message_info['username'].lower()
+        message = message_info['message']
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("%s: %s", user, message)
+        if(self.imTop!=0):
+            # "Kappa (10,20)" stamps the emote at 10,20 when emotes
+            # are on, other commands paint pixels when pixels are on
+            self.pixels.paint = self.colBool.get()==1
+            if(self.emoBool.get()==1):
+                self.pixels.emotes = self.emotePack
+                self.pixels.add_message(message,user,message_info.emotes)
+            elif(self.pixels.paint):
+                self.pixels.emotes = None
+                self.pixels.add_message(message,user)
+            
+    def enableButtons(self):
+        for button in self.allButtons:
+            button.config(state='normal')
+    def disableButtons(self):
+        for button in self.allButtons:
+            button.config(state='disabled')
+   
+
+
+def main(archive=None,viewerPort=None,viewerHost='127.0.0.1'):
+    """
+    Run the interface until its window is closed.
+    :param archive: see Interface
+    :param viewerPort: see Interface
+    :param viewerHost: see Interface
+    """
+    try:
+        import pyHook #import HookManager, GetKeyState, HookConstants
+    except ImportError: # the keyboard hook only exists on Windows
+        pyHook = None
+
+    gui = Interface(archive=archive,viewerPort=viewerPort,viewerHost=viewerHost)
+
+    if pyHook is not None:
+        hm = pyHook.HookManager()    
+
+    # set the hook
+    gui.mainloop()
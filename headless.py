@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The canvas bot without a GUI: reads the chat of one or more channels and
+paints the pixel commands into one canvas per channel, optionally saving
+the canvases every few seconds. Started with python -m twitch, see
+twitch.py for the options.
+"""
+import asyncio
+import logging
+import os
+import numpy as np
+from chat import ChatConnectionPool
+from canvas import PixelBatch, colors_command
+from commands import PREFIX, CommandDispatcher
+from canvasstore import CanvasStore
+from ratelimit import UserRateLimiter
+from emotes import EmotePack
+from archive import ChatArchive
+from timelapse import TimelapseRecorder
+from viewer import CanvasViewer
+
+log = logging.getLogger(__name__)
+
+
+class HeadlessBot(object):
+    """
+    Paints the pixel commands of every joined channel into a canvas of
+    its own. Commands are collected per channel and applied as one batch
+    fps times per second.
+    :param username: Twitch username
+    :param oauth: oauth for logging in (see https://twitchapps.com/tmi/)
+    :param channels: names of the channels to join (without #)
+    :param width: canvas width in pixels
+    :param height: canvas height in pixels
+    :param save: path to save the canvases to, '{channel}' is replaced by
+        the channel name; .png is written with PIL, anything else with
+        numpy.save
+    :param save_interval: seconds between saves
+    :param state_dir: keep the canvases in crash-safe CanvasStores in
+        this directory (one per channel), so a restart continues where
+        the last run stopped
+    :param channels_per_connection: see ChatConnectionPool
+    :param fps: batches applied per second
+    :param max_pixels_per_frame: bound on the pixel commands queued per
+        channel between two frames, see PixelBatch; None for no bound
+    :param user_limits: keyword arguments for the UserRateLimiter of each
+        channel (None for its defaults), False to let everybody paint as
+        fast as they like
+    :param emotes: directory of emote sprites (see emotes.EmotePack);
+        messages with an emote then stamp it at their coordinates
+    :param archive: directory to archive all chat messages in, see
+        archive.ChatArchive
+    :param timelapse: directory to record the history of every canvas in
+        (<channel>.tlp), for exporting with timelapse.py
+    :param viewer_port: serve the canvases to browsers on this port, see
+        viewer.CanvasViewer
+    :param viewer_host: address the viewer listens on
+    :param canvases: arrays to paint into by channel name instead of new
+        ones, e.g. in shared memory (see rooms.py); not used with
+        state_dir
+    :param verbose: show all stream messages on stdout (for debugging)
+    """
+
+    def __init__(self, username, oauth, channels, width=500, height=500,
+                 save=None, save_interval=30, channels_per_connection=50,
+                 fps=30, state_dir=None, max_pixels_per_frame=50000,
+                 user_limits=None, emotes=None, archive=None,
+                 timelapse=None, viewer_port=None, viewer_host='127.0.0.1',
+                 canvases=None, verbose=False):
+        self.pool = ChatConnectionPool(
+            username, oauth, channels_per_connection=channels_per_connection,
+            verbose=verbose)
+        self.channels = [channel.lower() for channel in channels]
+        self.width = width
+        self.height = height
+        self.save = save
+        self.save_interval = save_interval
+        self.interval = 1. / fps
+        self.emotes = EmotePack(emotes) if emotes else None
+        self.archive = ChatArchive(archive) if archive else None
+        # chat commands (register more on it), everything else paints
+        self.commands = CommandDispatcher(self.paint_message,
+                                          reply=self.pool.send_chat_message)
+        # counting reads the whole canvas, so not on the painting thread
+        self.commands.register('!canvas', self.canvas_command, mode='thread',
+                               timeout=5, max_concurrent=2)
+        self.commands.register('!colors', colors_command)
+        self.viewer = None
+        if viewer_port is not None:
+            self.viewer = CanvasViewer(viewer_port, viewer_host)
+        self.canvases = {}
+        self.stores = {}
+        self.recorders = {}
+        self.journals = {}
+        self.batches = {}
+        for channel in self.channels:
+            if state_dir:
+                store = CanvasStore(os.path.join(state_dir, channel), width, height)
+                self.stores[channel] = store
+                self.canvases[channel] = store.array
+            elif canvases is not None:
+                self.canvases[channel] = canvases[channel]
+            else:
+                self.canvases[channel] = np.zeros((width, height, 3), np.uint8)
+            self.journals[channel] = self.stores.get(channel)
+            if timelapse:
+                os.makedirs(timelapse, exist_ok=True)
+                self.recorders[channel] = TimelapseRecorder(
+                    os.path.join(timelapse, channel + '.tlp'),
+                    self.canvases[channel], self.journals[channel])
+                self.journals[channel] = self.recorders[channel]
+            if self.viewer is not None:
+                self.journals[channel] = self.viewer.add(
+                    channel, self.canvases[channel], journal=self.journals[channel])
+            limiter = None
+            if user_limits is not False:
+                limiter = UserRateLimiter(**(user_limits or {}))
+            self.batches['#' + channel] = PixelBatch(max_pixels_per_frame, limiter,
+                                                     self.emotes)
+
+    def on_message(self, message_info):
+        if self.archive is not None:
+            self.archive.add(message_info)
+        if message_info.message[:1] == PREFIX:
+            # commands see the canvas with everything said before them
+            self.apply_batch(message_info.channel)
+        self.commands.dispatch(message_info)
+
+    def paint_message(self, message_info):
+        self.batches[message_info.channel].add_message(
+            message_info.message, message_info.username,
+            message_info.emotes if self.emotes is not None else None)
+
+    def canvas_command(self, command):
+        """
+        Handler of the !canvas chat command.
+        :return: size of the channel's canvas, how much of it is painted
+            and how to paint
+        """
+        canvas = self.canvases[command.channel[1:]]
+        painted = np.count_nonzero(canvas.any(axis=2))
+        return ('%dx%d canvas, %d pixels painted. Paint with (x, y, color), '
+                'rect(x0, y0, x1, y1, color), box(...), line(...) or '
+                'fill(x, y, color); !colors lists the colors'
+                % (self.width, self.height, painted))
+
+    def apply_batches(self):
+        for channel in self.batches:
+            self.apply_batch(channel)
+
+    def apply_batch(self, channel):
+        """
+        Paint the commands collected for a channel (with the #) now.
+        """
+        batch = self.batches[channel]
+        if not batch:
+            return
+        channel = channel[1:]
+        try:
+            batch.apply(self.canvases[channel], self.journals[channel])
+        except Exception:
+            # the batch is gone, the next one paints as usual
+            log.exception("Dropped a batch for %s", channel)
+
+    def save_canvases(self):
+        if not self.save:
+            return
+        for channel, array in self.canvases.items():
+            path = self.save.format(channel=channel)
+            if path.endswith('.png'):
+                from PIL import Image # only needed when saving PNGs
+                Image.fromarray(array.swapaxes(0, 1)).save(path)
+            else:
+                np.save(path, array)
+
+    async def _paint(self):
+        loop = asyncio.get_running_loop()
+        next_save = loop.time() + self.save_interval
+        while True:
+            await asyncio.sleep(self.interval)
+            self.apply_batches()
+            if loop.time() >= next_save:
+                self.save_canvases()
+                next_save = loop.time() + self.save_interval
+
+    async def run(self):
+        """
+        Join all channels and paint until the connections are closed.
+        """
+        # replies of pooled commands are sent from the event loop
+        self.commands.deliver = asyncio.get_running_loop().call_soon_threadsafe
+        painter = asyncio.ensure_future(self._paint())
+        try:
+            async with self.pool:
+                for channel in self.channels:
+                    await self.pool.join(channel, self.on_message)
+                await self.pool.run()
+        finally:
+            painter.cancel()
+            self.close()
+
+    def close(self):
+        """
+        Apply and save what is left and close the stores, recordings,
+        archive and viewer.
+        """
+        self.commands.close()
+        self.apply_batches()
+        self.save_canvases()
+        if self.viewer is not None:
+            self.viewer.close()
+        for recorder in self.recorders.values():
+            recorder.close()
+        for store in self.stores.values():
+            store.close()
+        if self.archive is not None:
+            self.archive.close()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Single pass parser for the IRC lines Twitch sends, including IRCv3
+message tags (https://ircv3.net/specs/extensions/message-tags).
+A line is split into tags, prefix, command and params with plain string
+searches; tags are only unescaped and split into a dict the first time
+they are looked at, so untagged traffic and lines nobody inspects pay
+nothing for them.
+
+    @badge-info=;badges=moderator/1;color=#1E90FF;display-name=Foo;emotes=25:0-4;id=b34c...;tmi-sent-ts=1507246572675 :foo!foo@foo.tmi.twitch.tv PRIVMSG #bar :Kappa (1,2)
+"""
+
+_TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
+def _unescape_tag(value):
+    """
+    Undo the IRCv3 tag value escaping (\\: \\s \\\\ \\r \\n).
+    """
+    if '\\' not in value:
+        return value
+    out = []
+    i = 0
+    n = len(value)
+    while i < n:
+        c = value[i]
+        if c == '\\' and i + 1 < n:
+            i += 1
+            c = _TAG_ESCAPES.get(value[i], value[i])
+        elif c == '\\':
+            c = ''
+        out.append(c)
+        i += 1
+    return ''.join(out)
+
+
+def parse_tags(raw):
+    """
+    Split a raw tag string (without the leading @) into a dict.
+    :param raw: e.g. 'color=#1E90FF;display-name=Foo'
+    :return: dict of tag name to unescaped value ('' for valueless tags)
+    """
+    tags = {}
+    for item in raw.split(';'):
+        key, sep, value = item.partition('=')
+        if key:
+            tags[key] = _unescape_tag(value) if sep else ''
+    return tags
+
+
+class ChatMessage(object):
+    """
+    One parsed IRC line. The split of the line (and the sender, channel
+    and text every PRIVMSG handler needs) is done up front, everything
+    else (tags, emotes, badges, ...) is derived on access.
+    For compatibility with the old dict based messages the keys
+    'channel', 'username' and 'message' can still be used with [].
+    :param command: IRC command or numeric, e.g. 'PRIVMSG'
+    :param params: list of params, the trailing param last
+    :param prefix: source of the message without ':' (or None)
+    :param raw_tags: tag string without '@' (or None)
+    """
+    # _tags stays unset until the tags are looked at, and so does _params
+    # for the PRIVMSGs of parse_line
+    __slots__ = ('command', '_params', 'prefix', 'raw_tags', '_tags',
+                 'username', 'channel', 'message')
+
+    def __init__(self, command, params, prefix=None, raw_tags=None):
+        self.command = command
+        self._params = params
+        self.prefix = prefix
+        self.raw_tags = raw_tags
+        # login name of the sender (the nick part of the prefix)
+        self.username = prefix.partition('!')[0] if prefix else None
+        # channel the message was sent to, including the '#'
+        self.channel = params[0] if params and params[0][:1] == '#' else None
+        # trailing parameter, i.e. the chat text of a PRIVMSG
+        self.message = params[-1] if len(params) > 1 else None
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return 'ChatMessage(%r, %r, prefix=%r)' % (
+            self.command, self.params, self.prefix)
+
+    @property
+    def params(self):
+        try:
+            return self._params
+        except AttributeError:
+            # a PRIVMSG from the fast path of parse_line
+            self._params = [self.channel, self.message]
+            return self._params
+
+    @property
+    def tags(self):
+        try:
+            return self._tags
+        except AttributeError:
+            self._tags = parse_tags(self.raw_tags) if self.raw_tags else {}
+            return self._tags
+
+    @property
+    def id(self):
+        return self.tags.get('id')
+
+    @property
+    def color(self):
+        return self.tags.get('color') or None
+
+    @property
+    def display_name(self):
+        return self.tags.get('display-name') or self.username
+
+    @property
+    def badges(self):
+        """
+        :return: dict of badge name to version, e.g. {'moderator': '1'}
+        """
+        raw = self.tags.get('badges')
+        if not raw:
+            return {}
+        return dict(b.partition('/')[::2] for b in raw.split(','))
+
+    @property
+    def emotes(self):
+        """
+        :return: dict of emote id to list of (start, end) character
+            positions in the message, e.g. {'25': [(0, 4)]}; empty
+            when the tag is malformed
+        """
+        raw = self.tags.get('emotes')
+        if not raw:
+            return {}
+        emotes = {}
+        try:
+            for emote in raw.split('/'):
+                emote_id, _, positions = emote.partition(':')
+                emotes[emote_id] = [
+                    tuple(int(p) for p in pos.split('-'))
+                    for pos in positions.split(',') if pos]
+        except ValueError:
+            # a malformed tag, the message is still chat without emotes
+            return {}
+        return emotes
+
+    @property
+    def timestamp(self):
+        """
+        :return: server time the message was sent, in seconds since the
+            epoch, or None when the tmi-sent-ts tag is missing
+        """
+        ts = self.tags.get('tmi-sent-ts')
+        return int(ts) / 1000.0 if ts else None
+
+
+class _ParsedMessage(ChatMessage):
+    # a ChatMessage made by parse_line, which fills the slots itself;
+    # calling a class without an __init__ of its own is the cheapest way
+    # to create an instance
+    __slots__ = ()
+    __init__ = object.__init__
+
+
+def parse_line(line):
+    """
+    Split a single IRC line (without CRLF) into a ChatMessage.
+    :param line: the decoded line
+    :type line: string
+    :return: ChatMessage, or None for an empty line
+    """
+    raw_tags = None
+    first = line[:1]
+    if first == '@':
+        raw_tags, _, line = line.partition(' ')
+        raw_tags = raw_tags[1:]
+        first = line[:1]
+    if first != ':':
+        prefix = username = None
+    else:
+        # ':nick!nick@host PRIVMSG #channel :text' in one split
+        try:
+            prefix, command, channel, message = line.split(' ', 3)
+        except ValueError:
+            command = message = ''
+        if command == 'PRIVMSG' and message[:1] == ':':
+            # fast path for chat, the bulk of all traffic
+            prefix = prefix[1:]
+            message = message[1:]
+            msg = _ParsedMessage()
+            msg.command = command
+            msg.prefix = prefix
+            msg.raw_tags = raw_tags
+            msg.username = prefix.partition('!')[0]
+            msg.channel = channel
+            msg.message = message
+            return msg
+        prefix, _, line = line[1:].partition(' ')
+        username = prefix.partition('!')[0]
+    command, _, rest = line.partition(' ')
+    if not command:
+        return None
+    middle, sep, trailing = (' ' + rest).partition(' :')
+    params = middle.split()
+    if sep:
+        params.append(trailing)
+    msg = _ParsedMessage()
+    msg.command = command
+    msg._params = params
+    msg.prefix = prefix
+    msg.raw_tags = raw_tags
+    msg.username = username
+    msg.channel = params[0] if params and params[0][:1] == '#' else None
+    msg.message = params[-1] if len(params) > 1 else None
+    return msg
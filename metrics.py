@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runtime metrics: counters, gauges and histograms kept in a registry,
+exported in the Prometheus text format by an optional local HTTP
+endpoint and summarised in a periodic stats line in the log.
+Updating a metric is a plain attribute update (plus a bisect for
+histograms), cheap enough for the receive and render paths. Updates from
+different threads are not locked; a lost increment now and then is an
+acceptable price for that.
+
+    python -m twitch ... --metrics-port 9100 --stats-interval 10
+    curl localhost:9100/metrics
+"""
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+# seconds, from 10 us to 1 s
+DEFAULT_BUCKETS = (.00001, .00005, .0001, .0005, .001, .0025, .005, .01,
+                   .025, .05, .1, .25, .5, 1.)
+
+
+class Counter(object):
+    """Monotonically increasing count."""
+    type = 'counter'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        yield self.name, '', self.value
+
+
+class Gauge(object):
+    """Value that goes up and down, e.g. a queue depth."""
+    type = 'gauge'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def samples(self):
+        yield self.name, '', self.value
+
+
+class Histogram(object):
+    """
+    Distribution of observed values over fixed buckets.
+    :param buckets: sorted upper bounds, +Inf is added
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help='', buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """
+        Context manager observing the time spent in its block.
+        """
+        return _Timer(self)
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.bounds + ['+Inf'], self.counts):
+            cumulative += count
+            yield self.name + '_bucket', '{le="%s"}' % bound, cumulative
+        yield self.name + '_sum', '', self.sum
+        yield self.name + '_count', '', self.count
+
+
+class _Timer(object):
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, type, value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry(object):
+    """
+    All metrics of the process, by name. Asking for an existing name
+    returns the metric that is already there.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, **kwargs)
+            return metric
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def render(self):
+        """
+        :return: all metrics in the Prometheus text exposition format
+        """
+        out = []
+        for name, metric in sorted(self.metrics.items()):
+            out.append('# HELP %s %s' % (name, metric.help))
+            out.append('# TYPE %s %s' % (name, metric.type))
+            for sample, labels, value in metric.samples():
+                out.append('%s%s %s' % (sample, labels, value))
+        return '\n'.join(out) + '\n'
+
+    def summary(self, previous):
+        """
+        One line with the rate of every counter, the value of every gauge
+        and the mean of every histogram since `previous`.
+        :param previous: (time, {name: (value, count)}) from the last
+            call, or None
+        :return: (line, state to pass as previous next time)
+        """
+        now = time.monotonic()
+        state = {}
+        parts = []
+        for name, metric in sorted(self.metrics.items()):
+            if metric.type == 'histogram':
+                state[name] = (metric.sum, metric.count)
+            else:
+                state[name] = (metric.value, 0)
+            if previous is None:
+                continue
+            then, old = previous
+            value, count = state[name]
+            old_value, old_count = old.get(name, (0, 0))
+            if metric.type == 'counter':
+                parts.append('%s=%.1f/s' % (name, (value - old_value) / max(now - then, 1e-9)))
+            elif metric.type == 'gauge':
+                parts.append('%s=%g' % (name, value))
+            elif count > old_count:
+                parts.append('%s=%.3fms' % (name, 1000 * (value - old_value) / (count - old_count)))
+        return ' '.join(parts), (now, state)
+
+
+REGISTRY = Registry()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def start_http_server(port, host='127.0.0.1', registry=REGISTRY):
+    """
+    Serve /metrics from a daemon thread.
+    :return: the ThreadingHTTPServer (call shutdown() to stop it)
+    """
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    log.info('metrics on http://%s:%d/metrics', host, server.server_address[1])
+    return server
+
+
+def start_stats_logger(interval, registry=REGISTRY):
+    """
+    Log a stats line every `interval` seconds from a daemon thread.
+    :return: threading.Event, set it to stop logging
+    """
+    stop = threading.Event()
+
+    def run():
+        line, state = registry.summary(None)
+        while not stop.wait(interval):
+            line, state = registry.summary(state)
+            log.info('stats %s', line)
+
+    threading.Thread(target=run, daemon=True).start()
+    return stop
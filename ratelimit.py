@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-user limits for canvas commands, so one chatter (or one script)
+cannot repaint the canvas faster than everybody else.
+
+Every user gets two sliding-window counters, one for messages with pixel
+commands and one for the commands themselves, plus the hash of their
+last message to drop repeats, all in one small slotted object. The
+windows are the usual approximation of a sliding log: the count of the
+current fixed window plus the count of the previous one weighted by how
+much of it still overlaps, which is O(1) and a few integers per user.
+Users live in an LRU-ordered table of at most max_users entries, so
+memory stays bounded however many people chat; whoever is evicted was
+the least recently active and simply starts over.
+"""
+from collections import OrderedDict
+import time
+
+from metrics import REGISTRY
+
+LIMITED = REGISTRY.counter('ratelimit_limited_total', 'Messages dropped by the per-user rate limits')
+REPEATED = REGISTRY.counter('ratelimit_repeated_total', 'Messages dropped as repeats of the previous one')
+USERS = REGISTRY.gauge('ratelimit_users', 'Users tracked by the rate limiters')
+
+
+class _User(object):
+    """
+    Counts of the current and the previous window, plus the last message.
+    """
+    __slots__ = ('window', 'messages_before', 'messages', 'pixels_before',
+                 'pixels', 'last_hash', 'last_time')
+
+    def __init__(self):
+        self.window = 0
+        self.messages_before = self.messages = 0
+        self.pixels_before = self.pixels = 0
+        self.last_hash = None
+        self.last_time = 0.
+
+
+class UserRateLimiter(object):
+    """
+    Decides per message whether a user's pixel commands are accepted.
+    :param window: length of the sliding window in seconds
+    :param max_messages: messages with pixel commands per user and
+        window; 1 works as a cooldown of `window` seconds. None for no
+        limit
+    :param max_pixels: pixel commands per user and window, None for no
+        limit
+    :param repeat_seconds: drop a message identical to the same user's
+        previous one within this many seconds, 0 to allow repeats
+    :param max_users: users remembered at most
+    """
+
+    def __init__(self, window=30, max_messages=20, max_pixels=300,
+                 repeat_seconds=30, max_users=200000):
+        self.window = window
+        self.max_messages = max_messages
+        self.max_pixels = max_pixels
+        self.repeat_seconds = repeat_seconds
+        self.max_users = max_users
+        self.users = OrderedDict()
+
+    def __len__(self):
+        return len(self.users)
+
+    def allow(self, username, message, pixels=1, now=None):
+        """
+        Check a message and count it when it is allowed.
+        :param username: who sent it
+        :param message: the text, for spotting repeats
+        :param pixels: number of pixel commands in it
+        :return: True when the commands may be painted
+        """
+        if now is None:
+            now = time.monotonic()
+        users = self.users
+        user = users.get(username)
+        if user is None:
+            user = users[username] = _User()
+            if len(users) > self.max_users:
+                users.popitem(last=False)
+            USERS.set(len(users))
+        else:
+            users.move_to_end(username)
+        digest = hash(message)
+        if (digest == user.last_hash and self.repeat_seconds
+                and now - user.last_time < self.repeat_seconds):
+            REPEATED.inc()
+            return False
+        window = int(now // self.window)
+        if window != user.window:
+            if window == user.window + 1:
+                user.messages_before, user.pixels_before = user.messages, user.pixels
+            else:
+                user.messages_before = user.pixels_before = 0
+            user.messages = user.pixels = 0
+            user.window = window
+        # share of the previous window still inside the sliding one
+        weight = 1 - (now % self.window) / self.window
+        if ((self.max_messages is not None and
+             user.messages_before * weight + user.messages + 1 > self.max_messages)
+                or (self.max_pixels is not None and
+                    user.pixels_before * weight + user.pixels + pixels > self.max_pixels)):
+            LIMITED.inc()
+            return False
+        user.messages += 1
+        user.pixels += pixels
+        user.last_hash = digest
+        user.last_time = now
+        return True
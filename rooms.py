@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The headless bot spread over processes, for many busy channels at once
+(one process only ever gets one core):
+
+    ingest processes  own the chat connections, a ChatConnectionPool
+                      each for a share of the channels; they parse the
+                      IRC lines, archive them and forward the messages
+                      with drawing or chat commands, in batches, to the
+                      workers, and send the replies of the commands
+    room workers      paint the rooms (channels) assigned to them and
+                      run their chat commands, with a HeadlessBot of
+                      their own that never connects
+
+Every ingest process has a pipe to every worker, batches going one way
+and replies the other, so there are no locks between processes. A
+thread per pipe does the sending, so a worker that falls behind never
+holds up reading chat or the other workers; its batches queue up to a
+bound and are dropped past it. The parent process watches all of them:
+when one dies (or on Ctrl-C) it stops the ingest processes, the workers
+finish the messages sent to them, and the shared memory is removed.
+
+The canvases live in multiprocessing.shared_memory blocks named after
+the channel (or, with a state_dir, in the memory maps of their
+CanvasStores), so renderers and exporters can read them while the bot
+runs, without copying:
+
+    shm, canvas = attach_canvas('somechannel', 500, 500)
+    ...
+    shm.close()
+
+Started with python -m twitch --room-workers N [--ingest-processes N].
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.connection import wait
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from archive import ChatArchive
+from canvas import COMMAND
+from commands import PREFIX
+from chat import AsyncTwitchChatStream, ChatConnectionPool
+from headless import HeadlessBot
+
+log = logging.getLogger(__name__)
+
+# what a worker needs of a ChatMessage
+_Message = namedtuple('_Message', 'channel username message emotes')
+
+# batches an ingest process keeps for a worker that falls behind
+QUEUED_BATCHES = 200
+
+
+def shm_name(channel):
+    # short, macOS allows 31 characters
+    return 'tw-' + channel.lower()
+
+
+def _canvas(shm, width, height):
+    return np.ndarray((width, height, 3), np.uint8, buffer=shm.buf)
+
+
+def attach_canvas(channel, width, height):
+    """
+    Map the canvas of a channel painted by RoomProcesses, read-only.
+    :return: (SharedMemory, array); close the SharedMemory when done
+    """
+    try:
+        shm = SharedMemory(shm_name(channel), track=False)
+    except TypeError:
+        # before Python 3.13 the resource tracker would remove the block
+        # when this process exits, although it belongs to the bot
+        shm = SharedMemory(shm_name(channel))
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    canvas = _canvas(shm, width, height)
+    canvas.flags.writeable = False
+    return shm, canvas
+
+
+def _close_others(pipes, keep):
+    """
+    Close the pipe ends this process does not use, so that a worker sees
+    the end of its pipes once the ingest processes are gone.
+    """
+    for row in pipes:
+        for ends in row:
+            for end in ends:
+                if end not in keep:
+                    end.close()
+
+
+def _ingest(number, username, oauth, channels, route, pipes, server, options):
+    # stopped by the parent with SIGTERM, so that Ctrl-C reaches it once
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    writers = [writer for _, writer in pipes[number]]
+    _close_others(pipes, writers)
+    # set by --server, lost when the process is spawned rather than forked
+    AsyncTwitchChatStream.connect_host, AsyncTwitchChatStream.connect_port = server
+    try:
+        asyncio.run(_ingest_chat(number, username, oauth, channels, route,
+                                 writers, **options))
+    except asyncio.CancelledError:
+        pass
+    finally:
+        for writer in writers:
+            writer.close()
+
+
+def _replies(number, worker, conn, loop, send):
+    """
+    Have the event loop send the replies of a worker's chat commands
+    until the worker is gone.
+    """
+    while True:
+        try:
+            channel, text = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            loop.call_soon_threadsafe(send, channel, text)
+        except RuntimeError:
+            # the loop is closed, the ingest process is stopping
+            return
+
+
+def _feed(number, worker, writer, batches):
+    """
+    Send the batches queued for a worker until None, or until the worker
+    is gone.
+    """
+    while True:
+        batch = batches.get()
+        if batch is None:
+            return
+        try:
+            writer.send(batch)
+        except (OSError, ValueError) as e:
+            log.error("Ingest %d lost room worker %d: %s", number, worker, e)
+            return
+
+
+async def _ingest_chat(number, username, oauth, channels, route, writers,
+                       channels_per_connection=50, archive=None, emotes=False,
+                       flush_interval=.01, verbose=False):
+    buffers = [[] for _ in writers]
+    search = COMMAND.search
+    archive = ChatArchive(archive, prefix='chat%d' % number) if archive else None
+    queues = [queue.Queue(QUEUED_BATCHES) for _ in writers]
+    feeders = [threading.Thread(target=_feed, args=(number, i, writer, queues[i]),
+                                name='feed-%d' % i, daemon=True)
+               for i, writer in enumerate(writers)]
+    for feeder in feeders:
+        feeder.start()
+    # batches dropped in a row per worker, to warn once for each run
+    dropped = [0] * len(writers)
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    except NotImplementedError:
+        # Windows, where terminate() does not let the process clean up
+        pass
+
+    def on_message(msg):
+        if archive is not None:
+            archive.add(msg)
+        if msg.message[:1] == PREFIX or search(msg.message):
+            buffers[route[msg.channel]].append((
+                msg.channel, msg.username, msg.message,
+                msg.emotes if emotes else None))
+
+    async def flush():
+        while True:
+            await asyncio.sleep(flush_interval)
+            for i, buffer in enumerate(buffers):
+                if not buffer:
+                    continue
+                buffers[i] = []
+                if not feeders[i].is_alive():
+                    # the worker is gone, its rooms are no longer painted
+                    continue
+                try:
+                    queues[i].put_nowait(buffer)
+                except queue.Full:
+                    if not dropped[i]:
+                        log.warning("Room worker %d falls behind, dropping messages", i)
+                    dropped[i] += 1
+                else:
+                    if dropped[i]:
+                        log.warning("Room worker %d caught up, %d batches dropped",
+                                    i, dropped[i])
+                        dropped[i] = 0
+
+    pool = ChatConnectionPool(username, oauth,
+                              channels_per_connection=channels_per_connection,
+                              verbose=verbose)
+    for i, conn in enumerate(writers):
+        threading.Thread(target=_replies, args=(number, i, conn, loop,
+                                                pool.send_chat_message),
+                         name='replies-%d' % i, daemon=True).start()
+    flusher = asyncio.ensure_future(flush())
+    try:
+        async with pool:
+            for channel in channels:
+                await pool.join(channel, on_message)
+            await pool.run()
+    finally:
+        flusher.cancel()
+        for i, feeder in enumerate(feeders):
+            if feeder.is_alive():
+                # the worker gets what was read before stopping
+                try:
+                    queues[i].put_nowait(None)
+                except queue.Full:
+                    pass
+        for feeder in feeders:
+            feeder.join(5)
+        if archive is not None:
+            archive.close()
+
+
+def _room_worker(number, rooms, pipes, owners, width, height, shared, options):
+    # stopped by the ingest processes closing their pipes
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    conns = [row[number][0] for row in pipes]
+    _close_others(pipes, conns)
+    readers = list(conns)
+    if options.get('viewer_port'):
+        # one port per worker, showing its rooms
+        options = dict(options, viewer_port=options['viewer_port'] + number)
+    blocks = {}
+    canvases = None
+    if shared:
+        canvases = {}
+        for channel in rooms:
+            blocks[channel] = SharedMemory(shm_name(channel))
+            canvases[channel] = _canvas(blocks[channel], width, height)
+    bot = HeadlessBot(None, None, rooms, width, height, canvases=canvases, **options)
+    lock = threading.Lock()
+
+    def reply(channel, text):
+        # to the ingest process connected to the channel; pooled
+        # commands reply from their threads
+        with lock:
+            conns[owners[channel]].send((channel, text))
+
+    bot.commands.reply = reply
+    loop_time = time.monotonic
+    next_frame = last_save = loop_time()
+    try:
+        while readers:
+            for reader in wait(readers, max(0., next_frame - loop_time())):
+                try:
+                    batch = reader.recv()
+                except EOFError:
+                    readers.remove(reader)
+                    continue
+                for message in batch:
+                    bot.on_message(_Message._make(message))
+            now = loop_time()
+            if now >= next_frame:
+                bot.apply_batches()
+                next_frame = now + bot.interval
+            if now >= last_save + bot.save_interval:
+                bot.save_canvases()
+                last_save = now
+    finally:
+        bot.close()
+        # no views of the blocks may be left when closing them
+        del bot, canvases
+        for shm in blocks.values():
+            shm.close()
+
+
+class RoomProcesses(object):
+    """
+    Runs the bot as ingest processes and room workers, see the module
+    docstring.
+    :param username: Twitch username
+    :param oauth: oauth for logging in (see https://twitchapps.com/tmi/)
+    :param channels: names of the channels to join (without #)
+    :param ingest_processes: processes holding the chat connections
+    :param room_workers: processes painting, by default one per core
+        left after the ingest processes, but at most one per channel
+    :param width: canvas width in pixels
+    :param height: canvas height in pixels
+    :param channels_per_connection: see ChatConnectionPool
+    :param archive: directory to archive all chat messages in, written
+        by the ingest processes
+    :param flush_interval: seconds an ingest process collects messages
+        for a worker before sending them on
+    :param verbose: show all stream messages on stdout (for debugging)
+    :param stop_timeout: seconds the processes get to finish once
+        stopping, before they are killed
+    :param options: further keyword arguments of HeadlessBot (save,
+        fps, state_dir, emotes, timelapse, ...) for every worker; worker
+        i serves its viewer on viewer_port + i
+    """
+
+    def __init__(self, username, oauth, channels, ingest_processes=1,
+                 room_workers=None, width=500, height=500,
+                 channels_per_connection=50, archive=None, flush_interval=.01,
+                 verbose=False, stop_timeout=15, **options):
+        self.username = username
+        self.oauth = oauth
+        self.channels = [channel.lower() for channel in channels]
+        self.width = width
+        self.height = height
+        if room_workers is None:
+            room_workers = max(1, (os.cpu_count() or 1) - ingest_processes)
+        self.ingest_processes = max(1, min(ingest_processes, len(self.channels)))
+        self.room_workers = max(1, min(room_workers, len(self.channels)))
+        self.ingest_options = dict(channels_per_connection=channels_per_connection,
+                                   archive=archive, emotes=bool(options.get('emotes')),
+                                   flush_interval=flush_interval, verbose=verbose)
+        self.stop_timeout = stop_timeout
+        self.options = options
+
+    def run(self):
+        """
+        Start all processes and wait until the connections are closed,
+        a process died or Ctrl-C. A second Ctrl-C kills the processes
+        without waiting for them.
+        """
+        # room i goes to worker i % room_workers
+        rooms = [self.channels[i::self.room_workers] for i in range(self.room_workers)]
+        route = {'#' + channel: i for i, names in enumerate(rooms) for channel in names}
+        # channel i is joined by ingest process i % ingest_processes
+        owners = {channel: i % self.ingest_processes
+                  for i, channel in enumerate(self.channels)}
+        shared = not self.options.get('state_dir')
+        blocks = []
+        if shared:
+            for channel in self.channels:
+                try:
+                    shm = SharedMemory(shm_name(channel), create=True,
+                                       size=self.width * self.height * 3)
+                except FileExistsError:
+                    # left over from a crashed run; start from a blank canvas
+                    SharedMemory(shm_name(channel)).unlink()
+                    shm = SharedMemory(shm_name(channel), create=True,
+                                       size=self.width * self.height * 3)
+                blocks.append(shm)
+        # (worker end, ingest end) by ingest process and worker
+        pipes = [[multiprocessing.Pipe() for _ in rooms]
+                 for _ in range(self.ingest_processes)]
+        workers = [multiprocessing.Process(
+            target=_room_worker, name='room-worker-%d' % i,
+            args=(i, names, pipes, owners, self.width, self.height, shared,
+                  self.options))
+            for i, names in enumerate(rooms)]
+        ingests = [multiprocessing.Process(
+            target=_ingest, name='ingest-%d' % i,
+            args=(i, self.username, self.oauth,
+                  self.channels[i::self.ingest_processes], route, pipes,
+                  (AsyncTwitchChatStream.connect_host, AsyncTwitchChatStream.connect_port),
+                  self.ingest_options))
+            for i in range(self.ingest_processes)]
+        log.info("%d channels, %d ingest processes, %d room workers",
+                 len(self.channels), len(ingests), len(workers))
+        try:
+            for process in workers + ingests:
+                process.start()
+            _close_others(pipes, ())
+            self._watch(ingests, workers)
+        finally:
+            for process in ingests + workers:
+                if process.is_alive():
+                    process.kill()
+                process.join()
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+    def _watch(self, ingests, workers):
+        """
+        Wait for the processes to end. Once one of them fails, or on
+        Ctrl-C, stop the ingest processes; the workers end when their
+        pipes do. Returns when all ended or stop_timeout after stopping.
+        """
+        running = ingests + workers
+        deadline = None
+        while running:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0., deadline - time.monotonic())
+            try:
+                ended = wait([process.sentinel for process in running], timeout)
+            except KeyboardInterrupt:
+                if deadline is not None:
+                    log.warning("Interrupted again, killing the processes")
+                    return
+                log.info("Interrupted, stopping")
+                deadline = self._stop(ingests)
+                continue
+            if not ended:
+                log.warning("%s did not stop in time, killing them",
+                            ', '.join(process.name for process in running))
+                return
+            for process in [process for process in running if process.sentinel in ended]:
+                process.join()
+                running.remove(process)
+                if process.exitcode and deadline is None:
+                    log.error("%s exited with code %s, stopping",
+                              process.name, process.exitcode)
+                    deadline = self._stop(ingests)
+
+    def _stop(self, ingests):
+        for process in ingests:
+            if process.is_alive():
+                process.terminate()
+        return time.monotonic() + self.stop_timeout
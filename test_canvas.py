@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pixel commands from chat applied to a canvas in batches.
+
+    python -m unittest test_canvas
+"""
+import unittest
+
+import numpy as np
+
+from canvas import PixelBatch
+
+
+class Journal(object):
+
+    def __init__(self):
+        self.pixels = []
+
+    def append(self, xs, ys, colors):
+        self.pixels.extend(zip(np.asarray(xs).tolist(), np.asarray(ys).tolist(),
+                               map(tuple, np.asarray(colors).tolist())))
+
+
+class PixelBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.canvas = np.zeros((20, 10, 3), np.uint8)
+
+    def test_last_write_wins(self):
+        batch = PixelBatch()
+        batch.add_message('(1, 2, red) (3, 4) [1, 2, blue]')
+        # enough duplicates that numpy's own order would show
+        for i in range(500):
+            batch.add_message('(5, 5, %s)' % ('red', 'green')[i % 2])
+        batch.add_message('{5, 5, #102030}')
+        journal = Journal()
+        self.assertEqual(batch.apply(self.canvas, journal), (3, 0, (1, 2, 6, 6)))
+        self.assertEqual(list(self.canvas[1, 2]), [0, 0, 255])
+        self.assertEqual(list(self.canvas[3, 4]), [255, 255, 255])
+        self.assertEqual(list(self.canvas[5, 5]), [16, 32, 48])
+        self.assertEqual(sorted(journal.pixels), [(1, 2, (0, 0, 255)), (3, 4, (255, 255, 255)),
+                                                  (5, 5, (16, 32, 48))])
+        self.assertEqual(len(batch), 0)
+
+    def test_bounds(self):
+        batch = PixelBatch()
+        count = batch.add_message('(-1, 0) (20, 0) (0, 10) (999999, 999999) (19, 9, red)')
+        self.assertEqual(count, 5)
+        # more than six digits is no coordinate at all
+        self.assertEqual(batch.add_message('(1234567, 1)'), 0)
+        self.assertEqual(batch.apply(self.canvas), (1, 4, (19, 9, 20, 10)))
+        self.assertEqual(int(np.count_nonzero(self.canvas.any(axis=2))), 1)
+
+    def test_all_rejected(self):
+        batch = PixelBatch()
+        batch.add_message('(20, 10)')
+        self.assertEqual(batch.apply(self.canvas), (0, 1, None))
+        self.assertFalse(self.canvas.any())
+
+    def test_shed_keeps_last_writes(self):
+        batch = PixelBatch(max_commands=8)
+        for i in range(40):
+            batch.add_message('(%d, 0, %s)' % (i % 4, ('red', 'blue')[i // 20]))
+        self.assertLessEqual(len(batch), 8)
+        batch.apply(self.canvas)
+        self.assertEqual(self.canvas[:4, 0].tolist(), [[0, 0, 255]] * 4)
+
+    def test_failing_batch_is_dropped(self):
+        batch = PixelBatch()
+        batch.add_message('(1, 1, red)')
+        # no room for the rgb triples
+        self.assertRaises(ValueError, batch.apply, np.zeros((20, 10, 2), np.uint8))
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(batch.apply(self.canvas), (0, 0, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
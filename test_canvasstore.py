@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Canvas stores coming back after a crash: the pixel log is replayed over
+the last snapshot.
+
+    python -m unittest test_canvasstore
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from canvas import PixelBatch
+from canvasstore import RECORD, CanvasStore
+
+
+class CanvasStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def open(self, **options):
+        return CanvasStore(self.dir, 40, 30, fsync_interval=None, **options)
+
+    def paint(self, store, message):
+        batch = PixelBatch()
+        batch.add_message(message)
+        batch.apply(store.array, journal=store)
+
+    def crash(self, store, name='canvas.bin'):
+        """
+        Stop without a snapshot and lose what the OS had not written of
+        the canvas file since the last one.
+        """
+        store.log.close()
+        path = os.path.join(self.dir, name)
+        size = os.path.getsize(path)
+        with open(path, 'r+b') as f:
+            f.truncate(0)
+            f.truncate(size)
+
+    def test_replay_after_crash(self):
+        store = self.open()
+        self.paint(store, '(1, 2, red) (3, 4, blue)')
+        self.paint(store, '(1, 2, green) rect(10, 10, 12, 11, #010203)')
+        expected = np.array(store.array)
+        self.crash(store)
+        store = self.open()
+        self.assertTrue((np.asarray(store.array) == expected).all())
+        self.assertEqual(list(store.array[1, 2]), [0, 255, 0])
+        self.assertEqual(list(store.array[12, 11]), [1, 2, 3])
+        store.close()
+
+    def test_torn_record(self):
+        store = self.open()
+        self.paint(store, '(1, 2, red)')
+        store.log.write(b'\x05\x00\x00')
+        self.crash(store)
+        store = self.open()
+        self.assertEqual(int(np.count_nonzero(store.array.any(axis=2))), 1)
+        self.assertEqual(list(store.array[1, 2]), [255, 0, 0])
+        store.close()
+
+    def test_replay_is_idempotent(self):
+        store = self.open()
+        self.paint(store, '(1, 2, red)')
+        self.paint(store, '(1, 2, blue)')
+        # the map is already newer than the log
+        store.log.close()
+        store = self.open()
+        self.assertEqual(list(store.array[1, 2]), [0, 0, 255])
+        store.close()
+
+    def test_snapshot_compacts_the_log(self):
+        store = self.open()
+        self.paint(store, '(1, 2, red) (3, 4)')
+        self.assertEqual(store.log_bytes, 2 * RECORD.itemsize)
+        store.snapshot()
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'pixels.0.log')))
+        self.assertEqual(os.path.getsize(os.path.join(self.dir, 'pixels.1.log')), 0)
+        with open(os.path.join(self.dir, 'meta.json')) as f:
+            self.assertEqual(json.load(f)['log'], 1)
+        self.paint(store, '(5, 6, blue)')
+        store.log.close()
+        store = self.open()
+        self.assertEqual(list(store.array[1, 2]), [255, 0, 0])
+        self.assertEqual(list(store.array[5, 6]), [0, 0, 255])
+        store.close()
+
+    def test_size_must_match(self):
+        self.open().close()
+        self.assertRaises(ValueError, CanvasStore, self.dir, 41, 30)
+
+    def test_tiled_replay_after_crash(self):
+        store = self.open(tile=16)
+        self.paint(store, '(1, 2, red) (39, 29, blue)')
+        self.crash(store, 'tiles.bin')
+        os.remove(os.path.join(self.dir, 'tiles.alloc'))
+        store = self.open(tile=16)
+        self.assertEqual(store.array.allocated, 2)
+        self.assertEqual(list(store.array[1, 2]), [255, 0, 0])
+        self.assertEqual(list(store.array[39, 29]), [0, 0, 255])
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The building blocks of the chat streams: framing received bytes into
+lines, and releasing queued lines within Twitch's rate limits.
+
+    python -m unittest test_chat
+"""
+import socket
+import time
+import unittest
+
+from chat import LineFramer, OutboundScheduler, TokenBucket
+
+
+class LineFramerTest(unittest.TestCase):
+
+    def test_lines(self):
+        framer = LineFramer()
+        framer.feed(b'PING :tmi.twitch.tv\r\n\r\nPRIVMSG #a :hi\r\n')
+        self.assertEqual(framer.pop_lines(), ['PING :tmi.twitch.tv', 'PRIVMSG #a :hi'])
+        self.assertEqual(framer.pop_lines(), [])
+
+    def test_split_line(self):
+        framer = LineFramer()
+        framer.feed(b'PRIVMSG #a :(1, ')
+        self.assertEqual(framer.pop_lines(), [])
+        framer.feed(b'2, red)\r')
+        self.assertEqual(framer.pop_lines(), [])
+        framer.feed(b'\nPRIVMSG')
+        self.assertEqual(framer.pop_lines(), ['PRIVMSG #a :(1, 2, red)'])
+        self.assertEqual(framer.take(), b'PRIVMSG')
+        self.assertEqual(framer.take(), b'')
+
+    def test_split_character(self):
+        data = 'PRIVMSG #a :grün ♥ 😀\r\n'.encode('utf-8')
+        for cut in range(1, len(data)):
+            framer = LineFramer()
+            framer.feed(data[:cut])
+            lines = framer.pop_lines()
+            framer.feed(data[cut:])
+            lines += framer.pop_lines()
+            self.assertEqual(lines, ['PRIVMSG #a :grün ♥ 😀'], cut)
+
+    def test_recv_grows_for_long_lines(self):
+        a, b = socket.socketpair()
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        framer = LineFramer(16)
+        line = 'PRIVMSG #a :' + 'é' * 40
+        b.sendall(line.encode('utf-8') + b'\r\nPING')
+        lines = []
+        while not lines:
+            self.assertGreater(framer.recv_from(a), 0)
+            lines = framer.pop_lines()
+        self.assertEqual(lines, [line])
+        self.assertEqual(framer.take(), b'PING')
+
+    def test_feed_grows(self):
+        framer = LineFramer(4)
+        framer.feed(b'x' * 100 + b'\r\n')
+        self.assertEqual(framer.pop_lines(), ['x' * 100])
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_and_refill(self):
+        bucket = TokenBucket(3, 2.)
+        now = bucket.stamp
+        self.assertEqual([bucket.take(now) for _ in range(4)], [True, True, True, False])
+        self.assertAlmostEqual(bucket.wait_time(now), .5)
+        self.assertFalse(bucket.take(now + .25))
+        self.assertAlmostEqual(bucket.wait_time(now + .25), .25)
+        self.assertTrue(bucket.take(now + .5))
+        self.assertFalse(bucket.take(now + .5))
+
+    def test_refill_is_capped(self):
+        bucket = TokenBucket(3, 2.)
+        now = bucket.stamp + 3600
+        self.assertEqual(sum(bucket.take(now) for _ in range(10)), 3)
+
+    def test_time_going_back(self):
+        bucket = TokenBucket(1, 1.)
+        now = bucket.stamp
+        self.assertTrue(bucket.take(now))
+        self.assertFalse(bucket.take(now - 5))
+        self.assertAlmostEqual(bucket.wait_time(now), 1.)
+
+    def test_for_limit(self):
+        bucket = TokenBucket.for_limit(20, 30)
+        self.assertEqual(bucket.capacity, 10)
+        # no window of 30 seconds ever sees more than 20 lines
+        self.assertLessEqual(bucket.capacity + bucket.rate * 30, 20)
+        self.assertEqual(TokenBucket.for_limit(1, 30).capacity, 1)
+
+
+class OutboundSchedulerTest(unittest.TestCase):
+
+    def test_priority(self):
+        scheduler = OutboundScheduler(user_limit=(4, 2))
+        now = time.monotonic()
+        for i in range(3):
+            scheduler.put('PRIVMSG #a :%d' % i)
+        scheduler.put('PONG :tmi.twitch.tv')
+        scheduler.put('JOIN #b')
+        self.assertEqual(len(scheduler), 5)
+        self.assertEqual(scheduler.pop_ready(now), b'PONG :tmi.twitch.tv\r\nJOIN #b\r\n'
+                                                   b'PRIVMSG #a :0\r\nPRIVMSG #a :1\r\n')
+        self.assertAlmostEqual(scheduler.next_due(now), 1., delta=.01)
+        self.assertEqual(scheduler.pop_ready(now), b'')
+        # control lines are not held up by the chat waiting for tokens
+        scheduler.put('PONG :tmi.twitch.tv')
+        self.assertEqual(scheduler.next_due(now), 0.)
+        self.assertEqual(scheduler.pop_ready(now), b'PONG :tmi.twitch.tv\r\n')
+        self.assertEqual(scheduler.pop_ready(now + 1), b'PRIVMSG #a :2\r\n')
+        self.assertIsNone(scheduler.next_due(now + 1))
+
+    def test_join_limit(self):
+        scheduler = OutboundScheduler(join_limit=(2, 10))
+        now = time.monotonic()
+        scheduler.put('JOIN #a')
+        scheduler.put('JOIN #b')
+        scheduler.put('PING :x')
+        self.assertEqual(scheduler.pop_ready(now), b'JOIN #a\r\nPING :x\r\n')
+        self.assertAlmostEqual(scheduler.next_due(now), 10., delta=.01)
+        self.assertEqual(scheduler.pop_ready(now + 10), b'JOIN #b\r\n')
+
+    def test_moderator_channels(self):
+        scheduler = OutboundScheduler(user_limit=(2, 30), moderator_limit=(100, 30))
+        scheduler.moderator_channels.add('mod')
+        now = time.monotonic()
+        for i in range(5):
+            scheduler.put('PRIVMSG #mod :%d' % i)
+        self.assertEqual(scheduler.pop_ready(now).count(b'\r\n'), 5)
+        for i in range(3):
+            scheduler.put('PRIVMSG #other :%d' % i)
+        self.assertEqual(scheduler.pop_ready(now).count(b'\r\n'), 1)
+        self.assertEqual(len(scheduler), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Chat commands driven end to end: a HeadlessBot connected to a
+FakeTwitchServer gets commands in chat and replies to them there.
+
+    python -m unittest test_commands
+"""
+import asyncio
+import time
+import unittest
+
+from chat import AsyncTwitchChatStream
+from commands import CommandDispatcher
+from fakeserver import FakeTwitchServer
+from headless import HeadlessBot
+
+
+class CommandDispatcherTest(unittest.TestCase):
+
+    def test_longest_match(self):
+        commands = CommandDispatcher()
+        commands.register('!canvas', print)
+        commands.register('!canvas top', print)
+        self.assertEqual(commands.match('!canvas top 10'), '!canvas top')
+        self.assertEqual(commands.match('!canvas, please'), '!canvas')
+        self.assertIsNone(commands.match('!canvasses'))
+        self.assertIsNone(commands.match('(1, 2, red)'))
+
+    def test_names_start_with_prefix(self):
+        commands = CommandDispatcher()
+        self.assertRaises(ValueError, commands.register, 'canvas', print)
+        self.assertRaises(ValueError, commands.register, '!', print)
+
+
+class ChatCommandsTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.server = await FakeTwitchServer().start()
+        self.address = AsyncTwitchChatStream.connect_host, AsyncTwitchChatStream.connect_port
+        AsyncTwitchChatStream.connect_host = '127.0.0.1'
+        AsyncTwitchChatStream.connect_port = self.server.port
+
+    async def asyncTearDown(self):
+        AsyncTwitchChatStream.connect_host, AsyncTwitchChatStream.connect_port = self.address
+        await self.server.close()
+
+    async def replies(self, count, timeout=10):
+        deadline = time.monotonic() + timeout
+        while True:
+            replies = [line.split(' :', 1)[1] for line in self.server.received
+                       if line.startswith('PRIVMSG #test ')]
+            if len(replies) >= count or time.monotonic() > deadline:
+                return replies
+            await asyncio.sleep(.01)
+
+    async def run_bot(self, chat, replies, **options):
+        """
+        Send chat to a HeadlessBot in one write.
+        :return: the bot and the first replies it sent
+        """
+        bot = HeadlessBot('bot', 'oauth:test', ['test'], 20, 10,
+                          user_limits=False, **options)
+        runner = asyncio.ensure_future(bot.run())
+        try:
+            await self.server.wait_for_members('test')
+            await self.server.replay('test', iter(chat), [0] * len(chat))
+            return bot, await self.replies(replies)
+        finally:
+            runner.cancel()
+            try:
+                await runner
+            except asyncio.CancelledError:
+                pass
+
+    async def test_colors(self):
+        bot, replies = await self.run_bot([('viewer', '(1, 2, red)'),
+                                           ('viewer', '!colors')], 1)
+        self.assertEqual(len(replies), 1)
+        self.assertTrue(replies[0].startswith('Colors: white, black'))
+        self.assertEqual(list(bot.canvases['test'][1, 2]), [255, 0, 0])
+
+    async def test_canvas_after_paint(self):
+        # one frame a second, so only !canvas itself can have painted
+        # the pixels said right before it
+        bot, replies = await self.run_bot([('viewer', '(1, 2, red)'),
+                                           ('other', 'rect(0, 0, 1, 1, blue)'),
+                                           ('viewer', '!canvas')], 1, fps=1)
+        self.assertEqual(replies, ['20x10 canvas, 5 pixels painted. Paint with (x, y, color), '
+                                   'rect(x0, y0, x1, y1, color), box(...), line(...) or '
+                                   'fill(x, y, color); !colors lists the colors'])
+
+
+if __name__ == '__main__':
+    unittest.main()
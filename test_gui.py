@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The Tk interface with the options python -m twitch --gui passes it.
+Needs a display, skipped without one.
+
+    python -m unittest test_gui
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from urllib.request import urlopen
+
+
+def _has_display():
+    try:
+        import tkinter
+        tkinter.Tk().destroy()
+    except Exception:
+        return False
+    return True
+
+
+@unittest.skipUnless(_has_display(), 'Tk needs a display')
+class InterfaceTest(unittest.TestCase):
+
+    def setUp(self):
+        # launchImage keeps the board and its history in the working
+        # directory
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def launch(self, **options):
+        from gui import Interface
+        gui = Interface(**options)
+        self.addCleanup(gui.totalDestroy)
+        gui.wEntry.insert(0, '64')
+        gui.hEntry.insert(0, '32')
+        gui.launchImage()
+        return gui
+
+    def test_viewer(self):
+        gui = self.launch(viewerPort=0)
+        with urlopen('http://127.0.0.1:%d/canvas/info' % gui.viewer.port, timeout=5) as response:
+            info = json.load(response)
+        self.assertEqual((info['width'], info['height']), (64, 32))
+
+    def test_no_viewer_or_archive(self):
+        gui = self.launch()
+        self.assertIsNone(gui.viewer)
+        self.assertIsNone(gui.archive)
+        self.assertFalse(os.path.exists('chat_archive'))
+
+    def test_archive(self):
+        gui = self.launch(archive='chat')
+        self.assertIsNotNone(gui.archive)
+        self.assertTrue(os.path.isdir('chat'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The IRC line parser on the lines Twitch sends.
+
+    python -m unittest test_ircv3
+"""
+import unittest
+
+from ircv3 import ChatMessage, parse_line
+
+TAGGED = ('@badge-info=;badges=moderator/1,subscriber/12;color=#1E90FF;'
+          'display-name=Foo;emotes=25:0-4,12-16/1902:6-10;id=b34c;'
+          'tmi-sent-ts=1507246572675 :foo!foo@foo.tmi.twitch.tv '
+          'PRIVMSG #bar :Kappa Keepo Kappa (1,2)')
+
+
+class ParseLineTest(unittest.TestCase):
+
+    def test_privmsg(self):
+        msg = parse_line(':foo!foo@foo.tmi.twitch.tv PRIVMSG #bar :hello :) (1,2)')
+        self.assertIsInstance(msg, ChatMessage)
+        self.assertEqual(msg.command, 'PRIVMSG')
+        self.assertEqual(msg.prefix, 'foo!foo@foo.tmi.twitch.tv')
+        self.assertEqual((msg.channel, msg.username, msg.message),
+                         ('#bar', 'foo', 'hello :) (1,2)'))
+        self.assertEqual(msg.params, ['#bar', 'hello :) (1,2)'])
+        self.assertEqual(msg['message'], 'hello :) (1,2)')
+        self.assertIsNone(msg.raw_tags)
+        self.assertEqual(msg.tags, {})
+        self.assertEqual(msg.emotes, {})
+
+    def test_tags(self):
+        msg = parse_line(TAGGED)
+        self.assertEqual((msg.channel, msg.username, msg.message),
+                         ('#bar', 'foo', 'Kappa Keepo Kappa (1,2)'))
+        self.assertEqual(msg.id, 'b34c')
+        self.assertEqual(msg.color, '#1E90FF')
+        self.assertEqual(msg.display_name, 'Foo')
+        self.assertEqual(msg.badges, {'moderator': '1', 'subscriber': '12'})
+        self.assertEqual(msg.emotes, {'25': [(0, 4), (12, 16)], '1902': [(6, 10)]})
+        self.assertEqual(msg.timestamp, 1507246572.675)
+
+    def test_escaped_tag(self):
+        msg = parse_line(r'@system-msg=a\sb\:c\\d :tmi.twitch.tv USERNOTICE #bar')
+        self.assertEqual(msg.tags['system-msg'], 'a b;c\\d')
+        self.assertIsNone(msg.message)
+
+    def test_malformed_emotes(self):
+        msg = parse_line(TAGGED.replace('emotes=25:0-4', 'emotes=25:0-x'))
+        self.assertEqual(msg.emotes, {})
+        self.assertEqual(msg.message, 'Kappa Keepo Kappa (1,2)')
+
+    def test_other_commands(self):
+        ping = parse_line('PING :tmi.twitch.tv')
+        self.assertEqual((ping.command, ping.params), ('PING', ['tmi.twitch.tv']))
+        self.assertIsNone(ping.prefix)
+        join = parse_line(':foo!foo@foo.tmi.twitch.tv JOIN #bar')
+        self.assertEqual((join.command, join.channel, join.username), ('JOIN', '#bar', 'foo'))
+        numeric = parse_line(':tmi.twitch.tv 001 foo :Welcome, GLHF!')
+        self.assertEqual(numeric.params, ['foo', 'Welcome, GLHF!'])
+        # a PRIVMSG that does not fit the fast path
+        odd = parse_line(':foo PRIVMSG #bar')
+        self.assertEqual((odd.command, odd.channel, odd.message), ('PRIVMSG', '#bar', None))
+        self.assertIsNone(parse_line(''))
+
+    def test_constructor(self):
+        msg = ChatMessage('PRIVMSG', ['#bar', 'hi'], 'foo!foo@foo.tmi.twitch.tv')
+        self.assertEqual((msg.channel, msg.username, msg.message), ('#bar', 'foo', 'hi'))
+        self.assertEqual(msg.tags, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
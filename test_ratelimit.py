@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The per-user limits on canvas commands: sliding windows, repeats and
+the bounded table of users.
+
+    python -m unittest test_ratelimit
+"""
+import unittest
+
+from ratelimit import UserRateLimiter
+
+
+class UserRateLimiterTest(unittest.TestCase):
+
+    def test_sliding_window(self):
+        limiter = UserRateLimiter(window=10, max_messages=4, max_pixels=None)
+        self.assertEqual([limiter.allow('a', str(t), now=t) for t in range(1, 6)],
+                         [True, True, True, True, False])
+        # half of the previous window still counts: 2 + 1, 2 + 2, 2 + 3
+        self.assertEqual([limiter.allow('a', str(t), now=15) for t in range(3)],
+                         [True, True, False])
+        # and less of it later on: .8 + 2 + 1
+        self.assertTrue(limiter.allow('a', 'x', now=18))
+        self.assertFalse(limiter.allow('a', 'y', now=18))
+        # other users have their own windows
+        self.assertTrue(limiter.allow('b', 'x', now=18))
+        # a whole window without messages forgets everything
+        self.assertEqual([limiter.allow('a', str(t), now=35) for t in range(5)],
+                         [True, True, True, True, False])
+
+    def test_pixels(self):
+        limiter = UserRateLimiter(window=10, max_messages=None, max_pixels=10)
+        self.assertTrue(limiter.allow('a', 'x', 8, now=0))
+        self.assertFalse(limiter.allow('a', 'y', 3, now=1))
+        self.assertTrue(limiter.allow('a', 'z', 2, now=2))
+        self.assertTrue(limiter.allow('a', 'w', 5, now=15))
+
+    def test_repeats(self):
+        limiter = UserRateLimiter(repeat_seconds=30, max_messages=None, max_pixels=None)
+        self.assertTrue(limiter.allow('a', '(1, 2)', now=0))
+        self.assertFalse(limiter.allow('a', '(1, 2)', now=29))
+        self.assertTrue(limiter.allow('b', '(1, 2)', now=29))
+        self.assertTrue(limiter.allow('a', '(1, 2)', now=30))
+        limiter.repeat_seconds = 0
+        self.assertTrue(limiter.allow('a', '(1, 2)', now=31))
+
+    def test_least_recent_user_is_evicted(self):
+        limiter = UserRateLimiter(window=10, max_messages=1, max_users=2)
+        self.assertTrue(limiter.allow('a', 'x', now=0))
+        self.assertTrue(limiter.allow('b', 'x', now=0))
+        self.assertFalse(limiter.allow('a', 'y', now=1))
+        self.assertTrue(limiter.allow('c', 'x', now=2))
+        self.assertEqual(len(limiter), 2)
+        self.assertEqual(list(limiter.users), ['a', 'c'])
+        # b was forgotten and starts over
+        self.assertTrue(limiter.allow('b', 'y', now=3))
+        self.assertEqual(list(limiter.users), ['c', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TiledCanvas against a plain array: the same writes must give the same
+board.
+
+    python -m unittest test_tiles
+"""
+import unittest
+
+import numpy as np
+
+from canvas import PixelBatch, flood_fill, line, rectangle, stamp
+from tiles import TiledCanvas
+
+WIDTH, HEIGHT = 75, 50
+
+
+class SmallChunks(TiledCanvas):
+    # three 8x8 tiles per chunk, so writes span several chunks
+    chunk_bytes = 3 * 8 * 8 * 3
+
+
+def fixed_pool(tile):
+    """
+    :return: a TiledCanvas on a fixed pool with a written bitmap, the
+        way CanvasStore keeps one
+    """
+    tiles_x, tiles_y = -(-WIDTH // tile), -(-HEIGHT // tile)
+    pool = np.zeros((tiles_x * tiles_y, tile, tile, 3), np.uint8)
+    written = np.zeros((tiles_x, tiles_y), np.uint8)
+    return TiledCanvas(WIDTH, HEIGHT, tile, pool, written)
+
+
+class TiledCanvasTest(unittest.TestCase):
+
+    def canvases(self):
+        return [TiledCanvas(WIDTH, HEIGHT, 16), SmallChunks(WIDTH, HEIGHT, 8),
+                fixed_pool(16)]
+
+    def assertSame(self, tiled, dense):
+        self.assertTrue((np.asarray(tiled) == dense).all())
+
+    def test_pixels(self):
+        rng = np.random.default_rng(1)
+        dense = np.zeros((WIDTH, HEIGHT, 3), np.uint8)
+        xs = rng.integers(0, WIDTH, 500)
+        ys = rng.integers(0, HEIGHT, 500)
+        colors = rng.integers(0, 256, (500, 3), np.uint8)
+        # no duplicates, numpy leaves open which of them wins
+        _, first = np.unique(xs * HEIGHT + ys, return_index=True)
+        xs, ys, colors = xs[first], ys[first], colors[first]
+        dense[xs, ys] = colors
+        for tiled in self.canvases():
+            self.assertEqual(tiled.allocated, 0)
+            self.assertFalse(tiled[xs, ys].any())
+            tiled[xs, ys] = colors
+            self.assertSame(tiled, dense)
+            self.assertTrue((tiled[xs[::-1], ys[::-1]] == colors[::-1]).all())
+
+    def test_blocks(self):
+        rng = np.random.default_rng(2)
+        dense = np.zeros((WIDTH, HEIGHT, 3), np.uint8)
+        tileds = self.canvases()
+        for _ in range(30):
+            x0, x1 = sorted(rng.integers(0, WIDTH + 1, 2))
+            y0, y1 = sorted(rng.integers(0, HEIGHT + 1, 2))
+            sx, sy = rng.integers(1, 4, 2)
+            key = slice(x0, x1, sx), slice(y0, y1, sy)
+            block = rng.integers(0, 256, dense[key].shape, np.uint8)
+            dense[key] = block
+            for tiled in tileds:
+                tiled[key] = block
+                self.assertTrue((tiled[key] == dense[key]).all())
+        for tiled in tileds:
+            self.assertSame(tiled, dense)
+            self.assertTrue((tiled[::3, 1::7] == dense[::3, 1::7]).all())
+
+    def test_drawing(self):
+        dense = np.zeros((WIDTH, HEIGHT, 3), np.uint8)
+        sprite = (np.full((20, 20, 3), 7, np.uint8), np.eye(20, dtype=bool))
+        batch = PixelBatch()
+        for canvas in [dense] + self.canvases():
+            rectangle(canvas, 5, 5, 40, 30, (255, 0, 0))
+            rectangle(canvas, 10, 2, 70, 45, (0, 255, 0), outline=True)
+            line(canvas, 0, 49, 74, 0, (0, 0, 255))
+            stamp(canvas, sprite, 60, 40)
+            flood_fill(canvas, 20, 20, (1, 2, 3), 64)
+            batch.add_message('(0, 0, red) (74, 49, #abcdef) (12, 12, white)')
+            batch.apply(canvas)
+            if canvas is not dense:
+                self.assertSame(canvas, dense)
+
+    def test_only_written_tiles_are_allocated(self):
+        for tiled in self.canvases():
+            tiled[np.array([0, 1, 74]), np.array([0, 1, 49])] = (1, 1, 1)
+            self.assertEqual(tiled.allocated, 2)
+            self.assertEqual(tiled.nbytes, 2 * tiled.tile * tiled.tile * 3)
+            tiled[16:18, 0:40] = (2, 2, 2)
+            self.assertEqual(tiled.allocated, 2 + -(-40 // tiled.tile))
+
+    def test_written_bitmap(self):
+        tiled = fixed_pool(16)
+        tiled[np.array([20]), np.array([40])] = (9, 9, 9)
+        self.assertEqual(np.argwhere(tiled.written).tolist(), [[1, 2]])
+        # a canvas on the same pool and bitmap picks up where it left off
+        reopened = TiledCanvas(WIDTH, HEIGHT, 16, tiled.chunks[0], tiled.written)
+        self.assertEqual(reopened.allocated, 1)
+        self.assertEqual(list(reopened[20:21, 40:41][0, 0]), [9, 9, 9])
+
+    def test_tile_size(self):
+        self.assertRaises(ValueError, TiledCanvas, WIDTH, HEIGHT, 24)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A canvas made of square uint8 RGB tiles, for boards far larger than what
+is ever painted or shown at once. Tiles live in a pool of arrays and a
+small table maps tile coordinates to pool slots, so reads and writes of
+scattered pixels stay fancy-indexed NumPy operations (one per chunk of
+the pool touched); a tile is only allocated when something is first
+written into it, and reading one that was never written gives black.
+The pool grows by adding chunks, so it is never copied.
+
+TiledCanvas indexes like the [x][y][rgb] arrays the rest of the bot
+uses, as far as PixelBatch, stamp and CanvasStore need it:
+
+    canvas[xs, ys] = colors        # index arrays
+    colors = canvas[xs, ys]
+    block = canvas[x0:x1, y0:y1]   # a copy, slices may have a step
+    canvas[x0:x1, y0:y1] = block
+
+np.asarray(canvas) builds the whole board as one array, which is only
+sensible for small ones.
+"""
+import numpy as np
+
+
+class TiledCanvas(object):
+    """
+    :param width: board width in pixels
+    :param height: board height in pixels
+    :param tile: tile size, a power of two
+    :param pool: optional array of shape (tiles_x * tiles_y, tile, tile,
+        3) holding every tile, tile (tx, ty) at tx * tiles_y + ty, e.g.
+        a memory map (see CanvasStore); by default tiles are allocated in
+        memory on first write
+    :param written: optional uint8 array of shape (tiles_x, tiles_y)
+        going with pool, nonzero for the tiles that were written, and
+        kept up to date as more are. Without it every tile of the pool
+        counts as written
+    """
+
+    # bytes per chunk of the in-memory pool
+    chunk_bytes = 16 << 20
+
+    def __init__(self, width, height, tile=128, pool=None, written=None):
+        if tile & (tile - 1):
+            raise ValueError('tile size %d is not a power of two' % tile)
+        self.width = width
+        self.height = height
+        self.tile = tile
+        self.shift = tile.bit_length() - 1
+        self.tiles_x = -(-width // tile)
+        self.tiles_y = -(-height // tile)
+        self.written = written
+        if pool is None:
+            self.table = np.full((self.tiles_x, self.tiles_y), -1, np.int32)
+            self.chunk_tiles = max(1, self.chunk_bytes // (tile * tile * 3))
+            self.chunks = []
+        else:
+            # every tile has its slot in the pool, the table only tells
+            # which of them were written
+            self.table = np.arange(self.tiles_x * self.tiles_y, dtype=np.int32).reshape(
+                self.tiles_x, self.tiles_y)
+            if written is not None:
+                self.table[written == 0] = -1
+            self.chunk_tiles = len(pool)
+            self.chunks = [pool]
+        self.allocated = int(np.count_nonzero(self.table >= 0))
+
+    @property
+    def shape(self):
+        return (self.width, self.height, 3)
+
+    @property
+    def dtype(self):
+        return np.dtype(np.uint8)
+
+    @property
+    def nbytes(self):
+        """
+        Bytes of the allocated tiles.
+        """
+        return self.allocated * self.tile * self.tile * 3
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[0:self.width, 0:self.height]
+        return array if dtype is None else array.astype(dtype)
+
+    def flush(self):
+        for chunk in self.chunks + [self.written]:
+            if hasattr(chunk, 'flush'):
+                chunk.flush()
+
+    def _allocate(self, txs, tys):
+        """
+        Give the listed tiles a slot in the pool where they have none.
+        """
+        missing = self.table[txs, tys] < 0
+        if not missing.any():
+            return
+        keys = np.unique(txs[missing] * self.tiles_y + tys[missing])
+        if self.written is not None:
+            # a fixed pool: the slot is there, mark it written
+            self.table[keys // self.tiles_y, keys % self.tiles_y] = keys
+            self.written[keys // self.tiles_y, keys % self.tiles_y] = 1
+            self.allocated += len(keys)
+            return
+        n = self.allocated + len(keys)
+        while n > len(self.chunks) * self.chunk_tiles:
+            self.chunks.append(np.zeros(
+                (self.chunk_tiles, self.tile, self.tile, 3), np.uint8))
+        self.table[keys // self.tiles_y, keys % self.tiles_y] = np.arange(
+            self.allocated, n, dtype=np.int32)
+        self.allocated = n
+
+    def _ranges(self, key):
+        xs, ys = key
+        return (range(*xs.indices(self.width)), range(*ys.indices(self.height)))
+
+    def __getitem__(self, key):
+        xs, ys = key
+        if isinstance(xs, slice):
+            return self._read_block(*self._ranges(key))
+        xs = np.asarray(xs)
+        ys = np.asarray(ys)
+        if not self.allocated:
+            return np.zeros(xs.shape + (3,), np.uint8)
+        slots = self.table[xs >> self.shift, ys >> self.shift]
+        colors = np.zeros(xs.shape + (3,), np.uint8)
+        for chunk, which, index in self._by_chunk(slots, xs, ys):
+            colors[which] = chunk[index]
+        return colors
+
+    def __setitem__(self, key, colors):
+        xs, ys = key
+        if isinstance(xs, slice):
+            self._write_block(*self._ranges(key), colors)
+            return
+        xs = np.asarray(xs)
+        ys = np.asarray(ys)
+        txs = xs >> self.shift
+        tys = ys >> self.shift
+        self._allocate(txs, tys)
+        colors = np.broadcast_to(np.asarray(colors, np.uint8), xs.shape + (3,))
+        for chunk, which, index in self._by_chunk(self.table[txs, tys], xs, ys):
+            chunk[index] = colors[which]
+
+    def _by_chunk(self, slots, xs, ys):
+        """
+        :return: list of (chunk, which, index) for the chunks the pixels
+            at xs, ys in the given slots are in (slots < 0 are left
+            out), which selects those pixels and index them in the chunk
+        """
+        mask = self.tile - 1
+        if len(self.chunks) == 1 and (slots >= 0).all():
+            return [(self.chunks[0], Ellipsis, (slots, xs & mask, ys & mask))]
+        result = []
+        numbers = np.where(slots >= 0, slots // self.chunk_tiles, -1)
+        for number in np.unique(numbers):
+            if number >= 0:
+                which = numbers == number
+                result.append((self.chunks[number], which, (
+                    slots[which] % self.chunk_tiles, xs[which] & mask, ys[which] & mask)))
+        return result
+
+    def _tile(self, slot):
+        return self.chunks[slot // self.chunk_tiles][slot % self.chunk_tiles]
+
+    def _tile_runs(self, coords):
+        """
+        Split a range of coordinates at the tile borders.
+        :return: list of (tile, start, end, local) where coords[start:end]
+            lie in that tile at the local slice of it
+        """
+        mask = self.tile - 1
+        runs = []
+        start = 0
+        while start < len(coords):
+            first = coords[start]
+            tile = first >> self.shift
+            # how many coordinates of the range are left in this tile
+            end = min(start + (((tile + 1) << self.shift) - first - 1) // coords.step + 1,
+                      len(coords))
+            last = coords[end - 1]
+            runs.append((tile, start, end, slice(first & mask, (last & mask) + 1, coords.step)))
+            start = end
+        return runs
+
+    def _read_block(self, xs, ys):
+        block = np.zeros((len(xs), len(ys), 3), np.uint8)
+        if not self.allocated or not len(xs) or not len(ys):
+            return block
+        x_runs = self._tile_runs(xs)
+        y_runs = self._tile_runs(ys)
+        # only visit the tiles that were written
+        slots = self.table[np.ix_([run[0] for run in x_runs], [run[0] for run in y_runs])]
+        for i, j in zip(*np.nonzero(slots >= 0)):
+            _, x0, x1, lx = x_runs[i]
+            _, y0, y1, ly = y_runs[j]
+            block[x0:x1, y0:y1] = self._tile(slots[i, j])[lx, ly]
+        return block
+
+    def _write_block(self, xs, ys, block):
+        if not len(xs) or not len(ys):
+            return
+        block = np.broadcast_to(np.asarray(block, np.uint8), (len(xs), len(ys), 3))
+        x_runs = self._tile_runs(xs)
+        y_runs = self._tile_runs(ys)
+        self._allocate(np.array([run[0] for run in x_runs]).repeat(len(y_runs)),
+                       np.tile([run[0] for run in y_runs], len(x_runs)))
+        for tx, x0, x1, lx in x_runs:
+            for ty, y0, y1, ly in y_runs:
+                self._tile(self.table[tx, ty])[lx, ly] = block[x0:x1, y0:y1]
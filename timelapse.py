@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Canvas history for timelapses. A TimelapseRecorder is the journal
+PixelBatch.apply writes to (in front of a CanvasStore, if any): it
+collects the pixels painted during each frame_interval and appends them
+to a .tlp file as one delta frame, the changed pixels only, each once
+with its last color. Every keyframe_interval, and whenever recording
+starts, a full copy of the canvas is appended as a keyframe. Frames are
+compressed and written by a thread of the recorder, so painting only
+pays for collecting the pixels and copying the canvas. The file is
+append-only:
+
+    header   b'TLAPSE1\\n', width and height as uint32
+    frames   time (float64), kind (0 key, 1 delta), pixel count and
+             payload length (uint32), zlib compressed payload
+
+A delta payload holds the sorted flat pixel indices, stored as the
+differences between neighbours and byte-shuffled so they compress to
+almost nothing, followed by the colors. A keyframe payload is the
+canvas bytes.
+
+The exporter replays the file from a keyframe, applying one delta after
+the other to a single array, and hands the frames to worker processes
+for encoding:
+
+    python timelapse.py canvas.tlp timelapse.gif --speed 120
+    python timelapse.py canvas.tlp timelapse.png          (APNG)
+    python timelapse.py canvas.tlp frames/%05d.png        (PNG sequence)
+"""
+import argparse
+import logging
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import deque
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'TLAPSE1\n'
+HEADER = struct.Struct('<II')
+FRAME = struct.Struct('<dBII')
+KEYFRAME, DELTA = 0, 1
+
+
+def _encode_delta(indices, colors):
+    diffs = np.diff(indices, prepend=np.uint32(0)).astype('<u4')
+    shuffled = diffs.view(np.uint8).reshape(-1, 4).T.tobytes()
+    return zlib.compress(shuffled + colors.tobytes())
+
+
+def _decode_delta(payload, count):
+    data = zlib.decompress(payload)
+    diffs = np.frombuffer(data, np.uint8, 4 * count).reshape(4, count).T.copy()
+    indices = np.cumsum(diffs.view('<u4').ravel(), dtype=np.int64)
+    colors = np.frombuffer(data, np.uint8, 3 * count, 4 * count).reshape(count, 3)
+    return indices, colors
+
+
+def _read_header(f, path):
+    magic = f.read(len(MAGIC))
+    if magic != MAGIC:
+        raise ValueError('%s is not a timelapse file' % path)
+    return HEADER.unpack(f.read(HEADER.size))
+
+
+def _scan(f):
+    """
+    Walk the frame headers of an open file, after the file header.
+    :return: iterator over (time, kind, count, payload offset, length)
+        of the complete frames
+    """
+    end = os.fstat(f.fileno()).st_size
+    offset = f.tell()
+    while offset + FRAME.size <= end:
+        f.seek(offset)
+        t, kind, count, length = FRAME.unpack(f.read(FRAME.size))
+        if offset + FRAME.size + length > end:
+            break
+        yield t, kind, count, offset + FRAME.size, length
+        offset += FRAME.size + length
+    f.seek(offset)
+
+
+class TimelapseRecorder(object):
+    """
+    Records the changes of one canvas, see the module docstring. Pass it
+    as the journal of PixelBatch.apply.
+    :param path: the .tlp file, appended to when it exists
+    :param canvas: the canvas array, for keyframes
+    :param journal: optional journal (e.g. a CanvasStore) every append
+        is passed on to first
+    :param frame_interval: seconds of painting collected into one frame
+    :param keyframe_interval: seconds between keyframes
+    :raise ValueError: for a canvas of 2**32 pixels or more, whose pixel
+        indices the file cannot hold
+    """
+
+    def __init__(self, path, canvas, journal=None, frame_interval=1.,
+                 keyframe_interval=3600):
+        self.path = path
+        self.canvas = canvas
+        self.journal = journal
+        self.frame_interval = frame_interval
+        self.keyframe_interval = keyframe_interval
+        width, height = canvas.shape[:2]
+        if width * height >= 1 << 32:
+            raise ValueError('%dx%d is too large for a timelapse' % (width, height))
+        if os.path.exists(path) and os.path.getsize(path):
+            self.file = open(path, 'r+b')
+            if _read_header(self.file, path) != (width, height):
+                self.file.close()
+                raise ValueError('%s records a different canvas size than %dx%d' % (
+                    path, width, height))
+            for _ in _scan(self.file):
+                pass
+            # a frame torn by a crash would hide everything after it
+            self.file.truncate()
+        else:
+            self.file = open(path, 'wb')
+            self.file.write(MAGIC + HEADER.pack(width, height))
+        self.xs = []
+        self.ys = []
+        self.colors = []
+        # one thread, so frames are written in the order they were taken
+        self.writer = ThreadPoolExecutor(1, thread_name_prefix='timelapse')
+        self.frame_started = time.monotonic()
+        self._keyframe(time.time())
+
+    def _keyframe(self, now):
+        # a copy, the canvas is painted on while the thread compresses
+        self._submit(self._write_keyframe, now, np.array(self.canvas))
+        self.last_keyframe = time.monotonic()
+
+    def _write_keyframe(self, now, canvas):
+        self._write(now, KEYFRAME, canvas.shape[0] * canvas.shape[1],
+                    zlib.compress(canvas.tobytes()))
+
+    def _write_delta(self, now, indices, colors):
+        # the last write of every pixel, in index order
+        indices, last = np.unique(indices[::-1], return_index=True)
+        colors = colors[::-1][last]
+        self._write(now, DELTA, len(indices),
+                    _encode_delta(indices.astype(np.uint32), colors))
+
+    def _write(self, now, kind, count, data):
+        self.file.write(FRAME.pack(now, kind, count, len(data)) + data)
+        self.file.flush()
+
+    def _submit(self, function, *args):
+        self.writer.submit(function, *args).add_done_callback(_log_failure)
+
+    def append(self, xs, ys, colors):
+        """
+        Record pixels that were just written to the canvas, in order.
+        """
+        if self.journal is not None:
+            self.journal.append(xs, ys, colors)
+        self.xs.append(np.asarray(xs, np.uint32))
+        self.ys.append(np.asarray(ys, np.uint32))
+        self.colors.append(np.asarray(colors, np.uint8))
+        self.painted = time.time()
+        if time.monotonic() - self.frame_started >= self.frame_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the pixels collected so far as a frame.
+        """
+        self.frame_started = now = time.monotonic()
+        if self.xs:
+            indices = (np.concatenate(self.xs).astype(np.int64) * self.canvas.shape[1]
+                       + np.concatenate(self.ys))
+            colors = np.concatenate(self.colors)
+            self.xs, self.ys, self.colors = [], [], []
+            self._submit(self._write_delta, self.painted, indices, colors)
+        if now - self.last_keyframe >= self.keyframe_interval:
+            self._keyframe(time.time())
+
+    def close(self):
+        self.flush()
+        self.writer.shutdown()
+        self.file.close()
+
+
+def _log_failure(future):
+    error = future.exception()
+    if error is not None:
+        log.error("Could not record a timelapse frame: %s", error)
+
+
+def replay(path, start=None, end=None):
+    """
+    Rebuild the canvas frame by frame.
+    :param path: the .tlp file
+    :param start: skip to this time (seconds since the epoch), decoding
+        from the last keyframe before it
+    :param end: stop at this time
+    :return: iterator over (time, canvas) after every frame; the canvas
+        is the same array each time, updated in place
+    """
+    with open(path, 'rb') as f:
+        width, height = _read_header(f, path)
+        frames = list(_scan(f))
+        first = 0
+        for i, (t, kind, _, _, _) in enumerate(frames):
+            if kind == KEYFRAME and (start is None or t <= start):
+                first = i
+                if start is None:
+                    break
+        canvas = np.zeros((width, height, 3), np.uint8)
+        flat = canvas.reshape(-1, 3)
+        for t, kind, count, offset, length in frames[first:]:
+            if end is not None and t > end:
+                break
+            f.seek(offset)
+            payload = f.read(length)
+            if kind == KEYFRAME:
+                canvas[...] = np.frombuffer(zlib.decompress(payload), np.uint8).reshape(
+                    width, height, 3)
+            else:
+                indices, colors = _decode_delta(payload, count)
+                flat[indices] = colors
+            if start is None or t >= start:
+                yield t, canvas
+
+
+def _frames(path, speed, fps, max_gap, start=None, end=None):
+    """
+    :return: iterator over copies of the canvas, one per output frame;
+        stream time runs `speed` times faster than the output and gaps
+        in the recording are cut to max_gap seconds
+    """
+    step = speed / float(fps)
+    clock = None  # stream time with the gaps cut out
+    previous = None
+    next_frame = None
+    for t, canvas in replay(path, start, end):
+        if clock is None:
+            clock = next_frame = t
+        else:
+            clock += min(t - previous, max_gap)
+        previous = t
+        while next_frame <= clock:
+            yield canvas.copy()
+            next_frame += step
+    if clock is not None and next_frame - step < clock:
+        yield canvas.copy()
+
+
+def _encode(canvas, scale, mode, path=None):
+    """
+    Encode one frame completely, in a pool worker.
+    :return: the frame as a GIF or PNG file of its own, None when
+        written to path
+    """
+    from PIL import Image
+    image = Image.fromarray(canvas.swapaxes(0, 1))
+    if scale != 1:
+        image = image.resize((image.width * scale, image.height * scale), Image.NEAREST)
+    if path is not None:
+        image.save(path, compress_level=1)
+        return None
+    out = BytesIO()
+    if mode == 'gif':
+        image.quantize(method=Image.FASTOCTREE).save(out, 'GIF')
+    else:
+        image.save(out, 'PNG', compress_level=1)
+    return out.getvalue()
+
+
+def _png_chunks(data):
+    """
+    :return: list of (type, body) of a PNG file's chunks
+    """
+    chunks = []
+    pos = 8
+    while pos < len(data):
+        length, kind = struct.unpack('>I4s', data[pos:pos + 8])
+        chunks.append((kind, data[pos + 8:pos + 8 + length]))
+        pos += 12 + length
+    return chunks
+
+
+def _png_chunk(kind, body):
+    return (struct.pack('>I', len(body)) + kind + body
+            + struct.pack('>I', zlib.crc32(kind + body)))
+
+
+class _ApngWriter(object):
+    """
+    Joins PNG files of the same size into an APNG as they come, keeping
+    only the file open: their IDAT chunks are copied, not decoded.
+    """
+
+    def __init__(self, path, fps):
+        self.file = open(path, 'wb')
+        self.fps = fps
+        self.frames = 0
+        self.sequence = 0
+
+    def add(self, data):
+        chunks = _png_chunks(data)
+        header = [body for kind, body in chunks if kind == b'IHDR'][0]
+        if not self.frames:
+            self.file.write(data[:8] + _png_chunk(b'IHDR', header))
+            # the frame count is only known at the end
+            self.actl = self.file.tell()
+            self.file.write(_png_chunk(b'acTL', struct.pack('>II', 0, 0)))
+        width, height = struct.unpack('>II', header[:8])
+        self.file.write(_png_chunk(b'fcTL', struct.pack(
+            '>IIIIIHHBB', self.sequence, width, height, 0, 0, 1, self.fps, 0, 0)))
+        self.sequence += 1
+        for kind, body in chunks:
+            if kind != b'IDAT':
+                continue
+            if not self.frames:
+                self.file.write(_png_chunk(b'IDAT', body))
+            else:
+                self.file.write(_png_chunk(b'fdAT', struct.pack('>I', self.sequence) + body))
+                self.sequence += 1
+        self.frames += 1
+
+    def close(self):
+        if self.frames:
+            self.file.write(_png_chunk(b'IEND', b''))
+            self.file.seek(self.actl)
+            self.file.write(_png_chunk(b'acTL', struct.pack('>II', self.frames, 0)))
+        self.file.close()
+
+
+def _gif_blocks(data, pos):
+    # the end of a run of GIF data sub-blocks starting at pos
+    while data[pos]:
+        pos += data[pos] + 1
+    return pos + 1
+
+
+class _GifWriter(object):
+    """
+    Joins single-frame GIF files of the same size into an animated GIF
+    as they come, each frame keeping its own palette as a local color
+    table; the LZW data is copied, not decoded.
+    """
+
+    def __init__(self, path, fps):
+        self.file = open(path, 'wb')
+        self.delay = max(1, int(round(100. / fps)))
+        self.frames = 0
+
+    def add(self, data):
+        width, height, flags = struct.unpack('<HHB', data[6:11])
+        pos = 13
+        table = b''
+        bits = 0
+        if flags & 0x80:
+            bits = flags & 7
+            table = data[pos:pos + 3 * (2 << bits)]
+            pos += len(table)
+        while data[pos] == 0x21:  # extensions
+            pos = _gif_blocks(data, pos + 2)
+        left, top, w, h, image_flags = struct.unpack('<HHHHB', data[pos + 1:pos + 10])
+        pos += 10
+        if image_flags & 0x80:
+            bits = image_flags & 7
+            table = data[pos:pos + 3 * (2 << bits)]
+            pos += len(table)
+        # LZW minimum code size, then the data sub-blocks
+        lzw = data[pos:_gif_blocks(data, pos + 1)]
+        if not self.frames:
+            self.file.write(b'GIF89a' + struct.pack('<HHBBB', width, height, 0, 0, 0)
+                            + b'\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00')
+        # graphic control: leave the previous frame in place, the delay
+        self.file.write(b'\x21\xf9\x04\x04' + struct.pack('<H', self.delay) + b'\x00\x00')
+        # a local color table, interlaced if the frame was
+        self.file.write(b'\x2c' + struct.pack('<HHHHB', left, top, w, h,
+                                               0x80 | image_flags & 0x40 | bits)
+                        + table + lzw)
+        self.frames += 1
+
+    def close(self):
+        if self.frames:
+            self.file.write(b'\x3b')
+        self.file.close()
+
+
+def export(path, out, speed=60., fps=20, scale=1, max_gap=10., workers=None,
+           start=None, end=None):
+    """
+    Write a timelapse of a .tlp file. Frames are encoded completely in
+    worker processes; this process only replays the recording and
+    copies the encoded frames into the output as they come, so memory
+    does not grow with the length of the timelapse.
+    :param path: the .tlp file
+    :param out: a .gif or .png (APNG) file, or a pattern with a
+        %-format for the frame number to write a PNG sequence
+        ('frames/%05d.png')
+    :param speed: seconds of stream per second of timelapse
+    :param fps: frames per second of the timelapse
+    :param scale: enlarge every pixel to scale x scale
+    :param max_gap: longer pauses in the recording are cut to this many
+        seconds of stream time
+    :param workers: processes encoding frames, default one per core
+    :param start: first moment to show, seconds since the epoch
+    :param end: last moment to show
+    :return: number of frames written
+    """
+    sequence = '%' in out
+    mode = 'png' if sequence else os.path.splitext(out)[1].lower().lstrip('.')
+    if mode not in ('gif', 'png', 'apng'):
+        raise ValueError('cannot write %s, use .gif, .png or a %%-pattern' % out)
+    workers = workers or os.cpu_count() or 1
+    writer = None
+    if not sequence:
+        writer = (_GifWriter if mode == 'gif' else _ApngWriter)(out, fps)
+    n = 0
+    try:
+        with ProcessPoolExecutor(workers) as pool:
+            pending = deque()
+            for canvas in _frames(path, speed, fps, max_gap, start, end):
+                pending.append(pool.submit(_encode, canvas, scale, mode,
+                                           out % n if sequence else None))
+                n += 1
+                # frames are written in order and only a few wait at a time
+                while len(pending) >= 2 * workers:
+                    data = pending.popleft().result()
+                    if writer is not None:
+                        writer.add(data)
+            while pending:
+                data = pending.popleft().result()
+                if writer is not None:
+                    writer.add(data)
+    finally:
+        if writer is not None:
+            writer.close()
+    return n
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export a timelapse of a recorded canvas')
+    parser.add_argument('path', help='the .tlp file')
+    parser.add_argument('out', help='.gif, .png (animated) or a pattern like frames/%%05d.png')
+    parser.add_argument('--speed', type=float, default=60,
+                        help='seconds of stream per second of timelapse')
+    parser.add_argument('--fps', type=int, default=20)
+    parser.add_argument('--scale', type=int, default=1, help='enlarge pixels')
+    parser.add_argument('--max-gap', type=float, default=10,
+                        help='cut pauses in the recording to this many seconds')
+    parser.add_argument('--workers', type=int, help='encoding processes')
+    parser.add_argument('--since', type=float,
+                        help='only the last this many seconds')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    started = time.monotonic()
+    frames = export(args.path, args.out, args.speed, args.fps, args.scale,
+                    args.max_gap, args.workers,
+                    time.time() - args.since if args.since else None)
+    log.info("Wrote %d frames to %s in %.1fs", frames, args.out,
+             time.monotonic() - started)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
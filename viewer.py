@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Live view of the canvases in a browser, served from a daemon thread:
+
+    python -m twitch ... --viewer-port 8080
+    http://localhost:8080/
+
+The canvas is served as PNG tiles, /<name>/tile/<tx>/<ty>.png. Every
+tile has a version, bumped whenever a pixel in it is painted, which is
+its ETag: a tile is encoded at most once per version, whoever asks for
+it, and a browser that has the current version gets a 304. Changes are
+pushed over Server-Sent Events from /<name>/events: the pixels painted
+since the last event, every `interval` seconds, encoded once and written
+to every viewer as they are. When too many pixels changed at once, the
+event lists the changed tiles instead and viewers fetch those again.
+
+A CanvasFeed learns about the painted pixels by being the journal of
+PixelBatch.apply, in front of the recorder or store (if any):
+
+    viewer = CanvasViewer(8080)
+    feed = viewer.add('somechannel', canvas, journal=store)
+    batch.apply(canvas, feed)
+"""
+import base64
+import json
+import logging
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+import numpy as np
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+TILES_ENCODED = REGISTRY.counter('viewer_tiles_encoded_total', 'Canvas tiles encoded as PNG for the viewer')
+TILES_NOT_MODIFIED = REGISTRY.counter('viewer_tiles_not_modified_total', 'Tile requests answered with 304')
+EVENTS_SENT = REGISTRY.counter('viewer_events_total', 'Change events published to viewers')
+VIEWERS = REGISTRY.gauge('viewer_connections', 'Viewers connected to an event stream')
+
+
+class CanvasFeed(object):
+    """
+    The tiles, tile versions and change events of one canvas.
+    :param canvas: the canvas array (or TiledCanvas)
+    :param tile: tile size in pixels
+    :param journal: optional journal (e.g. a CanvasStore or
+        TimelapseRecorder) every append is passed on to first
+    :param max_event_pixels: events with more changed pixels list the
+        changed tiles instead
+    :param backlog: events kept for viewers that fall behind; one that
+        falls further behind is told to reload
+    """
+
+    def __init__(self, canvas, tile=256, journal=None, max_event_pixels=50000,
+                 backlog=256):
+        self.canvas = canvas
+        self.tile = tile
+        self.journal = journal
+        self.max_event_pixels = max_event_pixels
+        self.width, self.height = canvas.shape[:2]
+        self.versions = np.zeros((-(-self.width // tile), -(-self.height // tile)), np.int64)
+        self.version = 0
+        # (version, png) by tile, filled on request
+        self.tiles = {}
+        self.encoding = threading.Lock()
+        self.lock = threading.Lock()
+        self.xs = []
+        self.ys = []
+        self.colors = []
+        # (number, event bytes); viewers wait on published for new ones
+        self.events = deque(maxlen=backlog)
+        self.published = threading.Condition()
+        self.last_event = 0
+        self.viewers = 0
+
+    def append(self, xs, ys, colors):
+        """
+        Take note of pixels that were just written to the canvas.
+        """
+        if self.journal is not None:
+            self.journal.append(xs, ys, colors)
+        xs = np.asarray(xs, np.int64)
+        ys = np.asarray(ys, np.int64)
+        with self.lock:
+            self.version += 1
+            self.versions[xs // self.tile, ys // self.tile] = self.version
+            self.xs.append(xs)
+            self.ys.append(ys)
+            self.colors.append(np.asarray(colors, np.uint8))
+
+    def etag(self, tx, ty):
+        return '"%s-%d"' % (CanvasViewer.started, self.versions[tx, ty])
+
+    def png(self, tx, ty):
+        """
+        :return: (etag, PNG bytes) of a tile, encoded again only when it
+            changed since the last request
+        """
+        with self.encoding:
+            version = int(self.versions[tx, ty])
+            cached = self.tiles.get((tx, ty))
+            if cached is not None and cached[0] == version:
+                return self.etag(tx, ty), cached[1]
+            from PIL import Image # only needed when serving tiles
+            x0, y0 = tx * self.tile, ty * self.tile
+            block = self.canvas[x0:min(x0 + self.tile, self.width),
+                                y0:min(y0 + self.tile, self.height)]
+            out = BytesIO()
+            Image.fromarray(np.ascontiguousarray(block.swapaxes(0, 1))).save(
+                out, 'PNG', compress_level=1)
+            data = out.getvalue()
+            # painted while encoding: the next request encodes it again
+            self.tiles[tx, ty] = (version, data)
+            TILES_ENCODED.inc()
+            return '"%s-%d"' % (CanvasViewer.started, version), data
+
+    def publish(self):
+        """
+        Turn the pixels painted since the last call into an event.
+        """
+        with self.lock:
+            if not self.xs:
+                return
+            xs, ys, colors = self.xs, self.ys, self.colors
+            self.xs, self.ys, self.colors = [], [], []
+        if not self.viewers:
+            # nobody to tell, but a viewer resuming later has to notice
+            # that it missed something
+            with self.published:
+                self.last_event += 1
+                self.events.clear()
+            return
+        indices = np.concatenate(xs) * self.height + np.concatenate(ys)
+        colors = np.concatenate(colors)
+        # the last write of every pixel
+        indices, last = np.unique(indices[::-1], return_index=True)
+        if len(indices) > self.max_event_pixels:
+            tiles = np.unique(np.stack([indices // self.height // self.tile,
+                                        indices % self.height // self.tile], 1), axis=0)
+            event = 'event: tiles\ndata: %s\n\n' % ' '.join(
+                '%d,%d' % (tx, ty) for tx, ty in tiles.tolist())
+        else:
+            data = indices.astype('<u4').tobytes() + colors[::-1][last].tobytes()
+            event = 'event: pixels\ndata: %d %s\n\n' % (
+                len(indices), base64.b64encode(data).decode('ascii'))
+        with self.published:
+            self.last_event += 1
+            self.events.append((self.last_event, event.encode('ascii')))
+            self.published.notify_all()
+        EVENTS_SENT.inc()
+
+    def events_after(self, number, timeout):
+        """
+        Wait for events newer than number.
+        :return: list of (number, event bytes), empty after the timeout,
+            None when the ones right after number were dropped already
+        """
+        with self.published:
+            self.published.wait_for(lambda: self.last_event > number, timeout)
+            if self.last_event <= number:
+                return []
+            if not self.events or self.events[0][0] > number + 1:
+                return None
+            return [event for event in self.events if event[0] > number]
+
+
+PAGE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>%(name)s</title>
+<style>body{margin:0;background:#222}
+canvas{image-rendering:pixelated;width:%(width)dpx;max-width:100%%}</style></head>
+<body><canvas id="c" width="%(width)d" height="%(height)d"></canvas><script>
+const W=%(width)d, H=%(height)d, T=%(tile)d;
+const ctx=document.getElementById('c').getContext('2d');
+function tile(tx,ty,v){
+  return new Promise(done=>{const im=new Image();
+    im.onload=()=>{ctx.drawImage(im,tx*T,ty*T);done()};im.onerror=done;
+    im.src='tile/'+tx+'/'+ty+'.png'+(v?'?v='+v:'')});
+}
+function pixels(data){
+  const [n,b64]=data.split(' '),count=+n,bin=atob(b64);
+  const bytes=new Uint8Array(bin.length);
+  for(let i=0;i<bin.length;i++)bytes[i]=bin.charCodeAt(i);
+  const idx=new Uint32Array(bytes.buffer,0,count);
+  let x0=W,y0=H,x1=0,y1=0;
+  for(const i of idx){const x=Math.floor(i/H),y=i%%H;
+    x0=Math.min(x0,x);y0=Math.min(y0,y);x1=Math.max(x1,x+1);y1=Math.max(y1,y+1)}
+  const img=ctx.getImageData(x0,y0,x1-x0,y1-y0),w=x1-x0;
+  for(let k=0;k<count;k++){const x=Math.floor(idx[k]/H)-x0,y=idx[k]%%H-y0,o=(y*w+x)*4,c=4*count+3*k;
+    img.data[o]=bytes[c];img.data[o+1]=bytes[c+1];img.data[o+2]=bytes[c+2];img.data[o+3]=255}
+  ctx.putImageData(img,x0,y0);
+}
+function tiles(e){for(const t of e.data.split(' ')){const [tx,ty]=t.split(',');
+  tile(+tx,+ty,e.lastEventId)}}
+// the tiles are loaded once the stream is open, so no change is missed;
+// events that arrive meanwhile are applied after them, in order
+let queue=[],loaded=false;
+const events=new EventSource('events');
+const later=f=>e=>queue?queue.push(()=>f(e)):f(e);
+events.addEventListener('pixels',later(e=>pixels(e.data)));
+events.addEventListener('tiles',later(tiles));
+events.addEventListener('reload',()=>location.reload());
+events.onopen=()=>{if(loaded)return;loaded=true;const loads=[];
+  for(let tx=0;tx*T<W;tx++)for(let ty=0;ty*T<H;ty++)loads.push(tile(tx,ty));
+  Promise.all(loads).then(()=>{for(const f of queue)f();queue=null})};
+</script></body></html>
+'''
+
+
+class _ViewerHandler(BaseHTTPRequestHandler):
+    viewer = None
+
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        feeds = self.viewer.feeds
+        if parts == ['']:
+            links = ''.join('<li><a href="%s/">%s</a></li>' % (name, name)
+                            for name in sorted(feeds))
+            self._send(200, 'text/html; charset=utf-8',
+                       ('<!DOCTYPE html><ul>%s</ul>' % links).encode('utf-8'))
+            return
+        feed = feeds.get(parts[0])
+        if feed is None:
+            self.send_error(404)
+        elif parts[1:] == [] and not self.path.split('?')[0].endswith('/'):
+            self.send_response(301)
+            self.send_header('Location', '/%s/' % parts[0])
+            self.end_headers()
+        elif parts[1:] in ([], ['']):
+            self._send(200, 'text/html; charset=utf-8', (PAGE % dict(
+                name=parts[0], width=feed.width, height=feed.height,
+                tile=feed.tile)).encode('utf-8'))
+        elif parts[1:] == ['info']:
+            self._send(200, 'application/json', json.dumps(dict(
+                width=feed.width, height=feed.height, tile=feed.tile,
+                versions=feed.versions.tolist())).encode('ascii'))
+        elif parts[1:] == ['events']:
+            self._stream(feed)
+        elif len(parts) == 4 and parts[1] == 'tile' and parts[3].endswith('.png'):
+            self._tile(feed, parts[2], parts[3][:-4])
+        else:
+            self.send_error(404)
+
+    def _send(self, status, content_type, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _tile(self, feed, tx, ty):
+        try:
+            tx, ty = int(tx), int(ty)
+        except ValueError:
+            tx = ty = -1
+        if not (0 <= tx < feed.versions.shape[0] and 0 <= ty < feed.versions.shape[1]):
+            self.send_error(404)
+            return
+        headers = [('Cache-Control', 'no-cache')]
+        etag = feed.etag(tx, ty)
+        if self.headers.get('If-None-Match') == etag:
+            TILES_NOT_MODIFIED.inc()
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        etag, data = feed.png(tx, ty)
+        self._send(200, 'image/png', data, headers + [('ETag', etag)])
+
+    def _stream(self, feed):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        started = CanvasViewer.started.encode('ascii')
+        # a browser reconnecting carries on after the last event it got
+        resume = self.headers.get('Last-Event-ID', '').partition('-')
+        if resume[1] and resume[0] == CanvasViewer.started and resume[2].isdigit():
+            number = min(int(resume[2]), feed.last_event)
+        else:
+            number = feed.last_event
+        with feed.lock:
+            feed.viewers += 1
+        VIEWERS.inc()
+        try:
+            while not self.viewer.stopping:
+                events = feed.events_after(number, self.viewer.keepalive)
+                if events is None:
+                    self.wfile.write(b'event: reload\ndata: \n\n')
+                    break
+                if not events:
+                    self.wfile.write(b': keepalive\n\n')
+                for number, event in events:
+                    self.wfile.write(b'id: %s-%d\n%s' % (started, number, event))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with feed.lock:
+                feed.viewers -= 1
+            VIEWERS.dec()
+        self.close_connection = True
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+class CanvasViewer(object):
+    """
+    HTTP server showing the canvases of the bot, see the module
+    docstring. Serves from daemon threads, one per connection.
+    :param port: port to listen on, 0 for any free one
+    :param host: address to listen on
+    :param interval: seconds between change events
+    :param keepalive: seconds of silence after which event streams get
+        a comment, so proxies keep them open
+    """
+
+    # part of every ETag, so a restarted bot does not match old ones
+    started = '%x' % int(time.time())
+
+    def __init__(self, port, host='127.0.0.1', interval=.2, keepalive=15.):
+        self.feeds = {}
+        self.interval = interval
+        self.keepalive = keepalive
+        self.stopping = False
+        handler = type('ViewerHandler', (_ViewerHandler,), {'viewer': self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, name='viewer',
+                         daemon=True).start()
+        threading.Thread(target=self._publish, name='viewer-events',
+                         daemon=True).start()
+        log.info('canvas viewer on http://%s:%d/', host, self.port)
+
+    def add(self, name, canvas, journal=None, **options):
+        """
+        Show a canvas as /<name>/, replacing any shown under that name.
+        :param journal: see CanvasFeed
+        :param options: further keyword arguments of CanvasFeed
+        :return: the CanvasFeed, to pass as journal to PixelBatch.apply
+        """
+        feed = CanvasFeed(canvas, journal=journal, **options)
+        self.feeds[name] = feed
+        return feed
+
+    def _publish(self):
+        while not self.stopping:
+            time.sleep(self.interval)
+            for feed in list(self.feeds.values()):
+                feed.publish()
+
+    def close(self):
+        self.stopping = True
+        self.server.shutdown()
+        self.server.server_close()